@@ -1,3 +1,25 @@
-from .eutils import EUtils
-from .diagnose import print_element
-from .pipeline import Config, Pipeline
+from importlib import import_module
+
+# names are imported from their modules when first used, so that commands which need
+# neither pandas nor the HTTP clients start quickly
+LAZY_NAMES = {
+    'EUtils': '.eutils',
+    'AsyncEUtils': '.aioeutils',
+    'print_element': '.diagnose',
+    'Config': '.config',
+    'Pipeline': '.pipeline',
+}
+
+__all__ = tuple(LAZY_NAMES)
+
+
+def __getattr__(name):
+    if name not in LAZY_NAMES:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(import_module(LAZY_NAMES[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(LAZY_NAMES))
@@ -0,0 +1,172 @@
+"""
+An asyncio version of the E-Utilities client
+"""
+import asyncio
+import time
+
+import aiohttp
+
+from .coalesce import AsyncSingleFlight
+from .eutils import EUTILS_PREFIX, EUTILS_URL, FORM_HEADERS, EUtils
+from .keypool import KeyPool, with_api_key
+from .metrics import Metrics
+from .tokenbucket import AsyncTokenBucket, RETRY_STATUSES, key_rejected, retry_after
+
+
+__all__ = (
+    'AsyncEUtils',
+    'AsyncResponse',
+)
+
+
+class AsyncResponse(object):
+    """
+    The parts of an HTTP response that the pipeline uses, read fully before the connection is released.
+    """
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+
+class AsyncEUtils(EUtils):
+    """
+    An abstraction that wraps the NCBI E-Utilities for use with asyncio
+
+    The methods `einfo`, `esearch`, `search`, `efetch`, and `epost` take the same arguments as
+    in `EUtils`, but return awaitables.  All requests share one pooled keep-alive connector,
+    and `limit` caps the number of connections it will open.  `keys` spreads requests over
+    several API keys, as in `EUtils`.
+    """
+    def __init__(self, apikey=None, email=None, rate=3, prefix=None, session=None, limit=100,
+                 retries=3, backoff=2.0, cache=None, metrics=None, keys=None):
+        # EUtils.__init__ would create a blocking session, so set up the attributes here
+        self.keypool = KeyPool(keys) if keys else None
+        self.apikey = apikey if self.keypool is None else None
+        self.email = email
+        self.rate = rate if self.keypool is None else self.keypool.max_rate
+        self.prefix = prefix if prefix else EUTILS_PREFIX
+        self.cache = cache
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.flights = AsyncSingleFlight()
+        self.session = session
+        self.limit = limit
+        self.retries = retries
+        self.backoff = backoff
+        # the key pool stands in for the token bucket, which `adapt` reads the rate of
+        self.tokenbucket = self.keypool or AsyncTokenBucket(rate=rate, tokens=rate, capacity=rate)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def get_session(self):
+        # the session must be created inside the running event loop
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=30)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def get(self, url, data=None):
+        """
+        GET `url`, or POST `data` to it, retrying when the server pushes back
+        """
+        session = self.get_session()
+        attempt = 0
+        metrics = self.metrics
+        keypool = self.keypool
+        key = None
+        while True:
+            stime = time.perf_counter()
+            request_url = url
+            if keypool is not None:
+                key, bucket, wait = keypool.reserve()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                request_url = with_api_key(url, key)
+            else:
+                bucket = self.tokenbucket
+                await bucket.consume(1)
+            sent = time.perf_counter()
+            metrics.observe('token_wait_seconds', sent - stime)
+            try:
+                if data is None:
+                    request = session.get(request_url)
+                else:
+                    request = session.post(request_url, data=data, headers=FORM_HEADERS)
+                async with request as r:
+                    content = await r.read()
+                    metrics.observe('http_request_seconds', time.perf_counter() - sent)
+                    metrics.inc('http_responses_total', status=r.status)
+                    if key is not None and key_rejected(r.status, content):
+                        metrics.inc('api_key_rejected_total', key=keypool.label(key))
+                        if keypool.reject(key):
+                            metrics.inc('api_keys_removed_total')
+                            if attempt < self.retries:
+                                attempt += 1
+                                continue
+                    if r.status in RETRY_STATUSES and key is not None:
+                        metrics.inc('api_key_pushback_total', key=keypool.label(key), status=r.status)
+                        if keypool.pushed_back(key, r.status):
+                            metrics.inc('api_keys_removed_total')
+                    if r.status in RETRY_STATUSES and attempt < self.retries:
+                        metrics.inc('http_retries_total', status=r.status)
+                        attempt += 1
+                        bucket.penalize()
+                        if r.status == 429:
+                            delay = retry_after(r.headers)
+                            bucket.pause(self.backoff if delay is None else delay)
+                        continue
+                    r.raise_for_status()
+                    bucket.reward()
+                    if key is not None:
+                        keypool.succeeded(key)
+                    return AsyncResponse(url, r.status, r.headers, content)
+            except aiohttp.ClientConnectionError:
+                if attempt >= self.retries:
+                    raise
+                attempt += 1
+
+    async def call(self, endpoint, params, parse=None, post=False):
+        async def call():
+            return self.decorate(endpoint, await self.fetch(endpoint, params, post), parse)
+
+        r, shared = await self.flights.do((endpoint, params, post, parse), call)
+        if shared:
+            self.count_shared(endpoint)
+        return r
+
+    async def search(self, db, history=False, webenv=None, query_key=None, retmax=20, post=False,
+                     keep_content=False, **kwargs):
+        params = self.search_params(db, history, webenv, query_key, retmax, **kwargs)
+
+        async def search():
+            return self.search_result(await self.fetch('esearch.fcgi', params, post), keep_content)
+
+        result, shared = await self.flights.do(('esearch.fcgi', params, post, keep_content), search)
+        if shared:
+            self.count_shared('esearch.fcgi')
+        return result
+
+    async def fetch(self, endpoint, params, post=False):
+        url = self.url(endpoint, params)
+        cached = self.cached(url)
+        if cached is not None:
+            r = AsyncResponse(url, 200, {'Content-Type': cached[0]}, cached[1])
+        else:
+            stime = time.perf_counter()
+            if post:
+                r = await self.get(EUTILS_URL.format(self.prefix, endpoint), params)
+            else:
+                r = await self.get(url)
+            self.count_call(endpoint, r, time.perf_counter() - stime)
+            self.store(url, r.headers['Content-Type'], r.content)
+        return r
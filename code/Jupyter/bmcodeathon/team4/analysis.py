@@ -0,0 +1,310 @@
+"""
+Bias analysis over the results.csv of one or more experiments
+"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from attrs import define
+
+from .idstore import IdListStore
+
+__all__ = (
+    'BiasArray',
+    'RankCurves',
+    'load_results',
+    'pivot',
+    'rank_curves',
+)
+
+SORTS = ['relevance', 'date_desc']
+
+RESULT_DTYPES = {
+    'search_index': 'int32',
+    'sort': pd.CategoricalDtype(SORTS),
+    'result_count': 'int32',
+    'return_count': 'int32',
+    'error_count': 'int32',
+    'bias_dimension': 'category',
+    'bias_result_count': 'int32',
+}
+
+
+def results_path(path):
+    path = Path(path)
+    return path / 'results.csv' if path.is_dir() else path
+
+
+def load_results(paths):
+    """
+    Load the results.csv of each experiment into one frame, with a categorical experiment column
+    """
+    frames = []
+    names = []
+    for path in paths:
+        path = results_path(path)
+        frames.append(pd.read_csv(path, dtype=RESULT_DTYPES, engine='c'))
+        names.append(path.parent.name)
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=list(RESULT_DTYPES))
+    df['experiment'] = pd.Categorical(np.repeat(names, [len(frame) for frame in frames]), categories=names)
+    # concat unions categories that differ between experiments, so set them once more
+    df['bias_dimension'] = df['bias_dimension'].astype('category')
+    return df
+
+
+@define
+class BiasArray:
+    """
+    Hedge counts pivoted to a (query, sort, hedge) array.
+
+    Each query is one (experiment, search_index) pair, and `present` marks the hedges
+    each experiment ran.  Counts that were never recorded are -1, and a query is excluded
+    when any of its rows has an error, a result_count of zero, or is missing.
+    """
+    experiments: list
+    hedges: list
+    queries: pd.DataFrame
+    counts: np.ndarray
+    excluded: np.ndarray
+    present: np.ndarray
+
+    @property
+    def query_present(self):
+        """
+        A (query, hedge) mask of the hedges that each query's experiment ran
+        """
+        return self.present[self.queries.experiment.cat.codes.to_numpy()]
+
+    @property
+    def differential(self):
+        """
+        Relevance minus date_desc hedge counts, as a (query, hedge) array
+        """
+        return self.counts[:, 0, :] - self.counts[:, 1, :]
+
+    @property
+    def included(self):
+        """
+        A (query, hedge) mask of the comparisons that count: no errors, and at least one hedge match
+        """
+        either = (self.counts[:, 0, :] > 0) | (self.counts[:, 1, :] > 0)
+        return either & self.query_present & ~self.excluded[:, np.newaxis]
+
+    def histograms(self):
+        """
+        Count the queries with each differential for each experiment and hedge
+        """
+        differential = self.differential
+        included = self.included
+        experiment = np.broadcast_to(self.queries.experiment.cat.codes.to_numpy()[:, np.newaxis], differential.shape)
+        hedge = np.broadcast_to(np.arange(len(self.hedges)), differential.shape)
+        offset = max(1, int(np.abs(differential[included]).max(initial=0)))
+        num_bins = 2 * offset + 1
+        bins = ((experiment[included] * len(self.hedges) + hedge[included]) * num_bins
+                + differential[included] + offset)
+        counts = np.bincount(bins, minlength=len(self.experiments) * len(self.hedges) * num_bins)
+        counts = counts.reshape(len(self.experiments), len(self.hedges), num_bins)
+        nonzero = np.nonzero(counts)
+        return pd.DataFrame({
+            'experiment': pd.Categorical.from_codes(nonzero[0], self.experiments),
+            'bias_dimension': pd.Categorical.from_codes(nonzero[1], self.hedges),
+            'differential': nonzero[2] - offset,
+            'count': counts[nonzero],
+        })
+
+    def summary(self):
+        """
+        Summarize the differentials for each experiment and hedge
+        """
+        differential = np.where(self.included, self.differential, 0)
+        codes = self.queries.experiment.cat.codes.to_numpy()
+        rows = []
+        for code, experiment in enumerate(self.experiments):
+            in_experiment = codes == code
+            included = self.included[in_experiment]
+            diffs = differential[in_experiment]
+            num_included = included.sum(axis=0)
+            with np.errstate(invalid='ignore'):
+                mean = diffs.sum(axis=0) / num_included
+            for i, hedge in enumerate(self.hedges):
+                rows.append({
+                    'experiment': experiment,
+                    'bias_dimension': hedge,
+                    'queries': int(in_experiment.sum()),
+                    'excluded': int(self.excluded[in_experiment].sum()),
+                    'compared': int(num_included[i]),
+                    'higher_relevance': int((diffs[:, i] > 0).sum()),
+                    'higher_date_desc': int((diffs[:, i] < 0).sum()),
+                    'mean_differential': mean[i],
+                })
+        return pd.DataFrame(rows)
+
+
+def pivot(df):
+    """
+    Pivot a frame from `load_results` to a `BiasArray`
+    """
+    experiments = list(df['experiment'].cat.categories)
+    experiment_codes = df['experiment'].cat.codes.to_numpy()
+    # number the queries by packing (experiment, search_index) into one integer
+    keys = (experiment_codes.astype(np.int64) << 32) | df['search_index'].to_numpy().astype(np.int64)
+    query_codes, unique_keys = pd.factorize(keys)
+    queries = pd.DataFrame({
+        'experiment': pd.Categorical.from_codes((unique_keys >> 32).astype(np.int32), experiments),
+        'search_index': (unique_keys & 0xffffffff).astype(np.int32),
+    })
+    sort_codes = df['sort'].cat.codes.to_numpy()
+    hedge_codes = df['bias_dimension'].cat.codes.to_numpy()
+    hedges = list(df['bias_dimension'].cat.categories)
+
+    counts = np.full((len(queries), len(SORTS), len(hedges)), -1, dtype=np.int32)
+    counts[query_codes, sort_codes, hedge_codes] = df['bias_result_count'].to_numpy()
+
+    present = np.zeros((len(experiments), len(hedges)), dtype=bool)
+    present[experiment_codes, hedge_codes] = True
+
+    bad = ((df['error_count'] > 0) | (df['result_count'] == 0)).to_numpy()
+    excluded = np.zeros(len(queries), dtype=bool)
+    excluded[query_codes[bad]] = True
+    query_present = present[queries.experiment.cat.codes.to_numpy()]
+    excluded |= ((counts < 0) & query_present[:, np.newaxis, :]).any(axis=(1, 2))
+
+    return BiasArray(experiments, hedges, queries, counts, excluded, present)
+
+
+def analyze(paths):
+    return pivot(load_results(paths))
+
+
+@define
+class RankCurves:
+    """
+    Cumulative hedge hits at each rank of the first stage IdLists, as a (query, sort, hedge, rank) array.
+
+    `hits[q, s, h, k]` is how many of the first k + 1 PMIDs of query q's IdList for sort s the hedge h matched,
+    so the counts of a run with any smaller `num_results` can be read off without running it.
+    """
+    bias: BiasArray
+    hits: np.ndarray
+
+    @property
+    def max_rank(self):
+        return self.hits.shape[-1]
+
+    def bias_at(self, cutoff):
+        """
+        The hedge counts among the top `cutoff` PMIDs, as a BiasArray
+        """
+        rank = min(cutoff, self.max_rank) - 1
+        counts = self.hits[..., rank] if rank >= 0 else np.zeros(self.hits.shape[:3], dtype=np.int32)
+        bias = self.bias
+        counts = np.where(bias.counts < 0, -1, counts).astype(np.int32)
+        return BiasArray(bias.experiments, bias.hedges, bias.queries, counts, bias.excluded, bias.present)
+
+    def summary(self, cutoffs):
+        """
+        Summarize the differentials for each experiment and hedge at each of `cutoffs`
+        """
+        frames = []
+        for cutoff in cutoffs:
+            frame = self.bias_at(cutoff).summary()
+            frame.insert(2, 'cutoff', cutoff)
+            frames.append(frame)
+        return pd.concat(frames, ignore_index=True)
+
+    def curves(self):
+        """
+        The mean cumulative hits of each sort at every rank, over the queries that are not excluded
+        """
+        codes = self.bias.queries.experiment.cat.codes.to_numpy()
+        ranks = np.arange(1, self.max_rank + 1)
+        frames = []
+        for code, experiment in enumerate(self.bias.experiments):
+            selected = (codes == code) & ~self.bias.excluded
+            means = self.hits[selected].mean(axis=0) if selected.any() else np.zeros(self.hits.shape[1:])
+            for i, hedge in enumerate(self.bias.hedges):
+                if not self.bias.present[code, i]:
+                    continue
+                frames.append(pd.DataFrame({
+                    'experiment': experiment,
+                    'bias_dimension': hedge,
+                    'rank': ranks,
+                    'relevance': means[0, i],
+                    'date_desc': means[1, i],
+                }))
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(
+            columns=['experiment', 'bias_dimension', 'rank', 'relevance', 'date_desc'])
+
+
+def experiment_hits(store, search_indexes, hedges):
+    """
+    Read the first stage and hedge IdLists of an experiment from its IdListStore, and
+    return a (query, sort, hedge, rank) array of cumulative hits, and a mask of the queries missing any IdList
+    """
+    keys = store.keys()
+    missing = np.zeros(len(search_indexes), dtype=bool)
+    idlists = []
+    for q, search_index in enumerate(search_indexes):
+        for sort_order in SORTS:
+            key = (str(search_index), sort_order, '')
+            if key in keys:
+                idlists.append(store.get(*key))
+            else:
+                idlists.append(np.empty(0, dtype=np.uint32))
+                missing[q] = True
+    max_rank = max((len(idlist) for idlist in idlists), default=0)
+    lengths = np.array([len(idlist) for idlist in idlists], dtype=np.int64)
+    # the IdLists of each (query, sort) case, padded with PMID 0, which no hedge matches
+    first_stage = np.zeros((len(idlists), max_rank), dtype=np.int64)
+    first_stage[np.arange(max_rank) < lengths[:, np.newaxis]] = np.concatenate(idlists) if idlists else []
+    # key each PMID by its case, so that one isin call matches every case at once
+    case_keys = np.arange(len(idlists), dtype=np.int64)[:, np.newaxis] << 32
+    first_keys = case_keys | first_stage
+
+    hits = np.zeros((len(search_indexes), len(SORTS), len(hedges), max_rank), dtype=np.int16)
+    for h, hedge in enumerate(hedges):
+        matched = []
+        for case, (search_index, sort_order) in enumerate(
+                (search_index, sort_order) for search_index in search_indexes for sort_order in SORTS):
+            key = (str(search_index), sort_order, hedge)
+            if key in keys:
+                matched.append((np.int64(case) << 32) | store.get(*key).astype(np.int64))
+            else:
+                missing[case // len(SORTS)] = True
+        matched = np.concatenate(matched) if matched else np.empty(0, dtype=np.int64)
+        found = np.isin(first_keys, matched) & (first_stage > 0)
+        hits[:, :, h, :] = np.cumsum(found, axis=1).reshape(len(search_indexes), len(SORTS), max_rank)
+    return hits, missing
+
+
+def rank_curves(paths):
+    """
+    Compute the cumulative hedge hits at every rank from the IdLists each experiment stored
+    """
+    bias = analyze(paths)
+    codes = bias.queries.experiment.cat.codes.to_numpy()
+    parts = []
+    for code, path in enumerate(paths):
+        path = results_path(path).parent
+        if not (path / 'idlists.idx').exists():
+            raise ValueError(f'{path}: no stored IdLists')
+        in_experiment = np.flatnonzero(codes == code)
+        hedges = [hedge for i, hedge in enumerate(bias.hedges) if bias.present[code, i]]
+        hits, missing = experiment_hits(IdListStore(path).load(),
+                                        bias.queries.search_index.to_numpy()[in_experiment], hedges)
+        parts.append((in_experiment, hedges, hits, missing))
+
+    max_rank = max((hits.shape[-1] for _, _, hits, _ in parts), default=0)
+    all_hits = np.zeros((len(bias.queries), len(SORTS), len(bias.hedges), max_rank), dtype=np.int16)
+    hedge_codes = dict((hedge, i) for i, hedge in enumerate(bias.hedges))
+    for in_experiment, hedges, hits, missing in parts:
+        rank = hits.shape[-1]
+        columns = [hedge_codes[hedge] for hedge in hedges]
+        block = np.zeros((len(in_experiment), len(SORTS), len(bias.hedges), max_rank), dtype=np.int16)
+        block[:, :, columns, :rank] = hits
+        # IdLists shorter than the longest stay at their last count
+        if rank:
+            block[:, :, columns, rank:] = hits[..., -1:]
+        all_hits[in_experiment] = block
+        bias.excluded[in_experiment[missing]] = True
+    return RankCurves(bias, all_hits)
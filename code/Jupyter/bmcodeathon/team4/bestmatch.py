@@ -0,0 +1,194 @@
+"""
+The Best Match and date sorted comparison of code/Python/best_match_comp_counter.py, as a pipeline mode
+"""
+import asyncio
+import csv
+import json
+import sys
+
+import pandas as pd
+from progress.bar import Bar
+
+from .pipeline import SORT_ORDERS, Pipeline
+from .retry import TransientError, is_transient_message
+
+
+__all__ = (
+    'BestMatchPipeline',
+    'ComparisonWriter',
+)
+
+# the column prefix of each sort in the output
+SORT_PREFIXES = {'relevance': 'BM', 'date_desc': 'DS'}
+
+
+class ComparisonWriter(object):
+    """
+    Writes one row per search as soon as both of its sorts have finished, flushing each row.
+
+    Rows are in the order searches finish, not the order of the search terms; search_count
+    gives each row's place in the terms file.
+    """
+    def __init__(self, path, hedges):
+        self.fieldnames = ['search_count', 'search_pointer', 'total_count', 'best_match_all', 'date_sort_all']
+        for hedge in hedges:
+            self.fieldnames += [f'{hedge}_BM_ids', f'{hedge}_BM_count', f'{hedge}_DS_ids', f'{hedge}_DS_count']
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.DictWriter(self.file, self.fieldnames)
+        self.writer.writeheader()
+        self.rows = 0
+
+    def write(self, row):
+        self.writer.writerow(row)
+        self.file.flush()
+        self.rows += 1
+
+    def close(self):
+        self.file.close()
+
+
+class BestMatchPipeline(Pipeline):
+    """
+    Searches each term with '[Filter]' syntax, sorted by relevance and by date, and then searches the
+    PMIDs of each sort ORed together and ANDed with each hedge, with the same sort.
+
+    Searches are POSTed and answered in JSON, as the script did, but on the pipeline's rate limited
+    session, with its workers, retries, and circuit breaker, and rows are written as searches finish.
+    Unlike the script, a search with no PMIDs skips its hedge searches, which could only fail, and
+    every search gets a row, with empty values for a sort that raised an exception.
+    """
+    def __init__(self, config, searchterms_path, hedges_path, output_path, item_count=None):
+        super().__init__(config)
+        self.searchterms_path = searchterms_path
+        self.hedges_path = hedges_path
+        self.output_path = output_path
+        self.item_count = item_count if item_count is not None else config.num_results
+        self.pending = {}
+        self.error_log = sys.stderr
+
+    def setup(self, resume=False):
+        self.hedge = self.load_hedges(self.hedges_path)
+        terms = pd.read_csv(self.searchterms_path, dtype=str, keep_default_na=False)
+        # searches are numbered from 1, in the order of the file
+        self.queries = pd.DataFrame({'query_term': terms['processed_query'].to_numpy()},
+                                    index=pd.RangeIndex(1, len(terms) + 1))
+
+    def first_stage_term(self, search_index):
+        return self.queries.query_term[search_index] + " AND 'medline'[Filter]"
+
+    def search_params(self, term, sort_order):
+        return self.eutils.params('pubmed', term=term, retmax=str(self.item_count), retstart='0',
+                                  retmode='json', sort=sort_order)
+
+    def search_result(self, r, label):
+        """
+        Return the count and IdList of a JSON esearch response
+        """
+        with self.metrics.timer('json_parse_seconds', endpoint='esearch'):
+            document = json.loads(r.content)
+        result = document.get('esearchresult', {})
+        error = result.get('ERROR') or document.get('error')
+        if error:
+            if self.config.retry_attempts and is_transient_message(error):
+                raise TransientError(f'{label}: {error}')
+            self.log_error(f'{label}:\n{error}')
+            return 1, 0, []
+        return 0, int(result.get('count', 0)), result.get('idlist', [])
+
+    def hedge_terms(self, pmids):
+        idlist = '(' + ' OR '.join(pmids) + ')'
+        for hedge_name, hedge_row in self.hedge.iterrows():
+            yield hedge_name, idlist + ' AND (' + hedge_row['Hedge_text'] + ')'
+
+    def run_case(self, search_index, sort_order):
+        label = f'{search_index}, {sort_order}'
+        params = self.search_params(self.first_stage_term(search_index), sort_order)
+        with self.metrics.timer('stage_seconds', stage='first_stage'):
+            r = self.eutils.call('esearch.fcgi', params, post=True)
+        error_count, count, pmids = self.search_result(r, label)
+        hedges = {}
+        if pmids:
+            for hedge_name, term in self.hedge_terms(pmids):
+                with self.metrics.timer('stage_seconds', stage='hedge'):
+                    r = self.eutils.call('esearch.fcgi', self.search_params(term, sort_order), post=True)
+                hedge_errors, hedge_count, hedge_pmids = self.search_result(r, f'{label}, {hedge_name}')
+                error_count += hedge_errors
+                hedges[hedge_name] = (hedge_pmids, hedge_count)
+        return {'error_count': error_count, 'total_count': count, 'ids': pmids, 'hedges': hedges}
+
+    async def run_case_async(self, eutils, search_index, sort_order):
+        label = f'{search_index}, {sort_order}'
+        params = self.search_params(self.first_stage_term(search_index), sort_order)
+        with self.metrics.timer('stage_seconds', stage='first_stage'):
+            r = await eutils.call('esearch.fcgi', params, post=True)
+        error_count, count, pmids = self.search_result(r, label)
+        hedges = {}
+        if pmids:
+            hedge_terms = list(self.hedge_terms(pmids))
+            with self.metrics.timer('stage_seconds', stage='hedge'):
+                responses = await asyncio.gather(*(
+                    eutils.call('esearch.fcgi', self.search_params(term, sort_order), post=True)
+                    for _, term in hedge_terms
+                ))
+            for (hedge_name, _), r in zip(hedge_terms, responses):
+                hedge_errors, hedge_count, hedge_pmids = self.search_result(r, f'{label}, {hedge_name}')
+                error_count += hedge_errors
+                hedges[hedge_name] = (hedge_pmids, hedge_count)
+        return {'error_count': error_count, 'total_count': count, 'ids': pmids, 'hedges': hedges}
+
+    def run_unit(self, batch):
+        return [self.run_case(*case) for case in batch]
+
+    async def run_unit_async(self, eutils, batch):
+        return [await self.run_case_async(eutils, *case) for case in batch]
+
+    def comparison_row(self, search_index, cases):
+        """
+        The output row of a search, with empty values for a sort that raised an exception
+        """
+        finished = [case for case in cases.values() if case is not None]
+        row = {
+            'search_count': search_index,
+            'search_pointer': self.first_stage_term(search_index)[0:5],
+            'total_count': finished[0]['total_count'] if finished else '',
+            'best_match_all': cases['relevance']['ids'] if cases['relevance'] else '',
+            'date_sort_all': cases['date_desc']['ids'] if cases['date_desc'] else '',
+        }
+        for hedge_name in self.hedge.index:
+            for sort_order in SORT_ORDERS:
+                if cases[sort_order] is None:
+                    pmids, count = '', ''
+                else:
+                    pmids, count = cases[sort_order]['hedges'].get(hedge_name, ([], 0))
+                row[f'{hedge_name}_{SORT_PREFIXES[sort_order]}_ids'] = pmids
+                row[f'{hedge_name}_{SORT_PREFIXES[sort_order]}_count'] = count
+        return row
+
+    def finish_case(self, results, progress, search_index, sort_order, atom):
+        progress.next()
+        if isinstance(atom, Exception):
+            self.metrics.inc('cases_total', status='exception')
+            self.log_error(f'{search_index}, {sort_order}: exception: {atom}')
+            atom = None
+        else:
+            self.metrics.inc('cases_total', status='error' if atom['error_count'] else 'ok')
+        cases = self.pending.setdefault(search_index, {})
+        cases[sort_order] = atom
+        if len(cases) < len(SORT_ORDERS):
+            return
+        del self.pending[search_index]
+        results.write(self.comparison_row(search_index, cases))
+
+    def run(self):
+        results = ComparisonWriter(self.output_path, self.hedge.index)
+        progress = Bar('Running', max=2 * len(self.queries))
+        try:
+            eutils = self.run_round(results, progress)
+        finally:
+            progress.finish()
+            results.close()
+        print(f'{eutils.call_count} API Calls, {self.error_count} errors')
+        if eutils.coalesced_count:
+            print(f'{eutils.coalesced_count} calls saved by sharing identical requests in flight')
+        print(f'{results.rows} searches in {self.output_path}')
+        return 0
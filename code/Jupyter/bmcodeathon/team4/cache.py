@@ -0,0 +1,121 @@
+"""
+A persistent cache of E-Utilities responses
+"""
+import hashlib
+import sqlite3
+import time
+import zlib
+from threading import Lock
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+
+__all__ = (
+    'ResponseCache',
+    'cache_key',
+)
+
+# parameters that do not change the response
+IGNORED_PARAMS = {'api_key', 'email', 'tool'}
+
+# parameters that refer to the history server, whose state expires
+HISTORY_PARAMS = {'usehistory', 'WebEnv', 'query_key'}
+
+
+def cache_key(url):
+    """
+    Normalize a request URL to the endpoint and its sorted parameters, leaving out the API key
+    """
+    parts = urlsplit(url)
+    endpoint = parts.path.rsplit('/', 1)[-1]
+    params = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in IGNORED_PARAMS)
+    normalized = endpoint + '?' + urlencode(params)
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def cacheable(url):
+    params = dict(parse_qsl(urlsplit(url).query))
+    return not any(key in params for key in HISTORY_PARAMS)
+
+
+class ResponseCache(object):
+    """
+    A SQLite file of zlib compressed response bodies.
+
+    Entries older than `ttl` seconds are treated as missing, and once the compressed bodies
+    exceed `max_bytes`, the least recently used entries are evicted.
+    """
+    def __init__(self, path, ttl=None, max_bytes=2**30):
+        self.path = str(path)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    content_type TEXT NOT NULL,
+                    body BLOB NOT NULL
+                )
+            """)
+            self.conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        # the size of the bodies is kept as entries come and go, so that a put need not sum them
+        self.total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    @property
+    def size(self):
+        with self.lock:
+            return self.total
+
+    def get(self, url):
+        """
+        Return the content type and body cached for `url`, or None
+        """
+        key = cache_key(url)
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                'SELECT created, content_type, body FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            created, content_type, body = row
+            if self.ttl is not None and created < now - self.ttl:
+                self.conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.total -= len(body)
+                return None
+            self.conn.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+        return content_type, zlib.decompress(body)
+
+    def put(self, url, content_type, content):
+        body = zlib.compress(content)
+        now = time.time()
+        key = cache_key(url)
+        with self.lock, self.conn:
+            replaced = self.conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.conn.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                (key, now, now, len(body), content_type, body)
+            )
+            self.total += len(body) - (replaced[0] if replaced else 0)
+            self.evict()
+
+    def evict(self):
+        if self.total <= self.max_bytes:
+            return
+        rows = self.conn.execute('SELECT key, size FROM responses ORDER BY accessed')
+        evicted = []
+        for key, size in rows:
+            if self.total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            self.total -= size
+        self.conn.executemany('DELETE FROM responses WHERE key = ?', evicted)
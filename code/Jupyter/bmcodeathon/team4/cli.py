@@ -1,8 +1,14 @@
 import os
 import sys
 from argparse import ArgumentParser, ArgumentTypeError
+from datetime import datetime
+from pathlib import Path
 
-from .pipeline import Config, Pipeline
+from .config import Config
+
+
+COMMANDS = ('run', 'rerun', 'bestmatch', 'plan', 'merge', 'evaluate', 'analyze', 'replay', 'status',
+            'validate-config')
 
 
 def existing_path(value):
@@ -11,23 +17,358 @@ def existing_path(value):
         raise ArgumentTypeError('should be an existing file')
     return value
 
-def create_parser(prog_name):
-    parser = ArgumentParser(prog=prog_name, description='Run team4 pipeline')
+def shard_value(value):
+    from .shard import parse_shard
+
+    try:
+        return parse_shard(value)
+    except ValueError as e:
+        raise ArgumentTypeError(str(e))
+
+def cutoffs_value(value):
+    try:
+        cutoffs = [int(part) for part in value.split(',')]
+    except ValueError:
+        raise ArgumentTypeError('should be ranks separated by commas, e.g. 10,20,50')
+    if any(cutoff < 1 for cutoff in cutoffs):
+        raise ArgumentTypeError('ranks start at 1')
+    return cutoffs
+
+def add_run_arguments(parser):
     parser.add_argument('--config', '-c', metavar='CONFIG_PATH', default=None,
                         help='Configuration file')
     parser.add_argument('--experiment', '-e', metavar='EXPERIMENT_PATH', default=None,
                         help='Relative path for intermediate and final results of this experiment')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='Continue an interrupted experiment, running only its missing or errored cases')
+    parser.add_argument('--shard', metavar='I/N', type=shard_value, default=None,
+                        help='Run shard I, from 0, of the experiment split N ways; combine the shards with merge')
+    parser.add_argument('--api-key', metavar='API_KEY', default=None,
+                        help='API key to use instead of the configured one, e.g. one per shard')
+
+def add_rerun_arguments(parser):
+    parser.add_argument('--config', '-c', metavar='CONFIG_PATH', default=None,
+                        help='Configuration file')
+    parser.add_argument('--from', dest='prior', metavar='EXPERIMENT_PATH', required=True,
+                        help='Experiment whose queries and first stage IdLists to reuse')
+    parser.add_argument('--hedges', metavar='HEDGES_PATH', type=existing_path, required=True,
+                        help='Hedge file to run; only hedges that are new or changed are searched')
+    parser.add_argument('--experiment', '-e', metavar='EXPERIMENT_PATH', default=None,
+                        help='Relative path for the results of the rerun')
+
+def add_bestmatch_arguments(parser):
+    # the arguments of code/Python/best_match_comp_counter.py
+    parser.add_argument('--searchtermsfile', metavar='CSV_PATH', type=existing_path, required=True,
+                        help='CSV-formatted file of searches to test, with a processed_query column')
+    parser.add_argument('--hedgesfile', metavar='CSV_PATH', type=existing_path, required=True,
+                        help='CSV-formatted file of hedges to test searches against')
+    parser.add_argument('--itemcounts', type=int, default=None,
+                        help='Number of items to pull for each search; num_results by default')
+    parser.add_argument('--api_key', default=None, help='API key to use instead of the configured one')
+    parser.add_argument('--config', '-c', metavar='CONFIG_PATH', default=None,
+                        help='Configuration file, for rate_limit, max_workers, run_mode, and eutils_prefix')
+    parser.add_argument('--output', '-o', metavar='CSV_PATH', default=None,
+                        help='Output file; simpleoutput_<searchtermsfile>_<date>.csv by default')
+
+def add_plan_arguments(parser):
+    parser.add_argument('--config', '-c', metavar='CONFIG_PATH', default=None,
+                        help='Configuration file')
+    parser.add_argument('--latency', type=float, default=None,
+                        help='Seconds each call takes, instead of measuring it with a few searches')
+    parser.add_argument('--probe', type=int, default=3, help='Number of searches to measure latency with')
+    parser.add_argument('--rerun', dest='prior', metavar='EXPERIMENT_PATH', default=None,
+                        help='Plan a rerun of this experiment instead, which searches only new or changed hedges')
+    parser.add_argument('--hedges', metavar='HEDGES_PATH', type=existing_path, default=None,
+                        help='Hedge file of the rerun')
+
+def add_merge_arguments(parser):
+    parser.add_argument('--config', '-c', metavar='CONFIG_PATH', default=None,
+                        help='Configuration file the shards were run with')
+    parser.add_argument('--experiment', '-e', metavar='EXPERIMENT_PATH', required=True,
+                        help='Relative path of the sharded experiment')
+
+def add_evaluate_arguments(parser):
+    parser.add_argument('--config', '-c', metavar='CONFIG_PATH', default=None,
+                        help='Configuration file')
+    parser.add_argument('--experiment', '-e', metavar='EXPERIMENT_PATH', required=True,
+                        help='Relative path of the experiment whose first stage IdLists to count')
+    parser.add_argument('--hedges', metavar='HEDGES_PATH', type=existing_path, default=None,
+                        help='Hedges to evaluate, instead of the configured hedge_path')
+    parser.add_argument('--offline', action='store_true', default=False,
+                        help='Use only the records already fetched')
+    parser.add_argument('--output', '-o', metavar='CSV_PATH', default=None,
+                        help='Where to write the counts, by default local-results.csv in the experiment')
+
+def add_analyze_arguments(parser):
+    parser.add_argument('experiments', metavar='EXPERIMENT_PATH', nargs='+', type=existing_path,
+                        help='Experiment directories, or their results.csv')
+    parser.add_argument('--histograms', '-o', metavar='CSV_PATH', default=None,
+                        help='Write the differential histograms to this file')
+    parser.add_argument('--cutoffs', metavar='K,K,...', type=cutoffs_value, default=None,
+                        help='Also compare the sorts among only the top K PMIDs, from the stored IdLists')
+    parser.add_argument('--curves', metavar='CSV_PATH', default=None,
+                        help='Write the mean cumulative hedge hits of each sort at every rank to this file')
+
+def add_status_arguments(parser):
+    parser.add_argument('experiment', metavar='EXPERIMENT_PATH',
+                        help='Experiment directory, or its path relative to the configured result_path')
+    parser.add_argument('--config', '-c', metavar='CONFIG_PATH', default=None,
+                        help='Configuration file, for result_path')
+
+def add_validate_config_arguments(parser):
+    parser.add_argument('config', metavar='CONFIG_PATH', type=existing_path, help='Configuration file to check')
+
+def add_replay_arguments(parser):
+    parser.add_argument('recordings', metavar='RECORDINGS_PATH', type=existing_path,
+                        help='Experiment directory with saved first stage XML, e.g. data/results/sample-1')
+    parser.add_argument('--port', '-p', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    parser.add_argument('--error-429', type=float, default=0.0, help='Probability of answering 429')
+    parser.add_argument('--error-502', type=float, default=0.0, help='Probability of answering 502')
+    parser.add_argument('--rate-limit', type=float, default=None, help='Requests per second before answering 429')
+
+def create_parser(prog_name):
+    parser = ArgumentParser(prog=prog_name, description='Run team4 pipeline')
+    subparsers = parser.add_subparsers(dest='command')
+    add_run_arguments(subparsers.add_parser('run', help='Run an experiment (the default)'))
+    add_rerun_arguments(subparsers.add_parser('rerun', help='Run an experiment again with changed hedges'))
+    add_bestmatch_arguments(subparsers.add_parser('bestmatch', help='Compare Best Match and date sorted searches, '
+                                                               'one row per search, as best_match_comp_counter.py'))
+    add_plan_arguments(subparsers.add_parser('plan', help='Estimate the calls and time a run will take'))
+    add_merge_arguments(subparsers.add_parser('merge', help='Combine the shards of an experiment'))
+    add_evaluate_arguments(subparsers.add_parser('evaluate', help='Count hedge matches locally, from fetched records'))
+    add_analyze_arguments(subparsers.add_parser('analyze', help='Compare relevance and date_desc hedge counts'))
+    add_replay_arguments(subparsers.add_parser('replay', help='Serve recorded responses as a local E-Utilities'))
+    add_status_arguments(subparsers.add_parser('status', help='Report how far an experiment has got'))
+    add_validate_config_arguments(subparsers.add_parser('validate-config', help='Check a configuration file'))
     return parser
 
+def run(parser, opts):
+    from .pipeline import Pipeline
+
+    if opts.resume and opts.experiment is None:
+        parser.error('--resume requires --experiment')
+    if opts.shard and opts.experiment is None:
+        parser.error('--shard requires --experiment, so that the shards share it')
+    config = Config.load(opts.config)
+    if opts.api_key:
+        config.api_key = opts.api_key
+        config.api_keys = None
+    try:
+        pipeline = Pipeline(config, opts.experiment, shard=opts.shard)
+    except ValueError as e:
+        parser.error(str(e))
+    pipeline.setup(resume=opts.resume)
+    return pipeline.run()
+
+def rerun(parser, opts):
+    from .pipeline import Pipeline
+
+    config = Config.load(opts.config)
+    pipeline = Pipeline(config, opts.experiment)
+    try:
+        pipeline.setup_rerun(opts.prior, opts.hedges)
+    except ValueError as e:
+        parser.error(str(e))
+    prior = pipeline.prior
+    print(f'{len(prior.cases)} cases reused from {prior.path}; searching {len(prior.changed)} new or changed '
+          f'hedges, and reusing {len(prior.unchanged)}')
+    return pipeline.run()
+
+def bestmatch(parser, opts):
+    from .bestmatch import BestMatchPipeline
+
+    config = Config.load(opts.config)
+    if opts.api_key:
+        config.api_key = opts.api_key
+        config.api_keys = None
+    output_path = opts.output
+    if output_path is None:
+        output_path = f'simpleoutput_{opts.searchtermsfile[:-4]}_{datetime.now().strftime("%Y_%m_%d")}.csv'
+    pipeline = BestMatchPipeline(config, opts.searchtermsfile, opts.hedgesfile, output_path, opts.itemcounts)
+    pipeline.setup()
+    return pipeline.run()
+
+def plan(parser, opts):
+    from .concurrency import MAX_HEDGE_UIDS, plan_run, probe_latency
+    from .pipeline import Pipeline
+
+    if opts.prior and opts.hedges is None:
+        parser.error('--rerun requires --hedges')
+    config = Config.load(opts.config)
+    pipeline = Pipeline(config)
+    try:
+        hedges = pipeline.load_hedges(opts.hedges)
+    except OSError as e:
+        parser.error(str(e))
+    num_hedges = len(hedges)
+    rerun = {}
+    if opts.prior:
+        import pandas as pd
+
+        from .rerun import PriorExperiment
+
+        prior_path = Path(config.result_path) / opts.prior
+        if not (prior_path / 'results.csv').exists():
+            parser.error(f'{prior_path}: no results to rerun')
+        prior = PriorExperiment(prior_path, hedges)
+        rerun = {
+            'num_queries': len(pd.read_csv(prior_path / 'queries.csv', index_col=0)),
+            'reused_cases': len(prior.cases),
+            'changed_hedges': len(prior.changed),
+        }
+        print(f'{len(prior.cases)} cases reused from {prior_path}; searching {len(prior.changed)} new or changed '
+              f'hedges, and reusing {len(prior.unchanged)}')
+    latency = opts.latency
+    if latency is None:
+        latency = probe_latency(pipeline.eutils, opts.probe)
+    estimate = plan_run(config, num_hedges, latency, **rerun)
+    print(f'{estimate["calls"]} calls for {estimate["queries"]} queries and {num_hedges} hedges: '
+          f'{estimate["first_stage_calls"]} first stage and {estimate["hedge_calls"]} hedge searches')
+    if config.hedge_batch and not config.hedge_index_path:
+        print(f'Hedge searches are at most that many, counting each batch as {config.num_results} PMIDs per case, '
+              f'searched {MAX_HEDGE_UIDS} at a time')
+    print(f'{latency:.3f} seconds per call, {estimate["calls_per_second"]:.1f} calls per second '
+          f'with {estimate["max_workers"]} workers ({estimate["bound"]}-bound)')
+    print(f'About {estimate["seconds"] / 60:.1f} minutes')
+    if estimate['bound'] == 'latency':
+        print(f'Set max_workers to {estimate["recommended_max_workers"]}, or auto, '
+              f'to reach the rate limit of {config.total_rate}')
+    return 0
+
+def merge(parser, opts):
+    from .pipeline import Pipeline
+    from .shard import merge_shards
+
+    config = Config.load(opts.config)
+    pipeline = Pipeline(config, opts.experiment)
+    try:
+        results = merge_shards(pipeline.result_path, list(pipeline.load_hedges().index))
+    except ValueError as e:
+        parser.error(str(e))
+    print(f'Merged {len(results)} results in {pipeline.result_path / "results.csv"}')
+    return 0
+
+def evaluate(parser, opts):
+    from .hedgequery import HedgeSyntaxError
+    from .pipeline import Pipeline
+
+    config = Config.load(opts.config)
+    pipeline = Pipeline(config, opts.experiment)
+    hedges = pipeline.load_hedges(opts.hedges)
+    try:
+        counts = pipeline.evaluate_hedges(hedges, offline=opts.offline)
+    except HedgeSyntaxError as e:
+        parser.error(f'hedge: {e}')
+    output_path = opts.output or pipeline.result_path / 'local-results.csv'
+    counts.to_csv(output_path, index=False)
+    counts['agree'] = counts.bias_result_count == counts.server_result_count
+    summary = counts.groupby('bias_dimension', sort=False).agg(
+        local=('bias_result_count', 'sum'),
+        server=('server_result_count', 'sum'),
+        agreement=('agree', 'mean'),
+    )
+    print(summary.to_string())
+    print(f'Counts in {output_path}')
+    return 0
+
+def analyze(parser, opts):
+    from .analysis import analyze, rank_curves
+
+    bias = analyze(opts.experiments)
+    print(bias.summary().to_string(index=False))
+    if opts.histograms:
+        bias.histograms().to_csv(opts.histograms, index=False)
+    if opts.cutoffs or opts.curves:
+        try:
+            curves = rank_curves(opts.experiments)
+        except ValueError as e:
+            parser.error(str(e))
+        if opts.cutoffs:
+            print()
+            print(curves.summary(opts.cutoffs).to_string(index=False))
+        if opts.curves:
+            curves.curves().to_csv(opts.curves, index=False)
+    return 0
+
+def replay(parser, opts):
+    from .replay import ReplayServer
+
+    server = ReplayServer(opts.recordings, ('127.0.0.1', opts.port), latency=opts.latency,
+                          error_429=opts.error_429, error_502=opts.error_502, rate_limit=opts.rate_limit)
+    print(f'Set eutils_prefix: {server.prefix}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+def status(parser, opts):
+    from .status import ExperimentStatus
+
+    path = Path(opts.experiment)
+    if not path.is_dir():
+        path = Path(Config.load(opts.config).result_path) / opts.experiment
+    if not path.is_dir():
+        parser.error(f'{opts.experiment}: no such experiment')
+    paths = [path]
+    if not (path / 'results.csv').exists():
+        # a sharded experiment that has not been merged reports each of its shards, named as shard_dirname
+        # names them, since importing shard would import pandas
+        shards = sorted(path.glob('shard-*-of-*'))
+        paths = shards or paths
+    for index, path in enumerate(paths):
+        if index:
+            print()
+        print('\n'.join(ExperimentStatus(path).summary()))
+    return 0
+
+def validate_config(parser, opts):
+    try:
+        config = Config.load(opts.config)
+    except ValueError as e:
+        print(e)
+        return 1
+    problems = [
+        f'{name} {getattr(config, name)} does not exist'
+        for name in ('data_path', 'hedge_path')
+        if not os.path.exists(getattr(config, name))
+    ]
+    for problem in problems:
+        print(f'{opts.config}: {problem}')
+    if problems:
+        return 1
+    print(f'{opts.config}: OK')
+    return 0
+
 def main(args=None):
     if args is None:
         args = sys.argv
+    # without a command, the arguments are for run, as before there were commands
+    if len(args) < 2 or args[1] not in COMMANDS + ('-h', '--help'):
+        args = [args[0], 'run'] + list(args[1:])
     parser = create_parser(args[0])
     opts = parser.parse_args(args[1:])
-    config = Config.load(opts.config)
-    pipeline = Pipeline(config, opts.experiment)
-    pipeline.setup()
-    rc = pipeline.run()
+    if opts.command == 'rerun':
+        rc = rerun(parser, opts)
+    elif opts.command == 'bestmatch':
+        rc = bestmatch(parser, opts)
+    elif opts.command == 'plan':
+        rc = plan(parser, opts)
+    elif opts.command == 'merge':
+        rc = merge(parser, opts)
+    elif opts.command == 'evaluate':
+        rc = evaluate(parser, opts)
+    elif opts.command == 'analyze':
+        rc = analyze(parser, opts)
+    elif opts.command == 'replay':
+        rc = replay(parser, opts)
+    elif opts.command == 'status':
+        rc = status(parser, opts)
+    elif opts.command == 'validate-config':
+        rc = validate_config(parser, opts)
+    else:
+        rc = run(parser, opts)
     if rc:
         raise SystemExit(int(rc))
 
@@ -0,0 +1,101 @@
+"""
+Coalescing identical requests: a canonical form for search terms, and single-flight sharing of calls in flight
+"""
+import asyncio
+from concurrent.futures import Future
+from threading import Lock
+
+from .hedgequery import OPERATORS, HedgeSyntaxError, tokenize
+
+
+__all__ = (
+    'AsyncSingleFlight',
+    'SingleFlight',
+    'normalize_term',
+)
+
+
+def normalize_term(term):
+    """
+    Rewrite a search term in a canonical form that PubMed searches the same way, so that equivalent
+    terms make identical requests.
+
+    PubMed ignores case, except in the Boolean operators, which count only in upper case, and ignores
+    spacing between tokens, so words and phrases are lower cased, field tags upper cased, and tokens
+    separated by single spaces, with none inside parentheses or between a term and its tag.
+    """
+    try:
+        tokens = list(tokenize(term))
+    except HedgeSyntaxError:
+        # without balanced quotes and brackets, only spacing is safe to change
+        return ' '.join(term.split())
+    parts = []
+    for kind, value in tokens:
+        if kind in ('operator', 'paren'):
+            part = value
+        elif kind == 'tag':
+            part = '[' + ' '.join(value.split()).upper() + ']'
+        elif kind == 'quoted':
+            part = '"' + ' '.join(value.split()).lower() + '"'
+        else:
+            part = value.lower()
+        tag = kind == 'tag'
+        if parts and parts[-1] != '(' and part != ')' and not (tag and parts[-1] not in OPERATORS):
+            parts.append(' ')
+        parts.append(part)
+    return ''.join(parts)
+
+
+class SingleFlight(object):
+    """
+    Lets threads making the same call at the same time share it: the first runs it, and the others
+    wait for its result, or its exception.  Calls are shared only while in flight; nothing is kept after.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.flights = {}
+
+    def do(self, key, call):
+        """
+        Return the result of `call()`, and whether it came from a call another thread made
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Future()
+        if not leader:
+            return flight.result(), True
+        try:
+            result = call()
+        except BaseException as exc:
+            flight.set_exception(exc)
+            raise
+        else:
+            flight.set_result(result)
+        finally:
+            with self.lock:
+                del self.flights[key]
+        return result, False
+
+
+class AsyncSingleFlight(object):
+    """
+    The same sharing as SingleFlight, for coroutines on one event loop
+    """
+    def __init__(self):
+        self.flights = {}
+
+    async def do(self, key, call):
+        """
+        Return the result of awaiting `call()`, and whether it came from a call another coroutine made
+        """
+        flight = self.flights.get(key)
+        if flight is not None:
+            return await asyncio.shield(flight), True
+        flight = self.flights[key] = asyncio.ensure_future(call())
+        try:
+            return await asyncio.shield(flight), False
+        finally:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
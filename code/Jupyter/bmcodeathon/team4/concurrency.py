@@ -0,0 +1,146 @@
+"""
+Sizing concurrency to the rate limit: a planner for runs, and a controller that adapts during them
+"""
+import math
+import time
+
+
+__all__ = (
+    'AUTO_MAX_WORKERS',
+    'ConcurrencyController',
+    'MAX_HEDGE_UIDS',
+    'estimate_calls',
+    'plan_run',
+    'probe_latency',
+)
+
+# the most cases a run with max_workers: auto keeps in flight
+AUTO_MAX_WORKERS = 128
+
+# the most PMIDs a batched hedge search asks for, since esearch returns at most 10,000
+MAX_HEDGE_UIDS = 10000
+
+
+class ConcurrencyController(object):
+    """
+    Sizes the number of units of work in flight to keep the token bucket saturated.
+
+    By Little's law, keeping `rate` calls per second flowing takes `rate * seconds_per_unit / calls_per_unit`
+    units in flight.  The seconds each unit takes are smoothed with weight `smoothing` as units finish, calls
+    per unit are averaged over the run, and `limit` adds `headroom` on top.
+
+    Once the rate limit is reached, the more units are in flight, the longer each waits for tokens, so a
+    unit's seconds count only the share of call time spent in requests, or the limit would keep climbing.
+    """
+    def __init__(self, rate, minimum=1, maximum=AUTO_MAX_WORKERS, headroom=1.25, smoothing=0.2):
+        self.rate = rate
+        self.minimum = minimum
+        self.maximum = maximum
+        self.headroom = headroom
+        self.smoothing = smoothing
+        self.unit_seconds = None
+        self.units = 0
+        self.request_share = 1.0
+        self.call_seconds = (0.0, 0.0)
+        self.limit = self.clip(math.ceil(rate))
+
+    def clip(self, limit):
+        return max(self.minimum, min(self.maximum, limit))
+
+    def observe(self, seconds, total_calls, rate=None, waiting=None, requesting=None):
+        """
+        Update the limit after a unit took `seconds`, when `total_calls` calls have been made so far,
+        having spent `waiting` seconds in all waiting for tokens and `requesting` seconds in requests
+        """
+        if rate is not None:
+            self.rate = rate
+        if waiting is not None and requesting is not None:
+            waited = waiting - self.call_seconds[0]
+            requested = requesting - self.call_seconds[1]
+            # the share since the last unit, or the last share when no calls finished in between
+            if waited + requested > 0:
+                self.request_share = requested / (waited + requested)
+                self.call_seconds = (waiting, requesting)
+        seconds *= self.request_share
+        self.units += 1
+        if self.unit_seconds is None:
+            self.unit_seconds = seconds
+        else:
+            self.unit_seconds += self.smoothing * (seconds - self.unit_seconds)
+        calls_per_unit = max(1.0, total_calls / self.units)
+        self.limit = self.clip(math.ceil(self.headroom * self.rate * self.unit_seconds / calls_per_unit))
+        return self.limit
+
+
+def estimate_calls(num_queries, num_hedges, hedge_batch=0, hedge_index=False, num_results=0, reused_cases=0,
+                   changed_hedges=None):
+    """
+    Return the number of first stage and hedge calls a run makes, without retries.
+
+    With `hedge_batch`, each batch searches the union of its IdLists of up to `num_results` PMIDs in chunks of
+    MAX_HEDGE_UIDS, counted as if the IdLists did not overlap, so the estimate is an upper bound.  A rerun reuses
+    the first stage of `reused_cases` cases and searches only the `changed_hedges` for them, and runs the rest
+    of the cases in full.
+    """
+    def hedge_calls(cases, hedges):
+        if hedge_index or not cases:
+            return 0
+        if not hedge_batch:
+            return cases * hedges
+        queries = math.ceil(cases / 2)
+        chunks = math.ceil(2 * min(queries, hedge_batch) * num_results / MAX_HEDGE_UIDS)
+        return math.ceil(queries / hedge_batch) * max(1, chunks) * hedges
+
+    fresh_cases = 2 * num_queries - reused_cases
+    changed_hedges = num_hedges if changed_hedges is None else changed_hedges
+    return fresh_cases, hedge_calls(fresh_cases, num_hedges) + hedge_calls(reused_cases, changed_hedges)
+
+
+def plan_run(config, num_hedges, latency, num_queries=None, reused_cases=0, changed_hedges=None):
+    """
+    Estimate the calls and wall-clock time of a run of `config`, or a rerun of `reused_cases` cases that
+    searches `changed_hedges`, when each call takes `latency` seconds.
+
+    With blocking calls, each worker has one call in flight, so throughput is the lesser of the rate limit and
+    `workers / latency`.  In async mode, a case's hedge searches are in flight together.
+    """
+    num_queries = config.num_queries if num_queries is None else num_queries
+    first_stage, hedges = estimate_calls(num_queries, num_hedges, config.hedge_batch, bool(config.hedge_index_path),
+                                         config.num_results, reused_cases, changed_hedges)
+    calls = first_stage + hedges
+    units = 2 * num_queries
+    if config.hedge_batch:
+        units = math.ceil(num_queries / config.hedge_batch)
+    calls_per_unit = calls / units if units else 1
+    # calls a unit has in flight at once: one at a time when blocking, or a stage at a time in async mode
+    parallel = max(1.0, calls_per_unit / 2) if config.run_mode == 'async' else 1.0
+    recommended = max(1, math.ceil(1.25 * config.total_rate * latency / parallel))
+    if config.max_workers == 'auto':
+        workers = min(recommended, AUTO_MAX_WORKERS)
+    else:
+        workers = config.max_workers
+    throughput = min(config.total_rate, workers * parallel / latency)
+    return {
+        'queries': num_queries,
+        'first_stage_calls': first_stage,
+        'hedge_calls': hedges,
+        'calls': calls,
+        'latency': latency,
+        'max_workers': workers,
+        'recommended_max_workers': recommended,
+        'calls_per_second': throughput,
+        'bound': 'rate' if throughput >= config.total_rate else 'latency',
+        'seconds': calls / throughput if throughput else float('inf'),
+    }
+
+
+def probe_latency(eutils, num_calls=3):
+    """
+    Return the median seconds taken by `num_calls` small searches
+    """
+    latencies = []
+    for _ in range(num_calls):
+        stime = time.perf_counter()
+        eutils.esearch('pubmed', term='cancer', retmax=20)
+        latencies.append(time.perf_counter() - stime)
+    return sorted(latencies)[len(latencies) // 2]
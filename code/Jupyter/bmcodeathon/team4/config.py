@@ -0,0 +1,170 @@
+"""
+The pipeline's configuration, which loads without pandas or numpy so that quick commands stay quick
+"""
+from typing import Optional, Union
+
+from attrs import define
+from yaml import YAMLError, safe_load
+
+
+__all__ = (
+    'Config',
+)
+
+PREVIEW_PREFIX = 'https://eutilspreview.ncbi.nlm.nih.gov/entrez'
+
+RUN_MODES = ('threads', 'async')
+
+SAMPLERS = ('memory', 'stream')
+
+
+@define
+class Config:
+    api_key: Optional[str]
+    api_keys: Optional[list]
+    email: Optional[str]
+    rate_limit: int
+    num_queries: int
+    num_results: int
+    data_path: str
+    data_sep: str
+    result_path: str
+    hedge_path: str
+    seed: int
+    max_workers: Union[int, str]
+    run_mode: str
+    eutils_prefix: str
+    hedge_index_path: Optional[str]
+    cache_path: Optional[str]
+    cache_ttl: Optional[float]
+    cache_max_bytes: int
+    sampler: str
+    save_xml: bool
+    record_path: Optional[str]
+    fetch_records: bool
+    stats_interval: float
+    metrics_port: Optional[int]
+    hedge_batch: int
+    retry_attempts: int
+    retry_backoff: float
+    retry_deadline: float
+    breaker_threshold: float
+    breaker_cooldown: float
+    sequential_batch: int
+    target_width: float
+    confidence: float
+    min_comparisons: int
+    call_budget: Optional[int]
+
+    @property
+    def random_state(self):
+        # numpy is imported here, so that loading a configuration stays quick
+        from numpy.random import RandomState
+
+        return RandomState(self.seed) if self.seed > 0 else None
+
+    @property
+    def key_rates(self):
+        """
+        The (API key, rate) of each of `api_keys`, or None
+        """
+        if not self.api_keys:
+            return None
+        return [
+            (entry, self.rate_limit) if isinstance(entry, str) else (entry['key'], entry.get('rate', self.rate_limit))
+            for entry in self.api_keys
+        ]
+
+    @property
+    def total_rate(self):
+        """
+        The requests per second of all the keys together
+        """
+        key_rates = self.key_rates
+        return sum(rate for _, rate in key_rates) if key_rates else self.rate_limit
+
+    @staticmethod
+    def get_defaults():
+        return {
+            'num_queries': 1000,
+            'num_results': 200,
+            'seed': 0,                      # or 0 to draw one from the clock for each new experiment
+            'data_path': '/data/pubmed-data.tsv',
+            'data_sep': '\t',
+            'result_path': '/data/team4/results',
+            'hedge_path': '/data/team4/hedges.csv',
+            'api_key': None,
+            'api_keys': None,               # several keys, each a key or {key, rate}, to spread requests over
+            'email': None,
+            'rate_limit': 3,
+            'max_workers': 1,               # or 'auto' to size concurrency to the rate limit as the run goes
+            'run_mode': 'threads',          # or 'async' to run all cases on one event loop
+            'eutils_prefix': PREVIEW_PREFIX,
+            'hedge_index_path': None,       # when set, count hedge matches locally
+            'cache_path': None,             # when set, responses are cached in this SQLite file
+            'cache_ttl': None,              # seconds, or None to keep responses until evicted
+            'cache_max_bytes': 2**30,
+            'sampler': 'memory',            # or 'stream' to sample the query log without loading it
+            'save_xml': False,              # also save each first stage response as XML
+            'record_path': None,            # SQLite file of fetched records, or None for one per experiment
+            'fetch_records': False,         # after a run, fetch the records of its first stage PMIDs
+            'stats_interval': 10,           # seconds between snapshots appended to stats.jsonl
+            'metrics_port': None,           # when set, serve Prometheus metrics on this port
+            'hedge_batch': 0,               # queries whose IdLists share each hedge search, or 0 for one per case
+            'retry_attempts': 5,            # retries of a case with a transient error, or 0 to count it as an error
+            'retry_backoff': 2.0,           # seconds before the first retry, doubling after each
+            'retry_deadline': 600,          # seconds after its first attempt that a case is given up on
+            'breaker_threshold': 0.5,       # pause dispatch when this fraction of recent cases failed transiently
+            'breaker_cooldown': 30,         # seconds to pause dispatch for
+            'sequential_batch': 0,          # run the sample this many queries at a time, stopping once converged
+            'target_width': 0.5,            # stop once every hedge's interval of the mean differential is narrower
+            'confidence': 0.95,             # confidence level of those intervals
+            'min_comparisons': 30,          # queries a hedge must be compared on before its interval counts
+            'call_budget': None,            # stop before a round would take the run past this many calls
+        }
+
+    @classmethod
+    def load(cls, path=None):
+        cls_kwargs = cls.get_defaults()
+        expected_keys = set(cls_kwargs.keys())
+        if path is not None:
+            with open(str(path)) as f:
+                try:
+                    overrides = safe_load(f)
+                except YAMLError as e:
+                    raise ValueError(f'{path}: {e}')
+            # an empty file changes nothing
+            overrides = {} if overrides is None else overrides
+            if not isinstance(overrides, dict):
+                raise ValueError(f'{path}: settings should be a mapping of names to values')
+            if any(key not in expected_keys for key in overrides.keys()):
+                raise ValueError(f'{path}: invalid setting encountered')
+            cls_kwargs.update(overrides)
+        if cls_kwargs['run_mode'] not in RUN_MODES:
+            raise ValueError(f'{path}: run_mode should be one of {", ".join(RUN_MODES)}')
+        if cls_kwargs['sampler'] not in SAMPLERS:
+            raise ValueError(f'{path}: sampler should be one of {", ".join(SAMPLERS)}')
+        max_workers = cls_kwargs['max_workers']
+        if max_workers != 'auto' and not (isinstance(max_workers, int) and max_workers > 0):
+            raise ValueError(f'{path}: max_workers should be a positive number or auto')
+        api_keys = cls_kwargs['api_keys']
+        if api_keys is not None:
+            if not isinstance(api_keys, list) or not api_keys:
+                raise ValueError(f'{path}: api_keys should be a list of keys')
+            for entry in api_keys:
+                if isinstance(entry, dict):
+                    rate = entry.get('rate', cls_kwargs['rate_limit'])
+                    if not isinstance(entry.get('key'), str) or set(entry) - {'key', 'rate'} or \
+                            not (isinstance(rate, (int, float)) and rate > 0):
+                        raise ValueError(f'{path}: each of api_keys should be a key, or a key and a positive rate')
+                elif not isinstance(entry, str):
+                    raise ValueError(f'{path}: each of api_keys should be a key, or a key and a positive rate')
+        if cls_kwargs['hedge_batch'] < 0:
+            raise ValueError(f'{path}: hedge_batch should not be negative')
+        if cls_kwargs['sequential_batch'] < 0:
+            raise ValueError(f'{path}: sequential_batch should not be negative')
+        if not 0 < cls_kwargs['confidence'] < 1:
+            raise ValueError(f'{path}: confidence should be between 0 and 1')
+        if cls_kwargs['target_width'] <= 0:
+            raise ValueError(f'{path}: target_width should be positive')
+        return cls(**cls_kwargs)
@@ -1,11 +1,22 @@
+from requests import Response
 from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
 from urllib.parse import quote
 from types import MethodType
+import html
 import re
+import time
 from collections import OrderedDict
+from typing import Optional
+from attrs import define
 from lxml import etree
 from io import BytesIO
+import numpy as np
 
+from .cache import cacheable
+from .coalesce import SingleFlight, normalize_term
+from .keypool import KeyPool
+from .metrics import Metrics
 from .tokenbucket import RateLimitedSession
 
 
@@ -15,63 +26,271 @@ EUTILS_PREFIX = 'https://eutils.ncbi.nlm.nih.gov/entrez'
 # Base URL for eutils
 EUTILS_URL = '{}/eutils/{}'
 
+# Headers for parameters sent in the body of a POST
+FORM_HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+
+# the elements of an esearch response that the pipeline reads; the first Count is the search's own,
+# and later ones are in the TranslationStack
+COUNT_PATTERN = re.compile(rb'<Count>(\d+)</Count>')
+ID_PATTERN = re.compile(rb'<Id>(\d+)</Id>')
+ERROR_PATTERN = re.compile(rb'<ERROR>(.*?)</ERROR>', re.DOTALL)
+WEBENV_PATTERN = re.compile(rb'<WebEnv>([^<]*)</WebEnv>')
+QUERY_KEY_PATTERN = re.compile(rb'<QueryKey>(\d+)</QueryKey>')
+
+
+@define
+class SearchResult:
+    """
+    The parts of an esearch response the pipeline uses, with the IdList as a uint32 array
+    """
+    count: int
+    ids: np.ndarray
+    errors: list
+    webenv: Optional[str]
+    query_key: Optional[str]
+    content: Optional[bytes] = None
+
+
+def first_text(pattern, content):
+    match = pattern.search(content)
+    return html.unescape(match.group(1).decode('utf-8')) if match else None
+
+
+def parse_search_result(content, keep_content=False):
+    """
+    Read an esearch XML response into a SearchResult with a few scans of the bytes, rather than building a tree.
+
+    The response is a flat eSearchResult, so only the IdList needs delimiting; `content` is kept only if asked.
+    """
+    if b'<eSearchResult' not in content:
+        raise ValueError(f'not an esearch result: {content[:60]!r}')
+    count = COUNT_PATTERN.search(content)
+    start = content.find(b'<IdList>')
+    if start >= 0:
+        ids = np.array(ID_PATTERN.findall(content, start, content.find(b'</IdList>', start)), dtype=np.uint32)
+    else:
+        ids = np.empty(0, dtype=np.uint32)
+    return SearchResult(
+        count=int(count.group(1)) if count else 0,
+        ids=ids,
+        errors=[html.unescape(error.decode('utf-8')) for error in ERROR_PATTERN.findall(content)],
+        webenv=first_text(WEBENV_PATTERN, content),
+        query_key=first_text(QUERY_KEY_PATTERN, content),
+        content=content if keep_content else None,
+    )
+
+
+def parse_search(r):
+    """
+    Decorate an esearch response with the history server's WebEnv and QueryKey
+    """
+    webenv = r.xml.xpath('/eSearchResult/WebEnv')
+    r.webenv = webenv[0].text if webenv else None
+    query_key = r.xml.xpath('/eSearchResult/QueryKey')
+    r.query_key = query_key[0].text if query_key else None
+
+
+def parse_post(r):
+    """
+    Decorate an epost response with the history server's WebEnv and QueryKey
+    """
+    webenv = r.xml.xpath('/ePostResult/WebEnv')
+    r.webenv = webenv[0].text if webenv else None
+    query_key = r.xml.xpath('/ePostResult/QueryKey')
+    r.query_key = query_key[0].text if query_key else None
+
 
 class EUtils(object):
     """
     An abstraction that wraps the NCBI E-Utilities
+
+    Calls, bytes, latency, and parse time are recorded in `metrics` by endpoint.  Search terms are
+    normalized, and identical requests made while one is in flight share its response.
+
+    With `keys`, a list of (API key, rate) pairs, requests are spread over the keys by a KeyPool
+    instead of all carrying `apikey`, and `rate` is the sum of the keys' rates.
     """
-    def __init__(self, apikey=None, email=None, rate=3, prefix=None, session=None):
-        self.apikey = apikey
+    def __init__(self, apikey=None, email=None, rate=3, prefix=None, session=None, cache=None, metrics=None,
+                 keys=None):
+        self.keypool = KeyPool(keys) if keys else None
+        # with a key pool, the session adds each request's key
+        self.apikey = apikey if self.keypool is None else None
         self.email = email
-        self.rate = rate
+        self.rate = rate if self.keypool is None else self.keypool.max_rate
         self.prefix = prefix if prefix else EUTILS_PREFIX
-        self.call_count = 0
+        self.cache = cache
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.flights = SingleFlight()
         if not session:
-            session = RateLimitedSession(rate=rate, tokens=rate, capacity=rate)
+            session = RateLimitedSession(rate=rate, tokens=rate, capacity=rate, metrics=self.metrics,
+                                         keypool=self.keypool)
             session.mount('https://', HTTPAdapter(max_retries=3, pool_maxsize=10))
         self.session = session
 
+    @property
+    def call_count(self):
+        return self.metrics.total('eutils_calls_total')
+
+    @property
+    def coalesced_count(self):
+        return self.metrics.total('coalesced_calls_total')
+
+    @property
+    def cache_hits(self):
+        return self.metrics.counter('cache_hits_total')
+
+    @property
+    def cache_misses(self):
+        return self.metrics.counter('cache_misses_total')
+
     def params(self, db=None, **kwargs):
         params = dict((k,v) for k,v in kwargs.items())
+        if 'term' in params:
+            params['term'] = normalize_term(params['term'])
         if db:
             params['db'] = db
         if self.apikey:
             params['api_key'] = self.apikey
         return '&'.join('{}={}'.format(key, quote(value)) for key, value in params.items())
 
-    def einfo(self, db=None, **kwargs):
-        params = self.params(db, retmode='xml', **kwargs)
-        url = EUTILS_URL.format(self.prefix, 'einfo.fcgi') + '?' + params
-        r = self.session.get(url)
-        self.call_count += 1
-        r.raise_for_status()
+    def url(self, endpoint, params):
+        return EUTILS_URL.format(self.prefix, endpoint) + '?' + params
+
+    def cached(self, url):
+        """
+        Return the content type and body cached for `url`, or None
+        """
+        if self.cache is None or not cacheable(url):
+            return None
+        cached = self.cache.get(url)
+        if cached is None:
+            self.metrics.inc('cache_misses_total')
+        else:
+            self.metrics.inc('cache_hits_total')
+        return cached
+
+    def store(self, url, content_type, content):
+        # responses carrying an ERROR are usually transient backend failures
+        if self.cache is not None and cacheable(url) and b'<ERROR>' not in content:
+            self.cache.put(url, content_type, content)
+
+    def count_call(self, endpoint, r, elapsed):
+        endpoint = endpoint.split('.')[0]
+        self.metrics.inc('eutils_calls_total', endpoint=endpoint)
+        self.metrics.inc('eutils_bytes_total', len(r.content), endpoint=endpoint)
+        self.metrics.observe('eutils_call_seconds', elapsed, endpoint=endpoint)
+
+    def decorate(self, endpoint, r, parse=None):
+        """
+        When the response is XML, parse it into `r.xml` and then pass it to `parse`, if given.
+        """
         content_type = r.headers['Content-Type']
         if content_type.startswith('text/xml'):
-            r.xml = etree.parse(BytesIO(r.content))
+            with self.metrics.timer('xml_parse_seconds', endpoint=endpoint.split('.')[0]):
+                r.xml = etree.parse(BytesIO(r.content))
+                if parse:
+                    parse(r)
         return r
 
-    def esearch(self, db, history=False, webenv=None, query_key=None, retmax=20, **kwargs):
+    def count_shared(self, endpoint):
+        self.metrics.inc('coalesced_calls_total', endpoint=endpoint.split('.')[0])
+
+    def search_result(self, r, keep_content=False):
+        with self.metrics.timer('xml_parse_seconds', endpoint='esearch'):
+            return parse_search_result(r.content, keep_content)
+
+    def call(self, endpoint, params, parse=None, post=False):
+        """
+        Issue one request against `endpoint` and decorate the response.
+
+        With `post`, the parameters are sent as a form body, so that long ID lists fit.
+        """
+        r, shared = self.flights.do(
+            (endpoint, params, post, parse),
+            lambda: self.decorate(endpoint, self.fetch(endpoint, params, post), parse),
+        )
+        if shared:
+            self.count_shared(endpoint)
+        return r
+
+    def fetch(self, endpoint, params, post=False):
+        """
+        Issue one request against `endpoint`, or answer it from the cache, and return the response as is
+        """
+        url = self.url(endpoint, params)
+        cached = self.cached(url)
+        if cached is not None:
+            r = Response()
+            r.url = url
+            r.status_code = 200
+            r.headers = CaseInsensitiveDict({'Content-Type': cached[0]})
+            r._content = cached[1]
+        else:
+            stime = time.perf_counter()
+            if post:
+                r = self.session.post(EUTILS_URL.format(self.prefix, endpoint), data=params, headers=FORM_HEADERS)
+            else:
+                r = self.session.get(url)
+            self.count_call(endpoint, r, time.perf_counter() - stime)
+            r.raise_for_status()
+            self.store(url, r.headers['Content-Type'], r.content)
+        return r
+
+    def stream(self, endpoint, params, post=False):
+        """
+        Issue one request against `endpoint`, and return the response before its body is read,
+        so that it can be parsed as it arrives, e.g. with `etree.iterparse(r.raw)`.
+
+        Streamed responses are not cached.
+        """
+        stime = time.perf_counter()
+        if post:
+            r = self.session.post(EUTILS_URL.format(self.prefix, endpoint), data=params, headers=FORM_HEADERS,
+                                  stream=True)
+        else:
+            r = self.session.get(self.url(endpoint, params), stream=True)
+        endpoint = endpoint.split('.')[0]
+        self.metrics.inc('eutils_calls_total', endpoint=endpoint)
+        self.metrics.observe('eutils_call_seconds', time.perf_counter() - stime, endpoint=endpoint)
+        r.raise_for_status()
+        r.raw.decode_content = True
+        return r
+
+    def einfo(self, db=None, **kwargs):
+        params = self.params(db, retmode='xml', **kwargs)
+        return self.call('einfo.fcgi', params)
+
+    def search_params(self, db, history=False, webenv=None, query_key=None, retmax=20, **kwargs):
         if history or webenv:
             kwargs['usehistory'] = 'y'
             if webenv:
                 kwargs['WebEnv'] = webenv
             if query_key:
                 kwargs['query_key'] = query_key
-        params = self.params(db, retmode='xml', retmax=str(retmax), **kwargs)
-        url = EUTILS_URL.format(self.prefix, 'esearch.fcgi') + '?' + params
-        r = self.session.get(url)
-        self.call_count += 1
-        r.raise_for_status()
-        content_type = r.headers['Content-Type']
-        if content_type.startswith('text/xml'):
-            r.xml = etree.parse(BytesIO(r.content))
-            webenv = r.xml.xpath('/eSearchResult/WebEnv')
-            r.webenv = webenv[0].text if webenv else None
-            query_key = r.xml.xpath('/eSearchResult/QueryKey')
-            r.query_key = query_key[0].text if query_key else None
-        return r
+        return self.params(db, retmode='xml', retmax=str(retmax), **kwargs)
+
+    def esearch(self, db, history=False, webenv=None, query_key=None, retmax=20, post=False, **kwargs):
+        params = self.search_params(db, history, webenv, query_key, retmax, **kwargs)
+        return self.call('esearch.fcgi', params, parse_search, post)
+
+    def search(self, db, history=False, webenv=None, query_key=None, retmax=20, post=False, keep_content=False,
+               **kwargs):
+        """
+        Search as `esearch` does, but return a SearchResult, which is quicker to read than the parsed tree.
+
+        With `keep_content`, the SearchResult keeps the response body, e.g. to save it.
+        """
+        params = self.search_params(db, history, webenv, query_key, retmax, **kwargs)
+        result, shared = self.flights.do(
+            ('esearch.fcgi', params, post, keep_content),
+            lambda: self.search_result(self.fetch('esearch.fcgi', params, post), keep_content),
+        )
+        if shared:
+            self.count_shared('esearch.fcgi')
+        return result
 
-    def efetch(self, db, *args, webenv=None, query_key=None, retmax=20, **kwargs):
+    def efetch(self, db, *args, webenv=None, query_key=None, retmax=20, stream=False, **kwargs):
         if webenv:
             kwargs['usehistory'] = 'y'
             kwargs['WebEnv'] = webenv
@@ -82,29 +301,14 @@ class EUtils(object):
             params = self.params(db, retmode='xml', retmax=str(retmax), id=idlist, **kwargs)
         else:
             params = self.params(db, retmode='xml', retmax=str(retmax), **kwargs)
-        url = EUTILS_URL.format(self.prefix, 'efetch.fcgi') + '?' + params
-        r = self.session.get(url)
-        self.call_count += 1
-        r.raise_for_status()
-        content_type = r.headers['Content-Type']
-        if content_type.startswith('text/xml'):
-            setattr(r, 'xml', etree.parse(BytesIO(r.content)))
-        return r
+        if stream:
+            return self.stream('efetch.fcgi', params, post=len(args) > 0)
+        return self.call('efetch.fcgi', params)
 
     def epost(self, db, *args, webenv=None, **kwargs):
         idlist = ','.join(str(arg) for arg in args)
         if webenv:
             kwargs['WebEnv'] = webenv
         params = self.params(db, id=idlist, retmode='xml', **kwargs)
-        url = EUTILS_URL.format(self.prefix, 'epost.fcgi') + '?' + params
-        r = self.session.get(url)
-        self.call_count += 1
-        r.raise_for_status()
-        content_type = r.headers['Content-Type']
-        if content_type.startswith('text/xml'):
-            setattr(r, 'xml', etree.parse(BytesIO(r.content)))
-            webenv = r.xml.xpath('/ePostResult/WebEnv')
-            r.webenv = webenv[0].text if webenv else None
-            query_key = r.xml.xpath('/ePostResult/QueryKey')
-            r.query_key = query_key[0].text if query_key else None
-        return r
+        # the ID list is sent as a form body, since it is usually too long for a URL
+        return self.call('epost.fcgi', params, parse_post, post=True)
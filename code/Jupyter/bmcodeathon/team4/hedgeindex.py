@@ -0,0 +1,147 @@
+"""
+A local index of the full PMID set matched by each hedge
+"""
+import hashlib
+from datetime import date, timedelta
+from pathlib import Path
+
+import numpy as np
+
+
+__all__ = (
+    'HedgeIndex',
+    'fetch_pmids',
+)
+
+# efetch returns at most this many UIDs per request
+PAGE_SIZE = 10000
+
+# esearch and efetch page through only the first 10,000 records of a result set
+MAX_RETRIEVABLE = 10000
+
+# the earliest publication date a search over the cap is split from
+FIRST_DATE = date(1700, 1, 1)
+
+
+def date_term(term, first, last):
+    return f'({term}) AND ("{first:%Y/%m/%d}"[PDAT] : "{last:%Y/%m/%d}"[PDAT])'
+
+
+def fetch_search(eutils, term, page_size=PAGE_SIZE):
+    """
+    Save the search for `term` on the history server, and page through its PMIDs.  Return its count, and
+    the PMIDs, unsorted, or None if it matches more than MAX_RETRIEVABLE
+    """
+    search = eutils.search('pubmed', history=True, retmax=0, term=term)
+    if search.errors:
+        raise ValueError(f'{term}: {"; ".join(search.errors)}')
+    count = search.count
+    if count > MAX_RETRIEVABLE:
+        return count, None
+    pmids = np.empty(count, dtype=np.uint32)
+    size = 0
+    for retstart in range(0, count, page_size):
+        r = eutils.efetch('pubmed', webenv=search.webenv, query_key=search.query_key, rettype='uilist',
+                          retstart=str(retstart), retmax=page_size)
+        errors = r.xml.xpath('//ERROR')
+        if errors:
+            raise ValueError(f'{term}: page at {retstart}: {errors[0].text}')
+        page = np.array([element.text for element in r.xml.xpath('//Id')], dtype=np.uint32)
+        # the result set may have grown since the search
+        if size + len(page) > len(pmids):
+            pmids.resize(size + len(page), refcheck=False)
+        pmids[size:size+len(page)] = page
+        size += len(page)
+    # a short page would otherwise leave a partial set in the index, and every run using it would undercount
+    if size < count:
+        raise ValueError(f'{term}: fetched {size} of its {count} PMIDs')
+    return count, pmids[:size]
+
+
+def fetch_date_range(eutils, term, first, last, page_size=PAGE_SIZE):
+    """
+    Fetch the PMIDs matching `term` published from `first` to `last`, halving the range until each part
+    is within MAX_RETRIEVABLE
+    """
+    _, pmids = fetch_search(eutils, date_term(term, first, last), page_size)
+    if pmids is not None:
+        return [pmids]
+    if first == last:
+        raise ValueError(f'{term}: more than {MAX_RETRIEVABLE} PMIDs published on {first}, too many to fetch')
+    middle = first + (last - first) // 2
+    return (fetch_date_range(eutils, term, first, middle, page_size) +
+            fetch_date_range(eutils, term, middle + timedelta(days=1), last, page_size))
+
+
+def fetch_pmids(eutils, term, page_size=PAGE_SIZE):
+    """
+    Return every PMID matching `term` as a sorted uint32 array.
+
+    The search is saved on the history server once and then paged through with efetch,
+    so the number of calls is 1 + count / page_size.  Since only the first MAX_RETRIEVABLE
+    records of a search can be fetched, a larger one is split into ranges of publication dates.
+    Rather than return a partial set, this raises ValueError.
+    """
+    count, pmids = fetch_search(eutils, term, page_size)
+    if pmids is not None:
+        return np.unique(pmids)
+    parts = fetch_date_range(eutils, term, FIRST_DATE, date(date.today().year + 1, 12, 31), page_size)
+    pmids = np.unique(np.concatenate(parts))
+    if len(pmids) < count:
+        raise ValueError(f'{term}: publication date ranges found {len(pmids)} of its {count} PMIDs')
+    return pmids
+
+
+class HedgeIndex(object):
+    """
+    A directory of `.npy` files, one per hedge, each holding a sorted uint32 array of the PMIDs it matches.
+
+    Files are named by the hedge's shortcode and a hash of its text, so editing a hedge
+    makes it build anew rather than reusing a stale set.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.sets = {}
+
+    @staticmethod
+    def digest(hedge_text):
+        return hashlib.sha1(hedge_text.encode('utf-8')).hexdigest()[:12]
+
+    def set_path(self, shortcode, hedge_text):
+        return self.path / f'{shortcode}-{self.digest(hedge_text)}.npy'
+
+    def build(self, eutils, hedges, progress=None):
+        """
+        Fetch and save the PMID set of each hedge that is not already in the index, and load them all.
+
+        `hedges` is the data frame returned by `Pipeline.load_hedges`.
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        for shortcode, hedge_row in hedges.iterrows():
+            hedge_text = hedge_row['Hedge_text']
+            set_path = self.set_path(shortcode, hedge_text)
+            if not set_path.exists():
+                pmids = fetch_pmids(eutils, hedge_text)
+                # write then rename so that an interrupted build leaves no partial set behind
+                partial_path = set_path.with_suffix('.partial.npy')
+                np.save(partial_path, pmids)
+                partial_path.replace(set_path)
+            self.sets[shortcode] = np.load(set_path, mmap_mode='r')
+            if progress:
+                progress.next()
+        return self
+
+    def matches(self, shortcode, pmids):
+        """
+        Return the PMIDs in `pmids` that are in the set for `shortcode`, in their original order
+        """
+        hedge_set = self.sets[shortcode]
+        pmids = np.asarray(pmids, dtype=np.uint32)
+        if len(hedge_set) == 0 or len(pmids) == 0:
+            return pmids[:0]
+        positions = np.searchsorted(hedge_set, pmids)
+        positions[positions == len(hedge_set)] = 0
+        return pmids[hedge_set[positions] == pmids]
+
+    def bias_counts(self, pmids):
+        return [(shortcode, len(self.matches(shortcode, pmids))) for shortcode in self.sets]
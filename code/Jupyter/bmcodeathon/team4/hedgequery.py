@@ -0,0 +1,300 @@
+"""
+Compiling hedges, which are PubMed boolean queries, and evaluating them against local records
+"""
+import re
+from bisect import bisect_left
+from functools import reduce
+
+from attrs import define
+
+
+__all__ = (
+    'And',
+    'HedgeSyntaxError',
+    'Not',
+    'Or',
+    'RecordIndex',
+    'Term',
+    'parse_hedge',
+)
+
+# [field] tags, normalized to lower case, and the field each one searches
+FIELDS = {
+    'mesh': 'mesh',
+    'mh': 'mesh',
+    'mesh:noexp': 'mesh',
+    'mh:noexp': 'mesh',
+    'majr': 'mesh',
+    'tiab': 'tiab',
+    'ti': 'title',
+    'ab': 'abstract',
+    'tw': 'all',
+    'all': 'all',
+    'all fields': 'all',
+}
+
+# the text fields of a record each field searches
+TEXT_FIELDS = {
+    'tiab': ('title', 'abstract'),
+    'title': ('title',),
+    'abstract': ('abstract',),
+    'all': ('title', 'abstract', 'mesh'),
+}
+
+OPERATORS = ('AND', 'OR', 'NOT')
+
+TOKEN_PATTERN = re.compile(r'\s*(?:(?P<paren>[()])|"(?P<quoted>[^"]*)"|\[(?P<tag>[^\]]*)\]|(?P<word>[^\s()"\[\]]+))')
+
+WORD_PATTERN = re.compile(r'[a-z0-9]+\*?')
+
+
+class HedgeSyntaxError(ValueError):
+    pass
+
+
+@define
+class Term:
+    text: str
+    field: str
+
+    @property
+    def prefix(self):
+        return self.text.endswith('*')
+
+
+@define
+class And:
+    children: list
+
+
+@define
+class Or:
+    children: list
+
+
+@define
+class Not:
+    left: object
+    right: object
+
+
+def tokenize(text):
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = TOKEN_PATTERN.match(text, position)
+        if match is None:
+            raise HedgeSyntaxError(f'unexpected {text[position:position + 20]!r}')
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'word' and value in OPERATORS:
+            kind = 'operator'
+        yield kind, value
+
+
+def words(text):
+    """
+    Split text into lower case words, as PubMed does, keeping a trailing * for truncation
+    """
+    return WORD_PATTERN.findall(text.lower())
+
+
+class Parser(object):
+    """
+    PubMed evaluates Boolean operators from left to right, without precedence, and adjacent terms are ANDed
+    """
+    def __init__(self, text):
+        self.text = text
+        self.tokens = list(tokenize(text))
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def parse(self):
+        node = self.expression()
+        if self.position < len(self.tokens):
+            raise HedgeSyntaxError(f'unexpected {self.peek()[1]!r} in {self.text[:40]!r}')
+        return node
+
+    def expression(self):
+        node = self.primary()
+        while True:
+            kind, value = self.peek()
+            if kind is None or kind == 'paren' and value == ')':
+                return node
+            operator = 'AND'
+            if kind == 'operator':
+                operator = self.take()[1]
+            right = self.primary()
+            if operator == 'NOT':
+                node = Not(node, right)
+            elif operator == 'AND':
+                node = And(node.children + [right] if isinstance(node, And) else [node, right])
+            else:
+                node = Or(node.children + [right] if isinstance(node, Or) else [node, right])
+
+    def primary(self):
+        kind, value = self.take()
+        if kind == 'paren' and value == '(':
+            node = self.expression()
+            if self.take() != ('paren', ')'):
+                raise HedgeSyntaxError(f'unbalanced parentheses in {self.text[:40]!r}')
+            return node
+        if kind == 'quoted':
+            text = value
+        elif kind == 'word':
+            # unquoted words up to an operator, parenthesis, or tag make one term, e.g. Racial Groups[MeSH]
+            parts = [value]
+            while self.peek()[0] == 'word':
+                parts.append(self.take()[1])
+            text = ' '.join(parts)
+        elif kind == 'tag':
+            # a tag without a term, e.g. OR [tiab] OR, matches nothing
+            self.position -= 1
+            text = ''
+        else:
+            raise HedgeSyntaxError(f'expected a term, not {value!r}, in {self.text[:40]!r}')
+        field = 'all'
+        if self.peek()[0] == 'tag':
+            tag = self.take()[1].strip().lower()
+            if tag not in FIELDS:
+                raise HedgeSyntaxError(f'unknown field [{tag}] in {self.text[:40]!r}')
+            field = FIELDS[tag]
+        return Term(text.strip(), field)
+
+
+def parse_hedge(text):
+    """
+    Parse a hedge into a tree of Term, And, Or, and Not nodes
+    """
+    return Parser(text).parse()
+
+
+class FieldIndex(object):
+    """
+    An inverted index of one text field: each word's documents, and each document's segments of words
+    """
+    def __init__(self):
+        self.postings = {}
+        self.segments = []
+        self.vocabulary = None
+
+    def add(self, doc, segments):
+        self.segments.append(segments)
+        for segment in segments:
+            for word in segment:
+                self.postings.setdefault(word, set()).add(doc)
+
+    def finish(self):
+        self.vocabulary = sorted(self.postings)
+
+    def prefixed(self, prefix):
+        """
+        Return the documents with any word starting with `prefix`
+        """
+        start = bisect_left(self.vocabulary, prefix)
+        docs = set()
+        for word in self.vocabulary[start:]:
+            if not word.startswith(prefix):
+                break
+            docs |= self.postings[word]
+        return docs
+
+    def word_docs(self, word):
+        if word.endswith('*'):
+            return self.prefixed(word[:-1])
+        return self.postings.get(word, set())
+
+    def search(self, phrase):
+        """
+        Return the documents where the words of `phrase` appear together, in order, in one segment
+        """
+        if not phrase:
+            return set()
+        docs = reduce(set.intersection, (self.word_docs(word) for word in phrase))
+        if len(phrase) == 1:
+            return set(docs)
+        return set(doc for doc in docs if any(self.contains(segment, phrase) for segment in self.segments[doc]))
+
+    @staticmethod
+    def contains(segment, phrase):
+        last = len(segment) - len(phrase)
+        for start in range(last + 1):
+            if all(
+                segment[start + i].startswith(word[:-1]) if word.endswith('*') else segment[start + i] == word
+                for i, word in enumerate(phrase)
+            ):
+                return True
+        return False
+
+
+class RecordIndex(object):
+    """
+    Term and prefix indexes over the title, abstract, and MeSH headings of a set of records,
+    against which hedges are evaluated locally.
+
+    The MeSH tree is not available locally, so [Mesh] matches a heading only as [Mesh:noexp] would,
+    and untagged terms are searched in all three fields rather than mapped to MeSH as PubMed does.
+    Compare with the server, as `team4 evaluate` does, before relying on a hedge's local counts.
+    """
+    def __init__(self, records):
+        self.pmids = []
+        self.fields = dict((name, FieldIndex()) for name in ('title', 'abstract', 'mesh'))
+        self.headings = {}
+        for doc, record in enumerate(records):
+            self.pmids.append(record.pmid)
+            self.fields['title'].add(doc, [words(record.title)])
+            self.fields['abstract'].add(doc, [words(record.abstract)])
+            self.fields['mesh'].add(doc, [words(heading) for heading in record.mesh])
+            for heading in record.mesh:
+                self.headings.setdefault(' '.join(words(heading)), set()).add(doc)
+        for index in self.fields.values():
+            index.finish()
+        self.heading_names = sorted(self.headings)
+
+    def __len__(self):
+        return len(self.pmids)
+
+    def mesh(self, text):
+        name = ' '.join(words(text))
+        if not name.endswith('*'):
+            return set(self.headings.get(name, ()))
+        prefix = name[:-1]
+        docs = set()
+        for heading in self.heading_names[bisect_left(self.heading_names, prefix):]:
+            if not heading.startswith(prefix):
+                break
+            docs |= self.headings[heading]
+        return docs
+
+    def docs(self, node):
+        """
+        Return the documents matching a parsed hedge
+        """
+        if isinstance(node, Term):
+            if node.field == 'mesh':
+                return self.mesh(node.text)
+            phrase = words(node.text)
+            return set().union(*(self.fields[name].search(phrase) for name in TEXT_FIELDS[node.field]))
+        if isinstance(node, And):
+            return reduce(set.intersection, (self.docs(child) for child in node.children))
+        if isinstance(node, Or):
+            return set().union(*(self.docs(child) for child in node.children))
+        if isinstance(node, Not):
+            return self.docs(node.left) - self.docs(node.right)
+        raise TypeError(f'not a hedge node: {node!r}')
+
+    def evaluate(self, hedge):
+        """
+        Return the set of PMIDs matching a hedge, given as text or parsed
+        """
+        if isinstance(hedge, str):
+            hedge = parse_hedge(hedge)
+        return set(self.pmids[doc] for doc in self.docs(hedge))
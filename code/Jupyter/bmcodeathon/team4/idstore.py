@@ -0,0 +1,115 @@
+"""
+A packed, memory-mappable store of the IdLists returned by an experiment
+"""
+import csv
+import os
+from pathlib import Path
+from threading import Lock
+
+import numpy as np
+
+
+__all__ = (
+    'IdListStore',
+)
+
+DATA_NAME = 'idlists.bin'
+INDEX_NAME = 'idlists.idx'
+INDEX_COLUMNS = ['search_index', 'sort', 'hedge', 'offset', 'length']
+
+
+class IdListStore(object):
+    """
+    IdLists appended as uint32 arrays to one file, with an index of where each one starts.
+
+    Each IdList is keyed by (search_index, sort, hedge), where hedge is empty for the first
+    stage search.  Appending is thread-safe, and when a key is appended more than once, as
+    when a run is resumed, the last one wins.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.data_path = self.path / DATA_NAME
+        self.index_path = self.path / INDEX_NAME
+        self.lock = Lock()
+        self.data_file = None
+        self.index_file = None
+        self.index = None
+        self.data = None
+
+    def open_for_append(self):
+        if self.index_path.exists():
+            self.truncate()
+        new_index = not self.index_path.exists() or self.index_path.stat().st_size == 0
+        self.data_file = open(self.data_path, 'ab')
+        self.index_file = open(self.index_path, 'a', newline='')
+        self.index_writer = csv.writer(self.index_file, dialect='unix')
+        if new_index:
+            self.index_writer.writerow(INDEX_COLUMNS)
+        return self
+
+    def truncate(self):
+        """
+        Cut off what a run that crashed mid-append left behind: a partial last index row, and data
+        past the end of the last indexed IdList, so that appended offsets stay aligned
+        """
+        with open(self.index_path, 'rb+') as f:
+            content = f.read()
+            content = content[:content.rfind(b'\n') + 1]
+            f.truncate(len(content))
+        rows = csv.DictReader(content.decode('utf-8').splitlines(), dialect='unix')
+        end = max((int(row['offset']) + int(row['length']) for row in rows), default=0)
+        end *= np.dtype(np.uint32).itemsize
+        if self.data_path.exists() and self.data_path.stat().st_size > end:
+            os.truncate(self.data_path, end)
+
+    def append(self, search_index, sort_order, hedge, pmids):
+        pmids = np.asarray(pmids, dtype=np.uint32)
+        with self.lock:
+            offset = self.data_file.tell() // pmids.itemsize
+            self.data_file.write(pmids.tobytes())
+            # the data is flushed before its index row, so the index never points past the data
+            self.data_file.flush()
+            self.index_writer.writerow([search_index, sort_order, hedge or '', offset, len(pmids)])
+            self.index_file.flush()
+
+    def close(self):
+        for f in (self.data_file, self.index_file):
+            if f is not None:
+                os.fsync(f.fileno())
+                f.close()
+        self.data_file = self.index_file = None
+
+    def load(self):
+        """
+        Memory-map the data and read the index, so that `get` can be used
+        """
+        size = self.data_path.stat().st_size if self.data_path.exists() else 0
+        if size:
+            self.data = np.memmap(self.data_path, dtype=np.uint32, mode='r')
+        else:
+            self.data = np.empty(0, dtype=np.uint32)
+        self.index = {}
+        if self.index_path.exists():
+            with open(self.index_path, newline='') as f:
+                for row in csv.DictReader(f, dialect='unix'):
+                    key = (row['search_index'], row['sort'], row['hedge'])
+                    self.index[key] = (int(row['offset']), int(row['length']))
+        return self
+
+    def keys(self):
+        return self.index.keys()
+
+    def pmids(self, hedge=None):
+        """
+        Yield the PMIDs of each IdList of `hedge`, or of the first stage, one IdList at a time
+        """
+        for key in self.index:
+            if key[2] == (hedge or ''):
+                yield from self.get(*key).tolist()
+
+    def get(self, search_index, sort_order, hedge=None):
+        """
+        Return an IdList as a uint32 array, which is a view of the memory-mapped file
+        """
+        offset, length = self.index[(str(search_index), sort_order, hedge or '')]
+        return self.data[offset:offset+length]
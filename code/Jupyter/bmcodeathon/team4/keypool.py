@@ -0,0 +1,119 @@
+"""
+Several API keys in one client, each with its own rate limit
+"""
+import time
+from threading import Lock
+from urllib.parse import quote
+
+from .tokenbucket import TokenBucket
+
+
+__all__ = (
+    'KeyPool',
+    'with_api_key',
+)
+
+
+def with_api_key(url, key):
+    """
+    Add `key` to the query string of `url`
+    """
+    return url + ('&' if '?' in url else '?') + 'api_key=' + quote(key)
+
+
+class KeyPool(object):
+    """
+    A token bucket per API key.  Each request takes a token from whichever key's next token comes
+    soonest, so a pool of keys serves the sum of their rates.
+
+    Every key's pushback is tracked apart, and a key that is pushed back `max_failures` times in
+    a row, or whose key the server rejects, is taken out of the pool, unless it is the last one.
+    `rate` is the sum of the keys' current rates, so the pool can stand in for a TokenBucket
+    where only the rate is read.
+    """
+    def __init__(self, keys, max_failures=5):
+        self.lock = Lock()
+        self.max_failures = max_failures
+        self.buckets = dict((key, TokenBucket(rate=rate, tokens=rate, capacity=rate)) for key, rate in keys)
+        if not self.buckets:
+            raise ValueError('a key pool needs at least one API key')
+        # keys are labelled by their position in the configuration, so that metrics do not show them
+        self.labels = dict((key, str(index)) for index, key in enumerate(self.buckets))
+        self.failures = dict.fromkeys(self.buckets, 0)
+        self.throttled = dict.fromkeys(self.buckets, 0)
+        self.removed = []
+
+    @property
+    def keys(self):
+        with self.lock:
+            return list(self.buckets)
+
+    @property
+    def rate(self):
+        with self.lock:
+            return sum(bucket.rate for bucket in self.buckets.values())
+
+    @property
+    def max_rate(self):
+        with self.lock:
+            return sum(bucket.max_rate for bucket in self.buckets.values())
+
+    def label(self, key):
+        return self.labels[key]
+
+    def reserve(self):
+        """
+        Take a token from the key that has one soonest, and return the key, its bucket, and how many seconds
+        the caller must wait before using it
+        """
+        with self.lock:
+            # among keys with a token to spare, the one with the most spreads requests across them
+            key = min(self.buckets, key=lambda key: (self.buckets[key].delay(1), -self.buckets[key].tokens))
+            bucket = self.buckets[key]
+            return key, bucket, bucket.reserve(1)
+
+    def consume(self):
+        """
+        Take a token as `reserve` does, blocking until it is available, and return its key and bucket
+        """
+        key, bucket, wait = self.reserve()
+        deadline = time.monotonic() + wait
+        remaining = deadline - time.monotonic()
+        while remaining > 0:
+            time.sleep(remaining)
+            remaining = deadline - time.monotonic()
+        return key, bucket
+
+    def succeeded(self, key):
+        with self.lock:
+            if key in self.failures:
+                self.failures[key] = 0
+
+    def pushed_back(self, key, status):
+        """
+        Count a response with which the server pushed back on `key`, and return whether the key was removed
+        """
+        with self.lock:
+            if key not in self.buckets:
+                return False
+            if status == 429:
+                self.throttled[key] += 1
+            self.failures[key] += 1
+            if self.failures[key] < self.max_failures:
+                return False
+            return self._remove(key)
+
+    def reject(self, key):
+        """
+        Remove a key that the server rejected, and return whether it was removed
+        """
+        with self.lock:
+            return key in self.buckets and self._remove(key)
+
+    def _remove(self, key):
+        # the last key stays, so that requests still have somewhere to go
+        if len(self.buckets) == 1:
+            return False
+        del self.buckets[key]
+        self.removed.append(key)
+        return True
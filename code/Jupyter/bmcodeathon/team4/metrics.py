@@ -0,0 +1,190 @@
+"""
+Counters and histograms for the E-Utilities client and the pipeline
+"""
+import bisect
+import json
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Lock, Thread
+
+
+__all__ = (
+    'Metrics',
+    'StatsWriter',
+    'serve_prometheus',
+)
+
+# upper bounds, in seconds, of the histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def metric_name(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Estimate a quantile as the upper bound of the bucket it falls in
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+        }
+
+
+class Metrics(object):
+    """
+    Thread-safe counters and histograms, each keyed by a name and optional labels
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.start = time.time()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        stime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - stime, **labels)
+
+    def counter(self, name, **labels):
+        with self.lock:
+            return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def total(self, name):
+        """
+        Sum a counter over all of its labels
+        """
+        with self.lock:
+            return sum(value for (key, _), value in self.counters.items() if key == name)
+
+    def seconds(self, name):
+        """
+        Sum a histogram's observations over all of its labels
+        """
+        with self.lock:
+            return sum(histogram.sum for (key, _), histogram in self.histograms.items() if key == name)
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            return {
+                'time': now,
+                'elapsed': now - self.start,
+                'counters': dict(
+                    (metric_name(name, labels), value) for (name, labels), value in self.counters.items()
+                ),
+                'histograms': dict(
+                    (metric_name(name, labels), histogram.snapshot())
+                    for (name, labels), histogram in self.histograms.items()
+                ),
+            }
+
+    def prometheus(self):
+        """
+        Render the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f'{metric_name(name, labels)} {value}')
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                seen = 0
+                for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                    seen += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{metric_name(name + "_bucket", labels + (("le", le),))} {seen}')
+                lines.append(f'{metric_name(name + "_sum", labels)} {histogram.sum}')
+                lines.append(f'{metric_name(name + "_count", labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+class StatsWriter(Thread):
+    """
+    Appends a snapshot of the metrics to a JSON-lines file every `interval` seconds, and once more when stopped
+    """
+    def __init__(self, metrics, path, interval=10.0):
+        super(StatsWriter, self).__init__(name='StatsWriter', daemon=True)
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        with open(self.path, 'a') as f:
+            print(json.dumps(self.metrics.snapshot()), file=f)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.write()
+
+
+def serve_prometheus(metrics, port, host='127.0.0.1'):
+    """
+    Serve the metrics as Prometheus text from a background thread, and return the server
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name='Prometheus', daemon=True).start()
+    return server
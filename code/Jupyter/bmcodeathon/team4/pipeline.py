@@ -1,66 +1,50 @@
+import asyncio
 import csv
+import json
+import os
 import time
 from datetime import datetime
+from itertools import groupby, islice
+from operator import itemgetter
 from pathlib import Path
+from queue import Queue
+from threading import Lock, Thread
 from typing import Optional, List, Tuple
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
+import numpy as np
 import pandas as pd
 from attrs import define
 from numpy.random import RandomState
 from progress.bar import Bar
-from yaml import safe_load
+from progress.counter import Counter
 
+from .cache import ResponseCache
+from .config import Config
+from .concurrency import AUTO_MAX_WORKERS, MAX_HEDGE_UIDS, ConcurrencyController, estimate_calls
 from .eutils import EUtils
+from .hedgeindex import HedgeIndex
+from .hedgequery import RecordIndex, parse_hedge
+from .idstore import IdListStore
+from .records import RecordStore, fetch_records
+from .metrics import Metrics, StatsWriter, serve_prometheus
+from .rerun import HEDGES_NAME, PriorExperiment
+from .retry import CircuitBreaker, Dispatcher, RetryQueue, TransientError, is_transient, is_transient_message
+from .sampling import SAMPLE_COLUMNS, reservoir_sample, sample_key
+from .sequential import BiasEstimator
+from .shard import shard_dirname, shard_queries
 
-PREVIEW_PREFIX = 'https://eutilspreview.ncbi.nlm.nih.gov/entrez'
-
-@define
-class Config:
-    api_key: Optional[str]
-    email: Optional[str]
-    rate_limit: int
-    num_queries: int
-    num_results: int
-    data_path: str
-    data_sep: str
-    result_path: str
-    hedge_path: str
-    seed: int
-    max_workers: int
-
-    @property
-    def random_state(self):
-        return RandomState(self.seed) if self.seed > 0 else None
-
-    @staticmethod
-    def get_defaults():
-        return {
-            'num_queries': 1000,
-            'num_results': 200,
-            'seed': int(time.time()),               # default seed is random
-            'data_path': '/data/pubmed-data.tsv',
-            'data_sep': '\t',
-            'result_path': '/data/team4/results',
-            'hedge_path': '/data/team4/hedges.csv',
-            'api_key': None,
-            'email': None,
-            'rate_limit': 3,
-            'max_workers': 1
-        }
-
-    @classmethod
-    def load(cls, path=None):
-        cls_kwargs = cls.get_defaults()
-        expected_keys = set(cls_kwargs.keys())
-        if path is not None:
-            with open(str(path)) as f:
-                overrides = safe_load(f)
-            if any(key not in expected_keys for key in overrides.keys()):
-                raise ValueError(f'{path}: invalid setting encountered')
-            cls_kwargs.update(overrides)
-        return cls(**cls_kwargs)
+SORT_ORDERS = ['relevance', 'date_desc']
 
+RESULT_COLUMNS = [
+    'search_index',
+    'sort',
+    'result_count',
+    'return_count',
+    'error_count',
+    'bias_dimension',
+    'bias_result_count',
+]
 
 @define
 class ResultAtom:
@@ -70,18 +54,86 @@ class ResultAtom:
     bias_counts: List[Tuple]
 
 
+class ResultWriter:
+    """
+    Writes result atoms to results.csv from a dedicated thread.
+
+    Atoms are queued by `write_atom`, which blocks once `max_queued` atoms are waiting,
+    and the writer drains them in batches of up to `batch_size`, flushing each batch
+    to disk so that an interrupted run can be resumed.
+    """
+    def __init__(self, path, append=False, batch_size=100, max_queued=1000):
+        self.path = path
+        self.batch_size = batch_size
+        self.file = open(path, 'a' if append else 'w', newline='')
+        self.writer = csv.writer(self.file, dialect='unix')
+        if not append:
+            self.writer.writerow(RESULT_COLUMNS)
+        self.queue = Queue(maxsize=max_queued)
+        self.thread = Thread(target=self.drain, name='ResultWriter', daemon=True)
+        self.thread.start()
+
+    def write_atom(self, search_index, sort_order, atom):
+        self.queue.put((search_index, sort_order, atom))
+
+    def drain(self):
+        done = False
+        while not done:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get())
+            if batch[-1] is None:
+                batch.pop()
+                done = True
+            for search_index, sort_order, atom in batch:
+                self.writer.writerows(
+                    [search_index, sort_order, atom.result_count, atom.return_count, atom.error_count,
+                     hedge_name, bias_result_count]
+                    for hedge_name, bias_result_count in atom.bias_counts
+                )
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+
+
 class Pipeline:
-    def __init__(self, config: Config, experiment: str = None):
+    def __init__(self, config: Config, experiment: str = None, shard: Optional[Tuple[int, int]] = None):
         self.config = config
         self.hedge = None
+        self.hedge_index = None
+        self.idstore = None
         self.data = None
         self.experiment = experiment
         if experiment is None:
             experiment = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
         self.result_path = Path(self.config.result_path) / experiment
+        # a shard runs its part of the experiment's sample in a directory of its own
+        self.shard = shard
+        if shard is not None:
+            if config.seed <= 0:
+                raise ValueError('a sharded run needs a seed set in its configuration, so that every shard draws '
+                                 'the same sample')
+            if config.sequential_batch:
+                raise ValueError('a sequential run decides when to stop from all of its queries, so it cannot be sharded')
+            self.result_path = self.result_path / shard_dirname(*shard)
         self.error_count = 0
         self.error_log = None
-        self.eutils = EUtils(config.api_key, config.email, config.rate_limit, PREVIEW_PREFIX)
+        self.error_lock = Lock()
+        self.resume = False
+        self.completed = set()
+        self.cache = None
+        if config.cache_path:
+            self.cache = ResponseCache(config.cache_path, config.cache_ttl, config.cache_max_bytes)
+        self.metrics = Metrics()
+        self.controller = None
+        self.estimator = None
+        self.prior = None
+        self.eutils = EUtils(config.api_key, config.email, config.rate_limit, config.eutils_prefix,
+                             cache=self.cache, metrics=self.metrics, keys=config.key_rates)
 
     def load_hedges(self, hedge_path: Optional[str] = None):
         if hedge_path is None:
@@ -99,127 +151,710 @@ class Pipeline:
         df = df.drop_duplicates(subset=['query_term'])
         return df
 
-    def setup(self):
+    @property
+    def searched_hedges(self):
+        """
+        The hedges to search: all of them, or in a rerun, those that are new or changed since the prior experiment
+        """
+        if self.prior is None:
+            return self.hedge
+        return self.hedge.loc[self.prior.changed]
+
+    def load_experiment(self):
+        """
+        Reload the sampled queries, seed, and hedges of an existing experiment
+        """
+        self.queries = pd.read_csv(self.result_path / 'queries.csv', index_col=0)
+        if (self.result_path / HEDGES_NAME).exists():
+            self.hedge = self.load_hedges(self.result_path / HEDGES_NAME)
+        self.config.seed = int((self.result_path / 'seed.txt').read_text())
+        self.config.num_queries = len(self.queries)
+        self.error_log = (self.result_path / 'error_log.txt').open('a')
+
+    def load_completed(self, output_path):
+        """
+        Find the cases that completed without errors in an existing results.csv, and
+        rewrite it without the rows of any other cases so that they can be run again.
+        """
+        with open(output_path, newline='') as f:
+            rows = list(csv.DictReader(f, dialect='unix'))
+        case_rows = {}
+        for row in rows:
+            case_rows.setdefault((row['search_index'], row['sort']), []).append(row)
+        completed = set(
+            case for case, atom_rows in case_rows.items()
+            if len(atom_rows) == len(self.hedge) and all(row['error_count'] == '0' for row in atom_rows)
+        )
+        partial_path = output_path.with_suffix('.partial')
+        with open(partial_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, RESULT_COLUMNS, dialect='unix')
+            writer.writeheader()
+            writer.writerows(row for row in rows if (row['search_index'], row['sort']) in completed)
+        partial_path.replace(output_path)
+        return completed
+
+    def setup(self, resume=False):
         # prepare the run
         self.hedge = self.load_hedges()
+        self.resume = resume and (self.result_path / 'queries.csv').exists()
+        if self.resume:
+            self.load_experiment()
+        else:
+            self.sample_queries(exist_ok=resume)
+
+        if self.config.hedge_index_path:
+            self.build_hedge_index()
+
+    def memory_sample(self):
         self.data = self.load_data()
 
         num_queries = self.config.num_queries
         queries = self.data.sample(num_queries, random_state=self.config.random_state)
         # drop some of the columns to make this tractable
-        columns_to_drop = list(set(queries.columns) - {'search_id', 'query_term', 'result_count'})
-        self.queries = queries = queries.drop(columns=columns_to_drop)
+        columns_to_drop = list(set(queries.columns) - set(SAMPLE_COLUMNS))
+        return queries.drop(columns=columns_to_drop)
+
+    def stream_sample(self):
+        config = self.config
+        random_state = config.random_state or RandomState()
+        return reservoir_sample(config.data_path, config.data_sep, config.num_queries, random_state)
+
+    def sample_path(self):
+        """
+        Where a sample is kept for reuse by experiments with the same data, seed, and sampler
+        """
+        config = self.config
+        key = sample_key(config.data_path, config.data_sep, config.num_queries, config.seed, config.sampler)
+        return Path(config.result_path) / '.samples' / f'{key}.csv'
 
-        # setup the result directoryh
-        self.result_path.mkdir()
+    def sample_queries(self, exist_ok=False):
+        # only a seed set in the configuration draws the same sample again, so only its sample is kept for reuse,
+        # or a sample would be kept for every run
+        sample_path = self.sample_path() if self.config.seed > 0 else None
+        if self.config.seed <= 0:
+            # without a seed in the configuration, one is drawn from the clock, and kept in seed.txt
+            self.config.seed = int(time.time())
+        if sample_path and sample_path.exists():
+            queries = pd.read_csv(sample_path, index_col=0, dtype={'search_id': str, 'query_term': str})
+        else:
+            queries = self.stream_sample() if self.config.sampler == 'stream' else self.memory_sample()
+            if sample_path:
+                sample_path.parent.mkdir(parents=True, exist_ok=True)
+                partial_path = sample_path.with_suffix('.partial')
+                queries.to_csv(partial_path)
+                partial_path.replace(sample_path)
+        if self.shard is not None:
+            queries = shard_queries(queries, *self.shard)
+        if self.config.sequential_batch:
+            # a sequential run takes the sample in rounds from the top, so shuffle it, reproducibly from the seed
+            queries = queries.sample(frac=1, random_state=self.config.random_state)
+        self.queries = queries
+        self.start_experiment(exist_ok)
+
+    def start_experiment(self, exist_ok=False):
+        """
+        Create the result directory, with the queries, seed, and hedges the experiment runs
+        """
+        self.result_path.mkdir(parents=True, exist_ok=exist_ok)
         self.error_log = (self.result_path / 'error_log.txt').open('w')
-        queries_path = self.result_path / 'queries.csv'
-        queries.to_csv(queries_path)
-        seed_path = self.result_path / 'seed.txt'
-        seed_path.write_text(str(self.config.seed))
-
-    # input to the thread pool jobs
-    #  - the search_index and sort they are running
-    #  - the result_path
-    # Work each job does:
-    #  - Run the search with that sort order
-    #  - Save results to disk
-    #  - for each hedge row,
-    #      - and the pmid_term into a full query
-    #  - the data that we need from each worker will be
-    #      - search_index
-    #      - sort
-    #      - list of hedge and bias_result_count tuples
-    def run_case(self, search_index, sort_order):
+        self.queries.to_csv(self.result_path / 'queries.csv')
+        (self.result_path / 'seed.txt').write_text(str(self.config.seed))
+        # kept so that a rerun with changed hedges can tell which changed
+        if self.hedge is not None:
+            self.hedge.to_csv(self.result_path / HEDGES_NAME)
+
+    def setup_rerun(self, prior_experiment, hedge_path):
+        """
+        Prepare to run the queries of a prior experiment against the hedges in `hedge_path`, reusing its
+        first stage IdLists, and the results of the hedges that have not changed
+        """
+        prior_path = Path(self.config.result_path) / prior_experiment
+        if not (prior_path / 'results.csv').exists():
+            raise ValueError(f'{prior_path}: no results to rerun')
+        self.hedge = self.load_hedges(hedge_path)
+        self.prior = PriorExperiment(prior_path, self.hedge)
+        self.queries = pd.read_csv(prior_path / 'queries.csv', index_col=0,
+                                   dtype={'search_id': str, 'query_term': str})
+        self.config.seed = int((prior_path / 'seed.txt').read_text())
+        self.config.num_queries = len(self.queries)
+        self.start_experiment()
+        if self.config.hedge_index_path:
+            self.build_hedge_index()
+
+    def record_store(self):
+        return RecordStore(self.config.record_path or self.result_path / 'records.sqlite')
+
+    def fetch_records(self, records, idlists):
+        """
+        Fetch the records of the PMIDs in the experiment's first stage IdLists that are not yet in `records`
+        """
+        # the PMIDs are streamed from the store, and which are missing is checked a chunk at a time,
+        # so memory does not grow with the number of records and the total is not known up front
+        progress = Counter('Fetching records ')
+        with self.metrics.timer('stage_seconds', stage='fetch_records'):
+            fetched = fetch_records(self.eutils, records, idlists.pmids(), progress=progress)
+        progress.finish()
+        return fetched
+
+    def evaluate_hedges(self, hedges, offline=False):
+        """
+        Count each hedge's matches in the experiment's first stage IdLists locally, fetching the records
+        of the PMIDs they hold unless `offline`.
+
+        Returns a DataFrame like results.csv, with the server's count alongside, when the run searched the hedge.
+        """
+        idlists = IdListStore(self.result_path).load()
+        first_stages = sorted(key for key in idlists.keys() if key[2] == '')
+        records = self.record_store()
+        try:
+            if not offline:
+                self.fetch_records(records, idlists)
+            index = RecordIndex(records)
+        finally:
+            records.close()
+        matches = dict((hedge_name, index.evaluate(parse_hedge(hedge_text)))
+                       for hedge_name, hedge_text in hedges.Hedge_text.items())
+        rows = []
+        for search_index, sort_order, _ in first_stages:
+            pmids = idlists.get(search_index, sort_order).tolist()
+            for hedge_name, hedge_matches in matches.items():
+                server_key = (search_index, sort_order, hedge_name)
+                rows.append((
+                    int(search_index), sort_order, hedge_name,
+                    sum(pmid in hedge_matches for pmid in pmids),
+                    len(idlists.get(*server_key)) if server_key in idlists.index else None,
+                ))
+        return pd.DataFrame(rows, columns=[
+            'search_index', 'sort', 'bias_dimension', 'bias_result_count', 'server_result_count',
+        ]).astype({'server_result_count': 'Int64'})
+
+    def build_hedge_index(self):
+        progress = Bar('Indexing hedges', max=len(self.hedge))
+        self.hedge_index = HedgeIndex(self.config.hedge_index_path).build(self.eutils, self.hedge, progress)
+        progress.finish()
+
+    def first_stage_term(self, search_index):
         query_term = self.queries.query_term[search_index]
-        local_error_count = 0
+        return f'({query_term}) AND medline[sb]'
 
-        # that query gets a directory
-        query_result_path = self.result_path / str(search_index)
-        query_result_path.mkdir(exist_ok=True)
-        xml_results = query_result_path / f'{sort_order}.xml'
+    def log_error(self, message):
+        # called from every worker thread
+        with self.error_lock:
+            self.error_count += 1
+            print(message, file=self.error_log)
+
+    def log_retry(self, message):
+        # a retried case is not an error unless its retries run out
+        with self.error_lock:
+            print(message, file=self.error_log)
+
+    def record_errors(self, r, label):
+        if self.config.retry_attempts and any(is_transient_message(error) for error in r.errors):
+            raise TransientError(f'{label}: ' + ' '.join(error.strip() for error in r.errors))
+        for error in r.errors:
+            self.log_error(f'{label}:\n{error}')
+        return len(r.errors)
+
+    def first_stage_results(self, search_index, sort_order, r):
+        """
+        Save the first stage IdList, and return its error count, result count, and PMIDs
+        """
+        if self.config.save_xml:
+            # that query gets a directory
+            query_result_path = self.result_path / str(search_index)
+            query_result_path.mkdir(exist_ok=True)
+            xml_results = query_result_path / f'{sort_order}.xml'
+            xml_results.write_bytes(r.content)
+
+        error_count = self.record_errors(r, f'{search_index}, {sort_order}')
+        self.idstore.append(search_index, sort_order, None, r.ids)
+        return error_count, r.count, r.ids
+
+    def hedge_results(self, search_index, sort_order, hedge_name, r):
+        """
+        Save a hedge stage IdList, and return its error count and number of PMIDs
+        """
+        error_count = self.record_errors(r, f'{search_index}, {sort_order}, {hedge_name}')
+        self.idstore.append(search_index, sort_order, hedge_name, r.ids)
+        return error_count, len(r.ids)
+
+    def local_bias_counts(self, search_index, sort_order, pmids):
+        """
+        Count hedge matches against the hedge index, saving the matching IdLists
+        """
+        bias_counts = []
+        for hedge_name in self.searched_hedges.index:
+            matches = self.hedge_index.matches(hedge_name, pmids)
+            self.idstore.append(search_index, sort_order, hedge_name, matches)
+            bias_counts.append((hedge_name, len(matches)))
+        return bias_counts
+
+    def hedge_queries(self, pmids):
+        # in PMID order, so that cases with the same IdList make the same request
+        pmid_term = ','.join(map(str, np.sort(np.asarray(pmids, dtype=np.uint32)))) + '[UID]'
+        for hedge_name, hedge_row in self.searched_hedges.iterrows():
+            hedge_query = hedge_row['Hedge_text']
+            yield hedge_name, f'{pmid_term} AND ({hedge_query})'
 
+    def reuse_first_stage(self, search_index, sort_order):
+        """
+        In a rerun, take the first stage from the prior experiment instead of searching again
+        """
+        result_count, pmids = self.prior.first_stage(search_index, sort_order)
+        self.idstore.append(search_index, sort_order, None, pmids)
+        return 0, result_count, pmids
+
+    def first_stage(self, search_index, sort_order):
+        if self.prior is not None and self.prior.reusable(search_index, sort_order):
+            return self.reuse_first_stage(search_index, sort_order)
+        term = self.first_stage_term(search_index)
+        with self.metrics.timer('stage_seconds', stage='first_stage'):
+            r = self.eutils.search('pubmed', retmax=self.config.num_results, term=term, sort=sort_order,
+                                   keep_content=self.config.save_xml)
+        return self.first_stage_results(search_index, sort_order, r)
+
+    async def first_stage_async(self, eutils, search_index, sort_order):
+        if self.prior is not None and self.prior.reusable(search_index, sort_order):
+            return self.reuse_first_stage(search_index, sort_order)
+        term = self.first_stage_term(search_index)
+        with self.metrics.timer('stage_seconds', stage='first_stage'):
+            r = await eutils.search('pubmed', retmax=self.config.num_results, term=term, sort=sort_order,
+                                    keep_content=self.config.save_xml)
+        return self.first_stage_results(search_index, sort_order, r)
+
+    # each case is one search_index and sort; the worker running it:
+    #  - runs the first stage search with that sort order, or reuses it in a rerun
+    #  - saves its IdList, and its XML when save_xml is set
+    #  - for each hedge, ANDs the IdList with the hedge, and searches it or matches it in the hedge index
+    #  - returns a ResultAtom of the result count and the list of hedge and bias_result_count tuples
+    def run_case(self, search_index, sort_order):
         # get the query results with relevance
-        only_medline = f'({query_term}) AND medline[sb]'
-        r = self.eutils.esearch('pubmed', retmax=self.config.num_results, term=only_medline, sort=sort_order)
-        xml_results.write_bytes(r.content)
-        error_elements = r.xml.xpath('/eSearchResult/ERROR')
-        for error in error_elements:
-            self.error_count += 1
-            local_error_count += 1
-            print(f'{search_index}, {sort_order}:\n{error.text}', file=self.error_log)
-        pmids = [element.text for element in r.xml.xpath('//IdList/Id')]
-        pmid_term = ','.join(pmids) + '[UID]'
-        counts = r.xml.xpath('//Count')
-        result_count = int(counts[0].text) if len(counts) > 0 else 0
-        return_count = len(pmids)
+        local_error_count, result_count, pmids = self.first_stage(search_index, sort_order)
+        if self.hedge_index is not None:
+            bias_counts = self.local_bias_counts(search_index, sort_order, pmids)
+            return ResultAtom(result_count, len(pmids), local_error_count, bias_counts)
 
         bias_counts = []
         # for each hedge, run the query against that query_id
-        for hedge_name, hedge_row in self.hedge.iterrows():
-            hedge_query = hedge_row['Hedge_text']
-            full_query = f'{pmid_term} AND ({hedge_query})'
-            r = self.eutils.esearch('pubmed', term=full_query, retmax=200)
-            error_elements = r.xml.xpath('/eSearchResult/ERROR')
-            for error in error_elements:
-                self.error_count += 1
-                local_error_count += 1
-                print(f'{search_index}, {sort_order}, {hedge_name}:\n{error.text}', file=self.error_log)
-            bias_result_count = len(r.xml.xpath('//IdList/Id'))
+        for hedge_name, full_query in self.hedge_queries(pmids):
+            with self.metrics.timer('stage_seconds', stage='hedge'):
+                r = self.eutils.search('pubmed', term=full_query, retmax=200)
+            error_count, bias_result_count = self.hedge_results(search_index, sort_order, hedge_name, r)
+            local_error_count += error_count
             bias_counts.append((hedge_name, bias_result_count))
 
-        return ResultAtom(result_count, return_count, local_error_count, bias_counts)
+        return ResultAtom(result_count, len(pmids), local_error_count, bias_counts)
+
+    async def run_case_async(self, eutils, search_index, sort_order):
+        """
+        The same work as `run_case`, but with the hedge searches issued concurrently
+        """
+        local_error_count, result_count, pmids = await self.first_stage_async(eutils, search_index, sort_order)
+        if self.hedge_index is not None:
+            bias_counts = self.local_bias_counts(search_index, sort_order, pmids)
+            return ResultAtom(result_count, len(pmids), local_error_count, bias_counts)
+
+        hedge_queries = list(self.hedge_queries(pmids))
+        with self.metrics.timer('stage_seconds', stage='hedge'):
+            responses = await asyncio.gather(*(
+                eutils.search('pubmed', term=full_query, retmax=200)
+                for _, full_query in hedge_queries
+            ))
+        bias_counts = []
+        for (hedge_name, _), r in zip(hedge_queries, responses):
+            error_count, bias_result_count = self.hedge_results(search_index, sort_order, hedge_name, r)
+            local_error_count += error_count
+            bias_counts.append((hedge_name, bias_result_count))
+
+        return ResultAtom(result_count, len(pmids), local_error_count, bias_counts)
+
+    def batch_hedge_queries(self, first_stages):
+        """
+        Yield a hedge query, and the number of PMIDs it asks for, over the union of the first stage IdLists.
+
+        The union is split into chunks of at most MAX_HEDGE_UIDS PMIDs.
+        """
+        union = np.unique(np.concatenate([pmids for _, _, pmids in first_stages]))
+        for start in range(0, len(union), MAX_HEDGE_UIDS):
+            chunk = union[start:start + MAX_HEDGE_UIDS]
+            for hedge_name, full_query in self.hedge_queries(chunk):
+                yield hedge_name, full_query, len(chunk)
+
+    def batch_hedge_results(self, batch, hedge_name, r, matches):
+        """
+        Add the PMIDs a batched hedge search matched to `matches`, and return its error count
+        """
+        label = ' '.join(f'{search_index}/{sort_order}' for search_index, sort_order in batch)
+        error_count = self.record_errors(r, f'{label}, {hedge_name}')
+        matches.setdefault(hedge_name, []).append(r.ids)
+        return error_count
+
+    def split_batch(self, batch, first_stages, matches, hedge_error_count):
+        """
+        Count each case's hedge matches from the batch's matches, saving the matching IdLists.
+
+        An error in any hedge search counts against every case in the batch, so that all are rerun on resume.
+        """
+        atoms = []
+        for (search_index, sort_order), (error_count, result_count, pmids) in zip(batch, first_stages):
+            bias_counts = []
+            for hedge_name in self.searched_hedges.index:
+                hedge_matches = np.concatenate(matches.get(hedge_name, [pmids[:0]]))
+                case_matches = pmids[np.isin(pmids, hedge_matches)]
+                self.idstore.append(search_index, sort_order, hedge_name, case_matches)
+                bias_counts.append((hedge_name, len(case_matches)))
+            atoms.append(ResultAtom(result_count, len(pmids), error_count + hedge_error_count, bias_counts))
+        return atoms
+
+    def run_batch(self, batch):
+        """
+        Run the first stage of each case in `batch`, and then search each hedge once for all of them
+        """
+        first_stages = [self.first_stage(search_index, sort_order) for search_index, sort_order in batch]
+        if self.hedge_index is not None:
+            return [
+                ResultAtom(result_count, len(pmids), error_count, self.local_bias_counts(search_index, sort_order, pmids))
+                for (search_index, sort_order), (error_count, result_count, pmids) in zip(batch, first_stages)
+            ]
+        matches = {}
+        hedge_error_count = 0
+        for hedge_name, full_query, num_pmids in self.batch_hedge_queries(first_stages):
+            with self.metrics.timer('stage_seconds', stage='hedge'):
+                r = self.eutils.search('pubmed', term=full_query, retmax=num_pmids, post=True)
+            hedge_error_count += self.batch_hedge_results(batch, hedge_name, r, matches)
+        return self.split_batch(batch, first_stages, matches, hedge_error_count)
+
+    async def run_batch_async(self, eutils, batch):
+        """
+        The same work as `run_batch`, but with the first stage and hedge searches each issued concurrently
+        """
+        first_stages = await asyncio.gather(*(
+            self.first_stage_async(eutils, search_index, sort_order) for search_index, sort_order in batch
+        ))
+        if self.hedge_index is not None:
+            return [
+                ResultAtom(result_count, len(pmids), error_count, self.local_bias_counts(search_index, sort_order, pmids))
+                for (search_index, sort_order), (error_count, result_count, pmids) in zip(batch, first_stages)
+            ]
+        hedge_queries = list(self.batch_hedge_queries(first_stages))
+        with self.metrics.timer('stage_seconds', stage='hedge'):
+            responses = await asyncio.gather(*(
+                eutils.search('pubmed', term=full_query, retmax=num_pmids, post=True)
+                for _, full_query, num_pmids in hedge_queries
+            ))
+        matches = {}
+        hedge_error_count = 0
+        for (hedge_name, _, _), r in zip(hedge_queries, responses):
+            hedge_error_count += self.batch_hedge_results(batch, hedge_name, r, matches)
+        return self.split_batch(batch, first_stages, matches, hedge_error_count)
+
+    def cases(self, search_indexes=None):
+        """
+        Yield the (search_index, sort) of each case that has not already completed
+        """
+        for search_index in self.queries.index if search_indexes is None else search_indexes:
+            for sort_order in SORT_ORDERS:
+                if (str(search_index), sort_order) not in self.completed:
+                    yield search_index, sort_order
+
+    def batches(self, search_indexes=None):
+        """
+        Yield lists of cases to run together: each case alone, or with `hedge_batch`,
+        the cases of that many queries
+        """
+        if not self.config.hedge_batch:
+            for case in self.cases(search_indexes):
+                yield [case]
+            return
+        queries = groupby(self.cases(search_indexes), key=itemgetter(0))
+        while True:
+            batch = [case for _, group in islice(queries, self.config.hedge_batch) for case in group]
+            if not batch:
+                break
+            yield batch
+
+    def run_unit(self, batch):
+        if not self.config.hedge_batch:
+            return [self.run_case(*batch[0])]
+        return self.run_batch(batch)
+
+    async def run_unit_async(self, eutils, batch):
+        if not self.config.hedge_batch:
+            return [await self.run_case_async(eutils, *batch[0])]
+        return await self.run_batch_async(eutils, batch)
+
+    def dispatcher(self, search_indexes=None):
+        retries = RetryQueue(self.config.retry_attempts, self.config.retry_backoff, deadline=self.config.retry_deadline)
+        breaker = CircuitBreaker(threshold=self.config.breaker_threshold, cooldown=self.config.breaker_cooldown)
+        return Dispatcher(self.batches(search_indexes), retries, breaker)
+
+    def settle(self, results, progress, dispatcher, item, exc, atoms):
+        """
+        Finish the cases of a dispatched batch, or queue them to be retried if they failed transiently
+        """
+        batch, attempt, started, ticket = item
+        transient = exc is not None and is_transient(exc)
+        was_open = dispatcher.breaker.is_open
+        dispatcher.breaker.record(ticket, not transient)
+        if dispatcher.breaker.is_open and not was_open:
+            self.metrics.inc('breaker_opens_total')
+            self.log_retry(f'Pausing dispatch for {dispatcher.breaker.cooldown} seconds after repeated backend errors')
+        if transient:
+            delay = dispatcher.retries.push(batch, attempt + 1, started)
+            if delay is not None:
+                self.metrics.inc('retries_total')
+                label = ' '.join(f'{search_index}/{sort_order}' for search_index, sort_order in batch)
+                self.log_retry(f'{label}: retry {attempt + 1} in {delay:.1f} seconds after: {exc}')
+                return
+        if exc is not None:
+            atoms = [exc] * len(batch)
+        for (search_index, sort_order), atom in zip(batch, atoms):
+            self.finish_case(results, progress, search_index, sort_order, atom)
+
+    def finish_case(self, results, progress, search_index, sort_order, atom):
+        progress.next()
+        if isinstance(atom, Exception):
+            self.metrics.inc('cases_total', status='exception')
+            self.log_error(f'{search_index}, {sort_order}: exception: {atom}')
+            if self.estimator is not None:
+                self.estimator.add(search_index, sort_order, None, 0, [])
+        else:
+            self.metrics.inc('cases_total', status='error' if atom.error_count else 'ok')
+            if self.prior is not None:
+                atom.bias_counts = self.prior.complete(self.idstore, search_index, sort_order, atom.bias_counts)
+            results.write_atom(search_index, sort_order, atom)
+            if self.estimator is not None:
+                self.estimator.add(search_index, sort_order, atom.result_count, atom.error_count, atom.bias_counts)
+
+    def adapt(self, stime, eutils, tokenbucket):
+        """
+        With max_workers: auto, resize concurrency after a unit dispatched at `stime` finished
+        """
+        if self.controller is not None:
+            rate = tokenbucket.rate if tokenbucket is not None else None
+            self.controller.observe(time.perf_counter() - stime, eutils.call_count, rate,
+                                    self.metrics.seconds('token_wait_seconds'),
+                                    self.metrics.seconds('http_request_seconds'))
+
+    def run_threads(self, results, progress, search_indexes=None):
+        """
+        Feed batches of cases to the thread pool, keeping at most two per worker queued or running,
+        or with max_workers: auto, as many as the controller finds keep the rate limit saturated.
+
+        Batches that fail transiently come back from the retry queue, and dispatch pauses while
+        the circuit breaker is open.
+        """
+        dispatcher = self.dispatcher(search_indexes)
+        tokenbucket = getattr(self.eutils.session, 'tokenbucket', None)
+        if self.config.max_workers == 'auto':
+            if self.controller is None:
+                self.controller = ConcurrencyController(self.config.total_rate)
+            pool_size = AUTO_MAX_WORKERS
+        else:
+            pool_size = self.config.max_workers
+        pending = {}
+        with ThreadPoolExecutor(max_workers=pool_size) as pool:
+            while True:
+                max_pending = self.controller.limit if self.controller else 2 * pool_size
+                while len(pending) < max_pending:
+                    item = dispatcher.next()
+                    if item is None:
+                        break
+                    pending[pool.submit(self.run_unit, item[0])] = (item, time.perf_counter())
+                if not pending and dispatcher.done:
+                    break
+                timeout = dispatcher.wait_time()
+                if not pending:
+                    time.sleep(timeout)
+                    continue
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item, stime = pending.pop(future)
+                    self.adapt(stime, self.eutils, tokenbucket)
+                    exc = future.exception()
+                    self.settle(results, progress, dispatcher, item, exc, None if exc else future.result())
+        return self.eutils
+
+    async def run_async(self, results, progress, search_indexes=None):
+        """
+        Run the cases as coroutines on one event loop.
+
+        At most `max_workers` batches of cases are in flight at once, or with max_workers: auto, as many as the
+        controller finds keep the rate limit saturated; the shared token bucket keeps the request rate within
+        `rate_limit`.
+        """
+        from .aioeutils import AsyncEUtils
+
+        config = self.config
+
+        async def guarded(item):
+            stime = time.perf_counter()
+            try:
+                return item, None, await self.run_unit_async(eutils, item[0])
+            except Exception as exc:
+                return item, exc, None
+            finally:
+                self.adapt(stime, eutils, eutils.tokenbucket)
+
+        if config.max_workers == 'auto':
+            if self.controller is None:
+                self.controller = ConcurrencyController(config.total_rate)
+            limit = AUTO_MAX_WORKERS
+        else:
+            limit = config.max_workers
+        async with AsyncEUtils(config.api_key, config.email, config.rate_limit, config.eutils_prefix,
+                               limit=limit, cache=self.cache, metrics=self.metrics, keys=config.key_rates) as eutils:
+            dispatcher = self.dispatcher(search_indexes)
+            pending = set()
+            while True:
+                while len(pending) < (self.controller.limit if self.controller else limit):
+                    item = dispatcher.next()
+                    if item is None:
+                        break
+                    pending.add(asyncio.ensure_future(guarded(item)))
+                if not pending and dispatcher.done:
+                    break
+                timeout = dispatcher.wait_time()
+                if not pending:
+                    await asyncio.sleep(timeout)
+                    continue
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    self.settle(results, progress, dispatcher, *task.result())
+        return eutils
+
+    def rounds(self):
+        """
+        Yield the search indexes of each round of queries: all of them at once, or `sequential_batch` at a time
+        """
+        size = self.config.sequential_batch or len(self.queries)
+        for start in range(0, len(self.queries), size):
+            yield self.queries.index[start:start + size]
+
+    def run_round(self, results, progress, search_indexes=None):
+        if self.config.run_mode == 'async':
+            return asyncio.run(self.run_async(results, progress, search_indexes))
+        return self.run_threads(results, progress, search_indexes)
+
+    def stop_reason(self, num_queries, queries_run):
+        """
+        Why a sequential run should stop before a round of `num_queries` queries, or None to run it
+        """
+        config = self.config
+        if self.estimator is None:
+            return None
+        if self.estimator.converged:
+            return f'every interval is narrower than {config.target_width}'
+        if config.call_budget is not None:
+            calls = self.metrics.total('eutils_calls_total')
+            if queries_run:
+                round_calls = calls / queries_run * num_queries
+            else:
+                round_calls = sum(estimate_calls(num_queries, len(self.hedge), config.hedge_batch,
+                                                 bool(config.hedge_index_path), config.num_results))
+            if calls + round_calls > config.call_budget:
+                return f'the next round would take the run past its budget of {config.call_budget} calls'
+        return None
+
+    def log_estimates(self, f, queries_run):
+        estimates = self.estimator.estimates()
+        print(json.dumps({
+            'time': time.time(),
+            'queries': queries_run,
+            'compared_queries': self.estimator.queries,
+            'calls': self.metrics.total('eutils_calls_total'),
+            'estimates': estimates.to_dict(orient='records'),
+        }), file=f, flush=True)
 
     def run(self):
-        # start the result file
+        # start the result file, or continue it when resuming
         output_path = self.result_path / 'results.csv'
-        f = open(output_path, 'w')
-        writer = csv.writer(f, dialect='unix')
-        writer.writerow([
-            'search_index',
-            'sort',
-            'result_count',
-            'return_count',
-            'error_count',
-            'bias_dimension',
-            'bias_result_count',
-        ])
+        config = self.config
+        if config.sequential_batch:
+            self.estimator = BiasEstimator(self.hedge.index, config.target_width, config.confidence,
+                                           config.min_comparisons)
+        if self.resume and output_path.exists():
+            self.completed = self.load_completed(output_path)
+            if self.estimator is not None:
+                self.estimator.load(output_path)
+            results = ResultWriter(output_path, append=True)
+        else:
+            results = ResultWriter(output_path)
+        self.idstore = IdListStore(self.result_path).open_for_append()
+
+        # snapshot the metrics to stats.jsonl, and serve them if asked
+        stats = StatsWriter(self.metrics, self.result_path / 'stats.jsonl', self.config.stats_interval)
+        stats.start()
+        metrics_server = None
+        if self.config.metrics_port is not None:
+            metrics_server = serve_prometheus(self.metrics, self.config.metrics_port)
 
         # progress bar
-        progress = Bar('Runing', max=2*self.config.num_queries)
+        progress = Bar('Runing', max=2*len(self.queries) - len(self.completed))
+        if self.prior is not None:
+            # a rerun first searches the changed hedges for the cases it can reuse
+            self.completed = set(
+                (str(search_index), sort_order) for search_index in self.queries.index for sort_order in SORT_ORDERS
+            ) - set(self.prior.cases)
         stime = time.perf_counter()
 
-        # for each query
-        with ThreadPoolExecutor(max_workers=self.config.max_workers) as pool:
-            future_to_params = {
-                pool.submit(self.run_case, search_index, sort_order): (search_index, sort_order)
-                for search_index in self.queries.index
-                for sort_order in ['relevance', 'date_desc']
-            }
-            for future in as_completed(future_to_params):
-                progress.next()
-                search_index, sort_order = future_to_params[future]
-                try:
-                    atom = future.result()
-                    for hedge_name, bias_result_count in atom.bias_counts:
-                        writer.writerow([
-                            search_index,
-                            sort_order,
-                            atom.result_count,
-                            atom.return_count,
-                            atom.error_count,
-                            hedge_name,
-                            bias_result_count
-                        ])
-                except Exception as exc:
-                    self.error_count += 1
-                    print(f'{search_index}, {sort_order}: exception: {exc}', file=self.error_log)
+        # for each round of queries, which is all of them unless sequential
+        eutils = self.eutils
+        stop_reason = None
+        queries_run = 0
+        estimates = (self.result_path / 'estimates.jsonl').open('a') if self.estimator is not None else None
+        for search_indexes in self.rounds():
+            stop_reason = self.stop_reason(len(search_indexes), queries_run)
+            if stop_reason is not None:
+                break
+            eutils = self.run_round(results, progress, search_indexes)
+            # queries that completed before a resume made no calls in this run
+            queries_run += sum(
+                any((str(search_index), sort_order) not in self.completed for sort_order in SORT_ORDERS)
+                for search_index in search_indexes
+            )
+            if estimates is not None:
+                self.log_estimates(estimates, queries_run)
+        if self.prior is not None and stop_reason is None:
+            # and then runs the cases the prior experiment did not finish cleanly in full
+            self.completed = set(self.prior.cases)
+            self.prior = None
+            eutils = self.run_round(results, progress)
         progress.finish()
-        f.close()
+        if estimates is not None:
+            estimates.close()
+        results.close()
+        self.idstore.close()
+        if self.config.fetch_records:
+            records = self.record_store()
+            try:
+                print(f'{self.fetch_records(records, IdListStore(self.result_path).load())} records fetched')
+            finally:
+                records.close()
+        stats.stop()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+            metrics_server.server_close()
         elapsed = time.perf_counter() - stime
-        call_count = self.eutils.call_count
+        call_count = eutils.call_count
         tput = call_count / elapsed
         print(f'{call_count} API Calls in {elapsed:.2f} seconds ({tput:.1f} per second)')
+        print(f'{self.metrics.seconds("token_wait_seconds"):.2f} seconds waiting for tokens, '
+              f'{self.metrics.seconds("http_request_seconds"):.2f} in requests, '
+              f'{self.metrics.seconds("xml_parse_seconds"):.2f} parsing XML')
+        if self.cache is not None:
+            print(f'{eutils.cache_hits} cache hits and {eutils.cache_misses} misses')
+        if eutils.coalesced_count:
+            print(f'{eutils.coalesced_count} calls saved by sharing identical requests in flight')
+        if eutils.keypool is not None and eutils.keypool.removed:
+            removed = ', '.join(eutils.keypool.label(key) for key in eutils.keypool.removed)
+            print(f'API keys {removed} of {len(eutils.keypool.labels)} were taken out of the pool after failing')
+        if self.controller is not None:
+            print(f'max_workers settled at {self.controller.limit}')
+        if self.estimator is not None:
+            print(f'Stopped after {queries_run} of {len(self.queries)} queries: '
+                  f'{stop_reason or "the sample ran out"}')
+            print(self.estimator.estimates().to_string(index=False))
         print(f'There were {self.error_count} errors')
         print(f'Results in {output_path}')
 
@@ -0,0 +1,172 @@
+"""
+A local store of PubMed records: the title, abstract, and MeSH headings of each PMID
+"""
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from threading import Lock
+
+from attrs import define
+from lxml import etree
+
+
+__all__ = (
+    'Record',
+    'RecordStore',
+    'fetch_records',
+    'iter_articles',
+    'parse_article',
+)
+
+# PMIDs posted to the history server at once, and records fetched per efetch page
+POST_SIZE = 10000
+PAGE_SIZE = 500
+
+
+@define
+class Record:
+    pmid: int
+    title: str
+    abstract: str
+    mesh: list
+
+
+def element_text(element):
+    return ' '.join(''.join(element.itertext()).split()) if element is not None else ''
+
+
+def parse_article(article):
+    """
+    Make a Record from a PubmedArticle element
+    """
+    citation = article.find('MedlineCitation')
+    abstract = ' '.join(element_text(text) for text in citation.iterfind('Article/Abstract/AbstractText'))
+    return Record(
+        pmid=int(citation.findtext('PMID')),
+        title=element_text(citation.find('Article/ArticleTitle')),
+        abstract=abstract,
+        mesh=[element_text(name) for name in citation.iterfind('MeshHeadingList/MeshHeading/DescriptorName')],
+    )
+
+
+class RecordStore(object):
+    """
+    A SQLite file of PubMed records, keyed by PMID.
+
+    `put` is thread-safe.  MeSH headings are kept one per line.
+    """
+    def __init__(self, path):
+        self.path = str(path)
+        self.lock = Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS records ('
+            'pmid INTEGER PRIMARY KEY, title TEXT NOT NULL, abstract TEXT NOT NULL, mesh TEXT NOT NULL)'
+        )
+        self.db.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+    def __iter__(self):
+        with self.lock:
+            rows = self.db.execute('SELECT pmid, title, abstract, mesh FROM records ORDER BY pmid').fetchall()
+        for pmid, title, abstract, mesh in rows:
+            yield Record(pmid, title, abstract, mesh.split('\n') if mesh else [])
+
+    def get(self, pmid):
+        with self.lock:
+            row = self.db.execute('SELECT pmid, title, abstract, mesh FROM records WHERE pmid = ?',
+                                  (int(pmid),)).fetchone()
+        if row is None:
+            return None
+        return Record(row[0], row[1], row[2], row[3].split('\n') if row[3] else [])
+
+    def missing(self, pmids):
+        """
+        Return the PMIDs, from `pmids`, that are not in the store
+        """
+        pmids = sorted(set(int(pmid) for pmid in pmids))
+        present = set()
+        with self.lock:
+            # stay within SQLite's limit on the number of parameters
+            for start in range(0, len(pmids), 500):
+                chunk = pmids[start:start + 500]
+                rows = self.db.execute(
+                    f'SELECT pmid FROM records WHERE pmid IN ({",".join("?" * len(chunk))})', chunk
+                ).fetchall()
+                present.update(row[0] for row in rows)
+        return [pmid for pmid in pmids if pmid not in present]
+
+    def put(self, records):
+        with self.lock:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO records (pmid, title, abstract, mesh) VALUES (?, ?, ?, ?)',
+                [(record.pmid, record.title, record.abstract, '\n'.join(record.mesh)) for record in records],
+            )
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def iter_articles(source):
+    """
+    Parse PubmedArticle elements from a file or stream one at a time, freeing each once it has been parsed
+    """
+    for _, article in etree.iterparse(source, tag='PubmedArticle'):
+        yield parse_article(article)
+        article.clear()
+        while article.getprevious() is not None:
+            del article.getparent()[0]
+
+
+def fetch_page(eutils, store, webenv, query_key, retstart, retmax, batch_size=100):
+    """
+    Fetch one page of the records posted under `query_key`, writing them to `store` as they are parsed
+    """
+    r = eutils.efetch('pubmed', webenv=webenv, query_key=query_key, retstart=str(retstart), retmax=retmax,
+                      stream=True)
+    count = 0
+    try:
+        articles = iter_articles(r.raw)
+        while True:
+            batch = list(islice(articles, batch_size))
+            if not batch:
+                break
+            store.put(batch)
+            count += len(batch)
+    finally:
+        r.close()
+    return count
+
+
+def fetch_records(eutils, store, pmids, page_size=PAGE_SIZE, post_size=POST_SIZE, parallel=4, progress=None):
+    """
+    Fetch the records of any of `pmids` missing from `store`, and return how many were fetched.
+
+    The missing PMIDs are posted to the history server `post_size` at a time, and each post is fetched
+    in pages of `page_size`, with up to `parallel` pages in flight.  Pages are parsed as they arrive and
+    written to the store as they are parsed, so memory use does not grow with the number of records.
+    """
+    pmids = iter(pmids)
+    fetched = 0
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        while True:
+            chunk = list(islice(pmids, post_size))
+            if not chunk:
+                break
+            missing = store.missing(chunk)
+            if not missing:
+                continue
+            r = eutils.epost('pubmed', *missing)
+            pages = [
+                pool.submit(fetch_page, eutils, store, r.webenv, r.query_key, retstart, page_size)
+                for retstart in range(0, len(missing), page_size)
+            ]
+            for page, retstart in zip(pages, range(0, len(missing), page_size)):
+                fetched += page.result()
+                if progress is not None:
+                    progress.next(min(page_size, len(missing) - retstart))
+    return fetched
@@ -0,0 +1,245 @@
+"""
+A local stand-in for the E-Utilities that replays recorded esearch responses
+"""
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+from xml.sax.saxutils import escape
+
+from lxml import etree
+
+from .tokenbucket import TokenBucket
+
+
+__all__ = (
+    'ReplayServer',
+    'load_recordings',
+)
+
+# recorded experiments name the date_desc response datedesc.xml
+SORT_FILES = {
+    'relevance': ['relevance.xml'],
+    'date_desc': ['date_desc.xml', 'datedesc.xml'],
+}
+
+
+def load_recordings(path):
+    """
+    Load the first stage responses saved under `path`, as {sort: [content, ...]}
+    """
+    recordings = dict((sort, []) for sort in SORT_FILES)
+    for query_path in sorted(Path(path).iterdir()):
+        if not query_path.is_dir():
+            continue
+        for sort, names in SORT_FILES.items():
+            for name in names:
+                if (query_path / name).exists():
+                    recordings[sort].append((query_path / name).read_bytes())
+                    break
+    return recordings
+
+
+def search_result(pmids, count=None, webenv=None, query_key=None):
+    count = len(pmids) if count is None else count
+    history = f'<QueryKey>{query_key}</QueryKey><WebEnv>{webenv}</WebEnv>' if webenv else ''
+    ids = ''.join(f'<Id>{pmid}</Id>\n' for pmid in pmids)
+    return (
+        '<?xml version="1.0" encoding="UTF-8" ?>\n'
+        f'<eSearchResult><Count>{count}</Count><RetMax>{len(pmids)}</RetMax><RetStart>0</RetStart>'
+        f'{history}<IdList>\n{ids}</IdList></eSearchResult>\n'
+    ).encode('utf-8')
+
+
+def error_result(message):
+    return (
+        '<?xml version="1.0" encoding="UTF-8" ?>\n'
+        f'<eSearchResult><ERROR>{escape(message)}</ERROR></eSearchResult>\n'
+    ).encode('utf-8')
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.handle_eutils(url.path, parse_qs(url.query))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        params = parse_qs(url.query)
+        params.update(parse_qs(self.rfile.read(length).decode('utf-8')))
+        self.handle_eutils(url.path, params)
+
+    def handle_eutils(self, path, params):
+        server = self.server
+        params = dict((key, values[-1]) for key, values in params.items())
+        server.count_request(path)
+        if server.latency:
+            time.sleep(server.latency * (1 + server.jitter * server.random.random()))
+        status, headers = server.injected_failure(params.get('api_key'))
+        if status:
+            return self.send(status, b'', headers=headers)
+        endpoint = path.rsplit('/', 1)[-1]
+        if endpoint == 'esearch.fcgi':
+            body = server.esearch(params)
+        elif endpoint == 'efetch.fcgi':
+            body = server.efetch(params)
+        elif endpoint == 'epost.fcgi':
+            body = server.epost(params)
+        else:
+            return self.send(404, b'')
+        self.send(200, body)
+
+    def send(self, status, body, content_type='text/xml; charset=UTF-8', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """
+    Serves esearch, efetch, and epost from recorded first stage responses.
+
+    A first stage search gets one of the recorded responses for its sort, chosen by a hash of the
+    term, so the same term always gets the same response.  A hedge search over a list of PMIDs
+    matches about one in `hedge_ratio` of them, chosen by a hash of the hedge and PMID, so hedge
+    results are consistent however they are asked for.  Searches with history save their IdList,
+    which efetch pages through.
+
+    `latency` seconds (stretched by up to `jitter` times) are added to every response, failures
+    are injected with probabilities `error_429` and `error_502`, and once requests exceed
+    `rate_limit` per second, they are answered with 429 and a Retry-After.  As at NCBI, the limit
+    applies to each API key apart, and to requests without one together.
+    """
+    daemon_threads = True
+
+    def __init__(self, recordings, address=('127.0.0.1', 0), latency=0.0, jitter=0.0, error_429=0.0,
+                 error_502=0.0, rate_limit=None, hedge_ratio=4, seed=0):
+        super(ReplayServer, self).__init__(address, ReplayHandler)
+        if not isinstance(recordings, dict):
+            recordings = load_recordings(recordings)
+        self.recordings = recordings
+        self.recorded_ids = dict((sort, [self.parse_ids(content) for content in contents])
+                                 for sort, contents in recordings.items())
+        self.latency = latency
+        self.jitter = jitter
+        self.error_429 = error_429
+        self.error_502 = error_502
+        self.hedge_ratio = hedge_ratio
+        self.random = random.Random(seed)
+        self.rate_limit = rate_limit
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.history = {}
+        self.request_counts = {}
+        self.thread = None
+
+    @staticmethod
+    def parse_ids(content):
+        return [element.text for element in etree.fromstring(content).xpath('//IdList/Id')]
+
+    @property
+    def prefix(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/entrez'
+
+    @property
+    def request_count(self):
+        return sum(self.request_counts.values())
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+    def count_request(self, path):
+        endpoint = path.rsplit('/', 1)[-1]
+        with self.lock:
+            self.request_counts[endpoint] = self.request_counts.get(endpoint, 0) + 1
+
+    def injected_failure(self, api_key=None):
+        with self.lock:
+            if self.rate_limit:
+                bucket = self.buckets.get(api_key)
+                if bucket is None:
+                    rate = self.rate_limit
+                    bucket = self.buckets[api_key] = TokenBucket(rate=rate, tokens=rate, capacity=rate)
+                if bucket.tokens < 1:
+                    return 429, {'Retry-After': '1'}
+                bucket.reserve(1)
+            draw = self.random.random()
+        if draw < self.error_429:
+            return 429, {}
+        if draw < self.error_429 + self.error_502:
+            return 502, {}
+        return None, None
+
+    def matches(self, hedge, pmid):
+        return zlib.crc32(f'{hedge}:{pmid}'.encode('utf-8')) % self.hedge_ratio == 0
+
+    def save_history(self, pmids, webenv=None):
+        with self.lock:
+            webenv = webenv or f'REPLAY_{len(self.history)}'
+            saved = self.history.setdefault(webenv, [])
+            saved.append(pmids)
+            return webenv, len(saved)
+
+    def esearch(self, params):
+        term = params.get('term', '')
+        if params.get('usehistory') == 'y':
+            pmids = sorted(set(
+                pmid for ids in self.recorded_ids.values() for id_list in ids for pmid in id_list
+                if self.matches(term, pmid)
+            ), key=int)
+            webenv, query_key = self.save_history(pmids, params.get('WebEnv'))
+            retmax = int(params.get('retmax', 20))
+            return search_result(pmids[:retmax], len(pmids), webenv, query_key)
+        if '[UID] AND (' in term:
+            uids, hedge = term.split('[UID] AND (', 1)
+            pmids = [pmid for pmid in uids.split(',') if pmid]
+            return search_result([pmid for pmid in pmids if self.matches(hedge[:-1], pmid)])
+        contents = self.recordings.get(params.get('sort', 'relevance')) or self.recordings['relevance']
+        if not contents:
+            return error_result('No recorded responses')
+        return contents[zlib.crc32(term.encode('utf-8')) % len(contents)]
+
+    def efetch(self, params):
+        if 'WebEnv' in params:
+            pmids = self.history[params['WebEnv']][int(params.get('query_key', 1)) - 1]
+        else:
+            pmids = params.get('id', '').split(',')
+        retstart = int(params.get('retstart', 0))
+        pmids = pmids[retstart:retstart + int(params.get('retmax', 20))]
+        if params.get('rettype') == 'uilist':
+            ids = ''.join(f'<Id>{pmid}</Id>\n' for pmid in pmids)
+            return f'<?xml version="1.0" encoding="UTF-8" ?>\n<IdList>\n{ids}</IdList>\n'.encode('utf-8')
+        articles = ''.join(
+            f'<PubmedArticle><MedlineCitation><PMID>{pmid}</PMID><Article>'
+            f'<ArticleTitle>Article {pmid}</ArticleTitle></Article></MedlineCitation></PubmedArticle>\n'
+            for pmid in pmids
+        )
+        return f'<?xml version="1.0" encoding="UTF-8" ?>\n<PubmedArticleSet>\n{articles}</PubmedArticleSet>\n'.encode('utf-8')
+
+    def epost(self, params):
+        pmids = [pmid for pmid in params.get('id', '').split(',') if pmid]
+        webenv, query_key = self.save_history(pmids, params.get('WebEnv'))
+        return (
+            '<?xml version="1.0" encoding="UTF-8" ?>\n'
+            f'<ePostResult><QueryKey>{query_key}</QueryKey><WebEnv>{webenv}</WebEnv></ePostResult>\n'
+        ).encode('utf-8')
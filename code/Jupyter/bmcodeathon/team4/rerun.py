@@ -0,0 +1,104 @@
+"""
+Re-running an experiment with changed hedges, reusing its first stage IdLists and the counts of unchanged hedges
+"""
+import hashlib
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .idstore import IdListStore
+
+
+__all__ = (
+    'PriorExperiment',
+    'diff_hedges',
+    'hedge_hash',
+)
+
+HEDGES_NAME = 'hedges.csv'
+
+
+def hedge_hash(text):
+    """
+    Identify a hedge's text, ignoring differences in whitespace
+    """
+    return hashlib.sha1(' '.join(str(text).split()).encode('utf-8')).hexdigest()[:16]
+
+
+def diff_hedges(old, new):
+    """
+    Return the shortcodes of `new` whose text is the same in `old`, and those that are new or changed,
+    in the order of `new`.  Both are hedge frames indexed by Shortcode, as `Pipeline.load_hedges` returns.
+    """
+    old_hashes = {} if old is None else dict(
+        (shortcode, hedge_hash(text)) for shortcode, text in old['Hedge_text'].items()
+    )
+    unchanged = []
+    changed = []
+    for shortcode, text in new['Hedge_text'].items():
+        if old_hashes.get(shortcode) == hedge_hash(text):
+            unchanged.append(shortcode)
+        else:
+            changed.append(shortcode)
+    return unchanged, changed
+
+
+class PriorExperiment(object):
+    """
+    What a rerun takes from an earlier experiment: for each case that finished without errors,
+    its result count, its first stage IdList, and the counts and IdLists of the hedges that have not changed.
+
+    Hedges are compared with the hedges.csv the experiment saved.  Experiments from before it was saved
+    have no hedges to compare with, so every hedge counts as changed, and only the first stage is reused.
+    """
+    def __init__(self, path, hedges):
+        self.path = Path(path)
+        old = None
+        if (self.path / HEDGES_NAME).exists():
+            old = pd.read_csv(self.path / HEDGES_NAME, index_col='Shortcode')
+        self.unchanged, self.changed = diff_hedges(old, hedges)
+        self.hedges = list(hedges.index)
+        self.store = IdListStore(self.path).load()
+        self.cases = self.load_cases()
+
+    def load_cases(self):
+        """
+        Read the result count and unchanged hedge counts of each case that can be reused
+        """
+        results = pd.read_csv(self.path / 'results.csv', dtype={'bias_dimension': str})
+        keys = self.store.keys()
+        cases = {}
+        for (search_index, sort_order), rows in results.groupby(['search_index', 'sort'], sort=False):
+            if (rows.error_count > 0).any() or (str(search_index), sort_order, '') not in keys:
+                continue
+            counts = dict(zip(rows.bias_dimension, rows.bias_result_count))
+            if any(hedge not in counts for hedge in self.unchanged):
+                continue
+            cases[(str(search_index), sort_order)] = (int(rows.result_count.iloc[0]), counts)
+        return cases
+
+    def reusable(self, search_index, sort_order):
+        return (str(search_index), sort_order) in self.cases
+
+    def first_stage(self, search_index, sort_order):
+        """
+        Return the result count and first stage PMIDs of a reusable case
+        """
+        result_count, _ = self.cases[(str(search_index), sort_order)]
+        return result_count, np.array(self.store.get(search_index, sort_order))
+
+    def complete(self, idstore, search_index, sort_order, bias_counts):
+        """
+        Add the unchanged hedges' counts to those of the changed hedges, in the order of the hedge file,
+        and copy their IdLists to `idstore`
+        """
+        _, counts = self.cases[(str(search_index), sort_order)]
+        counts = dict(counts)
+        counts.update(bias_counts)
+        keys = self.store.keys()
+        for hedge in self.unchanged:
+            key = (str(search_index), sort_order, hedge)
+            if key in keys:
+                idstore.append(search_index, sort_order, hedge, self.store.get(*key))
+        return [(hedge, int(counts[hedge])) for hedge in self.hedges]
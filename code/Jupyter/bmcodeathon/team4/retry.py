@@ -0,0 +1,230 @@
+"""
+A delayed retry queue for cases that failed transiently, and a circuit breaker for the backend
+"""
+import asyncio
+import heapq
+import random
+import re
+import time
+from collections import deque
+
+import requests
+from aiohttp import ClientConnectionError
+
+from .tokenbucket import RETRY_STATUSES
+
+
+__all__ = (
+    'CircuitBreaker',
+    'Dispatcher',
+    'RetryQueue',
+    'TransientError',
+    'is_transient',
+    'is_transient_message',
+)
+
+# eSearchResult ERROR messages from a backend that failed this time, but may not the next
+TRANSIENT_MESSAGES = re.compile(
+    r'Search Backend failed|response processing error|HTTP request returned 5\d\d|'
+    r'temporarily unavailable|timed? ?out',
+    re.IGNORECASE,
+)
+
+
+class TransientError(Exception):
+    """
+    A response carried an ERROR that is likely to go away when the request is repeated
+    """
+
+
+def is_transient_message(message):
+    return bool(message) and TRANSIENT_MESSAGES.search(message) is not None
+
+
+def is_transient(exc):
+    """
+    Whether a case that raised `exc` is worth running again
+    """
+    if isinstance(exc, TransientError):
+        return True
+    response = getattr(exc, 'response', None)
+    status = getattr(response, 'status_code', None) or getattr(exc, 'status', None)
+    if isinstance(status, int):
+        return status in RETRY_STATUSES or status >= 500
+    return isinstance(exc, (ConnectionError, TimeoutError, asyncio.TimeoutError, requests.ConnectionError,
+                            requests.Timeout, ClientConnectionError))
+
+
+class RetryQueue(object):
+    """
+    Holds failed units of work until their backoff has passed.
+
+    The n-th retry waits about `backoff * 2**(n-1)` seconds, at most `max_delay`, with half of it jittered.
+    A unit is given up on after `attempts` retries, or once `deadline` seconds have passed since its first attempt.
+    """
+    def __init__(self, attempts=5, backoff=2.0, max_delay=60.0, deadline=600.0, seed=None):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.random = random.Random(seed)
+        self.heap = []
+        self.sequence = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def delay(self, attempt):
+        delay = min(self.max_delay, self.backoff * 2 ** (attempt - 1))
+        return delay / 2 + self.random.uniform(0, delay / 2)
+
+    def push(self, unit, attempt, started):
+        """
+        Queue `unit` for its `attempt`-th retry, and return the delay, or None if it should be given up on
+        """
+        if attempt > self.attempts:
+            return None
+        delay = self.delay(attempt)
+        ready = time.monotonic() + delay
+        if ready > started + self.deadline:
+            return None
+        heapq.heappush(self.heap, (ready, self.sequence, unit, attempt, started))
+        self.sequence += 1
+        return delay
+
+    def pop_ready(self):
+        """
+        Return the next (unit, attempt, started) whose backoff has passed, or None
+        """
+        if self.heap and self.heap[0][0] <= time.monotonic():
+            _, _, unit, attempt, started = heapq.heappop(self.heap)
+            return unit, attempt, started
+        return None
+
+    def wait_time(self):
+        """
+        Seconds until the next unit is ready, or None if the queue is empty
+        """
+        if not self.heap:
+            return None
+        return max(0.0, self.heap[0][0] - time.monotonic())
+
+
+class CircuitBreaker(object):
+    """
+    Stops dispatch while the backend is failing.
+
+    Once at least `threshold` of the last `window` outcomes are failures, the breaker opens, and dispatch
+    pauses for `cooldown` seconds.  Then one unit is let through as a probe: if it succeeds the breaker
+    closes, otherwise it opens again.
+
+    Each dispatched unit gets a ticket from `allow`, which its outcome is recorded with, so that units
+    still in flight when the breaker opened neither count towards the window nor stand in for the probe.
+    """
+    def __init__(self, window=20, threshold=0.5, cooldown=30.0):
+        self.window = window
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.outcomes = deque(maxlen=window)
+        self.opened = None
+        self.probe = None
+        self.open_count = 0
+        self.tickets = 0
+        # the last ticket handed out before the breaker last opened
+        self.epoch = 0
+
+    @property
+    def is_open(self):
+        return self.opened is not None
+
+    def open(self):
+        self.opened = time.monotonic()
+        self.open_count += 1
+        self.outcomes.clear()
+        self.epoch = self.tickets
+
+    def allow(self):
+        """
+        Return a ticket for another unit to be dispatched now, to record its outcome with, or None
+        """
+        if self.opened is not None:
+            if self.probe is not None or time.monotonic() < self.opened + self.cooldown:
+                return None
+        self.tickets += 1
+        if self.opened is not None:
+            self.probe = self.tickets
+        return self.tickets
+
+    def cancel(self, ticket):
+        """
+        Give back a ticket that was allowed but not used
+        """
+        if ticket == self.probe:
+            self.probe = None
+
+    def wait_time(self):
+        """
+        Seconds until the breaker lets a probe through, or None if it is closed or waiting on a probe
+        """
+        if self.opened is None or self.probe is not None:
+            return None
+        return max(0.0, self.opened + self.cooldown - time.monotonic())
+
+    def record(self, ticket, ok):
+        if ticket <= self.epoch:
+            # units dispatched before the breaker opened ran against the backend as it was then
+            return
+        if self.opened is not None:
+            if ticket == self.probe:
+                self.probe = None
+                if ok:
+                    self.opened = None
+                else:
+                    self.open()
+            return
+        self.outcomes.append(ok)
+        failures = self.outcomes.count(False)
+        if len(self.outcomes) == self.window and failures >= self.threshold * self.window:
+            self.open()
+
+
+class Dispatcher(object):
+    """
+    Chooses what to dispatch next: retries whose backoff has passed, then new units, while the breaker allows.
+    Each comes with the breaker's ticket, to record its outcome with.
+    """
+    def __init__(self, units, retries, breaker):
+        self.units = iter(units)
+        self.retries = retries
+        self.breaker = breaker
+        self.exhausted = False
+
+    @property
+    def done(self):
+        return self.exhausted and not self.retries
+
+    def next(self):
+        """
+        Return the next (unit, attempt, started, ticket) to dispatch, or None if nothing may go now
+        """
+        ticket = self.breaker.allow()
+        if ticket is None:
+            return None
+        item = self.retries.pop_ready()
+        if item is None and not self.exhausted:
+            unit = next(self.units, None)
+            if unit is None:
+                self.exhausted = True
+            else:
+                item = (unit, 0, time.monotonic())
+        if item is None:
+            self.breaker.cancel(ticket)
+            return None
+        return item + (ticket,)
+
+    def wait_time(self):
+        """
+        Seconds until something may be ready to dispatch, or None
+        """
+        times = [t for t in (self.retries.wait_time(), self.breaker.wait_time()) if t is not None]
+        return min(times) if times else None
@@ -0,0 +1,79 @@
+"""
+Sampling queries from the query log without loading it into memory
+"""
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+
+__all__ = (
+    'SAMPLE_COLUMNS',
+    'reservoir_sample',
+    'sample_key',
+)
+
+# the only columns of the query log that an experiment keeps
+SAMPLE_COLUMNS = ['search_id', 'query_term', 'result_count']
+
+
+def reservoir_sample(data_path, sep, num_queries, random_state, chunksize=10**6):
+    """
+    Sample `num_queries` rows with distinct query terms from the query log in one streaming pass.
+
+    Only `SAMPLE_COLUMNS` are read, `chunksize` rows at a time.  Duplicate query terms are
+    recognized by a 64-bit hash, and the sample is drawn with reservoir sampling (Algorithm R),
+    so the same `random_state` seed always gives the same sample.  The index of each row is its
+    row number in the query log, as it is when the log is loaded whole.
+    """
+    seen = set()
+    reservoir = None
+    num_distinct = 0
+    reader = pd.read_csv(
+        data_path,
+        sep=sep,
+        usecols=SAMPLE_COLUMNS,
+        dtype={'search_id': str, 'query_term': str},
+        chunksize=chunksize,
+    )
+    for chunk in reader:
+        chunk = chunk[chunk.query_term.notnull()].drop_duplicates(subset=['query_term'])
+        hashes = pd.util.hash_pandas_object(chunk.query_term, index=False).to_numpy()
+        is_new = np.fromiter((h not in seen for h in hashes), dtype=bool, count=len(hashes))
+        seen.update(hashes[is_new].tolist())
+        chunk = chunk[is_new]
+
+        if reservoir is None:
+            reservoir = chunk.iloc[:0]
+        # fill the reservoir, then replace entries with decreasing probability
+        num_fill = max(0, min(len(chunk), num_queries - len(reservoir)))
+        if num_fill:
+            reservoir = pd.concat([reservoir, chunk.iloc[:num_fill]])
+        rest = chunk.iloc[num_fill:]
+        if len(rest):
+            positions = np.arange(num_distinct + num_fill, num_distinct + len(chunk))
+            slots = random_state.randint(0, positions + 1)
+            accepted = np.flatnonzero(slots < num_queries)
+            if len(accepted):
+                # later rows replace earlier ones in the same slot, as they would one at a time
+                last = pd.Series(accepted, index=slots[accepted]).groupby(level=0).last()
+                targets, sources = last.index.to_numpy(), last.to_numpy()
+                index = reservoir.index.to_numpy().copy()
+                index[targets] = rest.index.to_numpy()[sources]
+                reservoir.iloc[targets] = rest.iloc[sources].to_numpy()
+                reservoir.index = index
+        num_distinct += len(chunk)
+
+    if reservoir is None:
+        return pd.DataFrame(columns=SAMPLE_COLUMNS)
+    return reservoir.sort_index()
+
+
+def sample_key(data_path, *args):
+    """
+    Identify a sample by the query log's path, size and modification time, and the sampling arguments
+    """
+    stat = os.stat(data_path)
+    parts = [os.path.abspath(data_path), stat.st_size, stat.st_mtime_ns] + list(args)
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:16]
@@ -0,0 +1,114 @@
+"""
+Running estimates of each hedge's relevance minus date_desc differential, for deciding when a sample is big enough
+"""
+import math
+from statistics import NormalDist
+
+import pandas as pd
+
+
+__all__ = (
+    'BiasEstimator',
+    'RunningMean',
+)
+
+
+class RunningMean(object):
+    """
+    The mean and variance of a stream of values, by Welford's method
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else float('nan')
+
+    def half_width(self, z):
+        """
+        Half the width of the normal confidence interval of the mean
+        """
+        if self.count < 2:
+            return float('inf')
+        return z * math.sqrt(self.variance / self.count)
+
+
+class BiasEstimator(object):
+    """
+    Estimates the mean differential of each hedge as cases finish, with the rules of `team4 analyze`:
+    a query counts once both its sorts have finished without errors and with results, and a hedge
+    compares only the queries where either sort matched it.
+
+    `converged` is true once every hedge has at least `min_comparisons` comparisons and a
+    `confidence` interval narrower than `width`.
+    """
+    def __init__(self, hedges, width, confidence=0.95, min_comparisons=30):
+        self.hedges = list(hedges)
+        self.width = width
+        self.confidence = confidence
+        self.min_comparisons = min_comparisons
+        self.z = NormalDist().inv_cdf((1 + confidence) / 2)
+        self.stats = dict((hedge, RunningMean()) for hedge in self.hedges)
+        self.pending = {}
+        self.queries = 0
+
+    def add(self, search_index, sort_order, result_count, error_count, bias_counts):
+        """
+        Add a finished case, or with a result_count of None, a case that failed
+        """
+        search_index = str(search_index)
+        ok = result_count is not None and result_count > 0 and error_count == 0
+        other = self.pending.pop(search_index, None)
+        if other is None:
+            self.pending[search_index] = (sort_order, ok, dict(bias_counts))
+            return
+        other_sort, other_ok, other_counts = other
+        if not (ok and other_ok):
+            return
+        self.queries += 1
+        counts = {sort_order: dict(bias_counts), other_sort: other_counts}
+        for hedge, stat in self.stats.items():
+            relevance = counts['relevance'].get(hedge, 0)
+            date_desc = counts['date_desc'].get(hedge, 0)
+            if relevance > 0 or date_desc > 0:
+                stat.add(relevance - date_desc)
+
+    def load(self, results_path):
+        """
+        Add the cases already in a results.csv
+        """
+        results = pd.read_csv(results_path, dtype={'bias_dimension': str})
+        for (search_index, sort_order), rows in results.groupby(['search_index', 'sort'], sort=False):
+            self.add(search_index, sort_order, int(rows.result_count.iloc[0]), int(rows.error_count.max()),
+                     zip(rows.bias_dimension, rows.bias_result_count))
+
+    def estimates(self):
+        """
+        A frame of each hedge's comparisons, mean differential, and confidence interval
+        """
+        rows = []
+        for hedge, stat in self.stats.items():
+            half_width = stat.half_width(self.z)
+            rows.append({
+                'bias_dimension': hedge,
+                'compared': stat.count,
+                'mean_differential': stat.mean if stat.count else float('nan'),
+                'low': stat.mean - half_width,
+                'high': stat.mean + half_width,
+            })
+        return pd.DataFrame(rows)
+
+    @property
+    def converged(self):
+        return all(
+            stat.count >= self.min_comparisons and 2 * stat.half_width(self.z) < self.width
+            for stat in self.stats.values()
+        )
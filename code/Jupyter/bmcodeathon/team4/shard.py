@@ -0,0 +1,185 @@
+"""
+Splitting an experiment's sample into shards, and merging the shards' results back together
+"""
+import csv
+import json
+import re
+import shutil
+from pathlib import Path
+
+import pandas as pd
+
+from .idstore import IdListStore
+from .rerun import HEDGES_NAME
+
+
+__all__ = (
+    'merge_shards',
+    'parse_shard',
+    'shard_dirname',
+    'shard_queries',
+)
+
+SHARD_PATTERN = re.compile(r'^shard-(\d+)-of-(\d+)$')
+
+
+def parse_shard(value):
+    """
+    Parse 'i/N' into (i, N), where shards are numbered from 0
+    """
+    try:
+        shard, num_shards = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise ValueError(f'{value}: shard should be i/N, e.g. 0/4')
+    if num_shards < 1 or not 0 <= shard < num_shards:
+        raise ValueError(f'{value}: shard should be from 0 to {num_shards - 1}')
+    return shard, num_shards
+
+
+def shard_dirname(shard, num_shards):
+    return f'shard-{shard}-of-{num_shards}'
+
+
+def shard_queries(queries, shard, num_shards):
+    """
+    Take every `num_shards`-th query of the sample, starting at `shard`, so that shards are disjoint and balanced
+    """
+    return queries.iloc[shard::num_shards]
+
+
+def find_shards(path):
+    """
+    Return the shard directories under an experiment, in shard order, checking that none are missing
+    """
+    shards = {}
+    for shard_path in Path(path).iterdir():
+        match = SHARD_PATTERN.match(shard_path.name)
+        if match and shard_path.is_dir():
+            shards[int(match.group(1))] = (int(match.group(2)), shard_path)
+    if not shards:
+        raise ValueError(f'{path}: no shard directories')
+    num_shards = set(num for num, _ in shards.values())
+    if len(num_shards) > 1:
+        raise ValueError(f'{path}: shards of different splits: {sorted(num_shards)}')
+    num_shards = num_shards.pop()
+    missing = sorted(set(range(num_shards)) - set(shards))
+    if missing:
+        raise ValueError(f'{path}: missing shards {missing} of {num_shards}')
+    return [shards[shard][1] for shard in range(num_shards)]
+
+
+def merge_queries(shard_paths):
+    """
+    Interleave the shards' queries back into the order of the sample they were taken from
+    """
+    shard_queries = [pd.read_csv(path / 'queries.csv', index_col=0, dtype={'search_id': str, 'query_term': str})
+                     for path in shard_paths]
+    num_shards = len(shard_queries)
+    order = [(position * num_shards + shard, shard, position)
+             for shard, queries in enumerate(shard_queries) for position in range(len(queries))]
+    order.sort()
+    return pd.concat([shard_queries[shard].iloc[[position]] for _, shard, position in order])
+
+
+def merge_results(shard_paths, queries, hedges):
+    """
+    Concatenate the shards' results.csv, ordered by query, sort, and hedge as in the sample and hedge file
+    """
+    from .pipeline import RESULT_COLUMNS, SORT_ORDERS
+
+    results = pd.concat([pd.read_csv(path / 'results.csv', dtype={'bias_dimension': str})
+                         for path in shard_paths], ignore_index=True)
+    query_order = dict((search_index, n) for n, search_index in enumerate(queries.index))
+    sort_order = dict((sort, n) for n, sort in enumerate(SORT_ORDERS))
+    hedge_order = dict((hedge, n) for n, hedge in enumerate(hedges))
+    results = results.assign(
+        _query=results.search_index.map(query_order),
+        _sort=results['sort'].map(sort_order),
+        _hedge=results.bias_dimension.map(hedge_order).fillna(len(hedge_order)),
+    )
+    results = results.sort_values(['_query', '_sort', '_hedge'], kind='stable')
+    return results[RESULT_COLUMNS]
+
+
+def merge_stats(shard_paths):
+    """
+    Combine the last snapshot of each shard: counters and histogram counts and sums add up, and
+    quantiles are the largest of any shard, an upper bound
+    """
+    merged = {'time': 0.0, 'elapsed': 0.0, 'counters': {}, 'histograms': {}}
+    for path in shard_paths:
+        stats_path = path / 'stats.jsonl'
+        if not stats_path.exists():
+            continue
+        lines = stats_path.read_text().splitlines()
+        if not lines:
+            continue
+        snapshot = json.loads(lines[-1])
+        merged['time'] = max(merged['time'], snapshot['time'])
+        merged['elapsed'] = max(merged['elapsed'], snapshot['elapsed'])
+        for name, value in snapshot['counters'].items():
+            merged['counters'][name] = merged['counters'].get(name, 0) + value
+        for name, histogram in snapshot['histograms'].items():
+            total = merged['histograms'].setdefault(name, {'count': 0, 'sum': 0.0, 'p50': None, 'p99': None})
+            total['count'] += histogram['count']
+            total['sum'] += histogram['sum']
+            for q in ('p50', 'p99'):
+                if histogram[q] is not None:
+                    total[q] = histogram[q] if total[q] is None else max(total[q], histogram[q])
+    return merged
+
+
+def merge_idlists(shard_paths, output_path, queries, hedges):
+    from .pipeline import SORT_ORDERS
+
+    stores = [IdListStore(path).load() for path in shard_paths]
+    merged = IdListStore(output_path).open_for_append()
+    try:
+        for search_index in queries.index:
+            for sort_order in SORT_ORDERS:
+                for hedge in [''] + list(hedges):
+                    key = (str(search_index), sort_order, hedge)
+                    for store in stores:
+                        if key in store.index:
+                            merged.append(search_index, sort_order, hedge, store.get(*key))
+                            break
+    finally:
+        merged.close()
+
+
+def merge_shards(path, hedges):
+    """
+    Merge the shards under experiment `path` into the experiment itself, as if it had been run by one process.
+
+    `hedges` is the list of hedge shortcodes, in the order of the hedge file, which orders the results.
+    """
+    path = Path(path)
+    shard_paths = find_shards(path)
+    seeds = set((shard_path / 'seed.txt').read_text().strip() for shard_path in shard_paths)
+    if len(seeds) > 1:
+        raise ValueError(f'{path}: shards were sampled with different seeds: {sorted(seeds)}')
+
+    queries = merge_queries(shard_paths)
+    queries.to_csv(path / 'queries.csv')
+    (path / 'seed.txt').write_text(seeds.pop())
+    if (shard_paths[0] / HEDGES_NAME).exists():
+        shutil.copyfile(shard_paths[0] / HEDGES_NAME, path / HEDGES_NAME)
+
+    results = merge_results(shard_paths, queries, hedges)
+    partial_path = path / 'results.partial'
+    results.to_csv(partial_path, index=False, quoting=csv.QUOTE_ALL, lineterminator='\n')
+    partial_path.replace(path / 'results.csv')
+
+    with open(path / 'error_log.txt', 'w') as f:
+        for shard_path in shard_paths:
+            error_path = shard_path / 'error_log.txt'
+            if error_path.exists():
+                f.write(error_path.read_text())
+
+    with open(path / 'stats.jsonl', 'w') as f:
+        print(json.dumps(merge_stats(shard_paths)), file=f)
+
+    for name in ('idlists.bin', 'idlists.idx'):
+        (path / name).unlink(missing_ok=True)
+    merge_idlists(shard_paths, path, queries, hedges)
+    return results
@@ -0,0 +1,162 @@
+"""
+The progress of an experiment, read from the end of its files, without pandas, for polling a run cheaply
+"""
+import csv
+import io
+import os
+from pathlib import Path
+
+
+__all__ = (
+    'ExperimentStatus',
+    'count_lines',
+    'tail_lines',
+)
+
+# how much of the end of results.csv is read for the latest cases and their errors
+TAIL_BYTES = 256 * 1024
+
+CHUNK_BYTES = 1024 * 1024
+
+
+def count_lines(path):
+    """
+    Count the lines of a file by scanning its bytes, without decoding or parsing them
+    """
+    lines = 0
+    last = b'\n'
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_BYTES)
+            if not chunk:
+                break
+            lines += chunk.count(b'\n')
+            last = chunk[-1:]
+    # a last line without its newline still counts
+    return lines + (last != b'\n')
+
+
+def tail_lines(path, max_bytes=None):
+    """
+    Return the whole lines in the last `max_bytes` bytes of a file, by default TAIL_BYTES
+    """
+    max_bytes = TAIL_BYTES if max_bytes is None else max_bytes
+    with open(path, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        start = max(0, size - max_bytes)
+        # read from the byte before the tail, to tell whether its first line is whole
+        f.seek(max(0, start - 1))
+        content = f.read()
+    if start > 0:
+        content = content[content.find(b'\n') + 1:] if b'\n' in content else b''
+    return content.decode('utf-8', errors='replace').splitlines()
+
+
+class ExperimentStatus(object):
+    """
+    How far an experiment has got: the cases in its results.csv out of the two for each query in
+    queries.csv, and the errors among the latest of them.
+
+    Only the end of results.csv is parsed.  The cases before it are counted from its lines, since
+    every case writes one row per hedge.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.queries = self.count_queries()
+        self.hedges = self.count_hedges()
+        self.tail = self.read_tail()
+        if self.hedges is None:
+            # without the hedges.csv snapshot, the most rows a case has in the tail will do
+            self.hedges = max((len(rows) for _, rows in self.tail), default=0) or None
+        self.rows = 0
+        if (self.path / 'results.csv').exists():
+            self.rows = max(0, count_lines(self.path / 'results.csv') - 1)
+
+    def count_queries(self):
+        if not (self.path / 'queries.csv').exists():
+            return None
+        with open(self.path / 'queries.csv', newline='') as f:
+            return max(0, sum(1 for _ in csv.reader(f)) - 1)
+
+    def count_hedges(self):
+        if not (self.path / 'hedges.csv').exists():
+            return None
+        with open(self.path / 'hedges.csv', newline='') as f:
+            return max(0, sum(1 for _ in csv.reader(f)) - 1)
+
+    def read_tail(self):
+        """
+        The latest cases in results.csv, as (case, rows) in the order they were written
+        """
+        path = self.path / 'results.csv'
+        if not path.exists():
+            return []
+        truncated = path.stat().st_size > TAIL_BYTES
+        lines = tail_lines(path)
+        if not truncated:
+            lines = lines[1:]
+        cases = []
+        for row in csv.reader(io.StringIO('\n'.join(lines)), dialect='unix'):
+            if len(row) < 7:
+                continue
+            case = (row[0], row[1])
+            if cases and cases[-1][0] == case:
+                cases[-1][1].append(row)
+            else:
+                cases.append((case, [row]))
+        # the first case in a tail that starts partway may be missing rows, so leave it out
+        return cases[1:] if truncated else cases
+
+    @property
+    def total_cases(self):
+        return None if self.queries is None else 2 * self.queries
+
+    @property
+    def completed_cases(self):
+        return self.rows // self.hedges if self.hedges else 0
+
+    @property
+    def missing_cases(self):
+        return None if self.total_cases is None else max(0, self.total_cases - self.completed_cases)
+
+    @property
+    def latest_case(self):
+        return self.tail[-1][0] if self.tail else None
+
+    def recent_errors(self):
+        """
+        Return how many of the latest cases had errors, and how many cases that is out of
+        """
+        errors = sum(1 for _, rows in self.tail if any(row[4] not in ('', '0') for row in rows))
+        return errors, len(self.tail)
+
+    def error_log(self, num_lines=5):
+        """
+        Return the last lines of error_log.txt
+        """
+        path = self.path / 'error_log.txt'
+        if not path.exists():
+            return []
+        return [line for line in tail_lines(path, 64 * 1024) if line.strip()][-num_lines:]
+
+    def summary(self):
+        """
+        Lines describing the experiment's progress
+        """
+        lines = [str(self.path)]
+        if self.total_cases is None:
+            lines.append(f'{self.completed_cases} cases completed; no queries.csv to count the sample from')
+        else:
+            percent = 100 * self.completed_cases / self.total_cases if self.total_cases else 100
+            lines.append(f'{self.completed_cases} of {self.total_cases} cases completed ({percent:.1f}%), '
+                         f'{self.missing_cases} missing')
+        if self.latest_case is not None:
+            lines.append(f'latest case: {", ".join(self.latest_case)}')
+        errors, cases = self.recent_errors()
+        if cases:
+            lines.append(f'errors in {errors} of the latest {cases} cases ({100 * errors / cases:.1f}%)')
+        log = self.error_log()
+        if log:
+            lines.append('end of error_log.txt:')
+            lines.extend('  ' + line for line in log)
+        return lines
@@ -2,26 +2,76 @@
 An implementation of the Token Bucket algorithm
 """
 # NOTE: This code was adapted from https://github.com/porterjamesj/tokenbucket/blob/master/tokenbucket.py,
-#       but modified to add a backoff that appears to be needed on Windows.
+#       but modified to reserve tokens under the lock and sleep outside of it, and to sleep
+#       until a deadline, since time.sleep can wake early on Windows.
+import asyncio
 import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from threading import Lock
 from requests import Session
 
 
 __all__ = (
     'TokenBucket',
+    'AsyncTokenBucket',
     'RateLimitedSession',
+    'key_rejected',
+    'retry_after',
 )
 
+# status codes that mean the server is overloaded, and the request may be retried
+RETRY_STATUSES = {429, 502, 503}
+
+# statuses with which the server turns away a request whose API key is invalid
+REJECTED_STATUSES = {400, 401, 403}
+
+
+def retry_after(headers):
+    """
+    Return the number of seconds asked for by a Retry-After header, or None
+    """
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def key_rejected(status, content):
+    """
+    Return whether a response says that its API key is invalid, rather than that the request is
+    """
+    return status in REJECTED_STATUSES and b'API key' in content
+
 
 class TokenBucket(object):
+    """
+    A token bucket whose rate adapts to the server.
 
-    def __init__(self, rate=1, tokens=0, capacity=100):
+    Callers reserve tokens under the lock, which may leave the bucket in debt, and then wait
+    for their slot outside of it.  Slots are handed out in the order callers reserve them.
+    `penalize` cuts the rate multiplicatively when the server pushes back, and `reward` raises it
+    additively after each success, up to the configured rate.
+    """
+
+    def __init__(self, rate=1, tokens=0, capacity=100, min_rate=None, decrease=0.5, increase=None):
         # immutable attributes
         self.lock = Lock()
-        self._rate = rate
+        self._max_rate = rate
+        self._min_rate = min_rate if min_rate else rate / 10
+        self._decrease = decrease
+        self._increase = increase if increase else rate / 100
         self._capacity = capacity
         # mutable attributes
+        self._rate = rate
         self._tokens = tokens
         self._time = time.monotonic()
 
@@ -29,6 +79,10 @@ class TokenBucket(object):
     def rate(self):
         return self._rate
 
+    @property
+    def max_rate(self):
+        return self._max_rate
+
     @property
     def capacity(self):
         return self._capacity
@@ -55,38 +109,106 @@ class TokenBucket(object):
             self._adjust()
             return self._tokens
 
+    def delay(self, tokens):
+        """
+        Return how many seconds a caller reserving `tokens` tokens now would wait, without reserving them
+        """
+        with self.lock:
+            self._adjust()
+            return max(0.0, (tokens - self._tokens) / self._rate)
+
+    def reserve(self, tokens):
+        """
+        Take `tokens` tokens from the bucket, and return how many seconds the caller must wait before using them
+        """
+        with self.lock:
+            self._adjust()
+            self._tokens -= tokens
+            return max(0.0, -self._tokens / self._rate)
+
     def consume(self, tokens):
         """
         Consume `tokens` tokens from the bucket, blocking until they are
         available
         """
+        deadline = time.monotonic() + self.reserve(tokens)
+        remaining = deadline - time.monotonic()
+        while remaining > 0:
+            time.sleep(remaining)
+            remaining = deadline - time.monotonic()
+
+    def penalize(self):
+        """
+        Cut the rate after the server pushed back
+        """
         with self.lock:
             self._adjust()
-            self._tokens -= tokens
-            backoff = 1
-            while self._tokens < 0:
-                to_sleep = backoff * (-self._tokens / self._rate)
-                time.sleep(to_sleep)
+            self._rate = max(self._min_rate, self._rate * self._decrease)
+
+    def reward(self):
+        """
+        Probe back up towards the configured rate after a success
+        """
+        if self._rate < self._max_rate:
+            with self.lock:
                 self._adjust()
-                backoff += 1
+                self._rate = min(self._max_rate, self._rate + self._increase)
+
+    def pause(self, seconds):
+        """
+        Hand out no new slots for `seconds` seconds, e.g. to honor Retry-After
+        """
+        with self.lock:
+            self._adjust()
+            self._tokens = min(self._tokens, -seconds * self._rate)
+
+
+class AsyncTokenBucket(TokenBucket):
+    """
+    A token bucket for use from coroutines on a single event loop.
+    """
+
+    async def consume(self, tokens):
+        """
+        Consume `tokens` tokens from the bucket, awaiting until they are
+        available
+
+        The tokens are reserved before waiting, so each caller waits for its own slot
+        and the event loop is free to run other coroutines in the meantime.
+        """
+        wait = self.reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
 
 
 class RateLimitedSession(Session):
-    def __init__(self, session=None, tokenbucket=None, rate=1, tokens=0, capacity=100, backoff=2.0,
-                 *args, **kwargs):
+    def __init__(self, session=None, tokenbucket=None, rate=1, tokens=0, capacity=100, backoff=2.0, retries=3,
+                 metrics=None, keypool=None, *args, **kwargs):
         """Creates a TokenBucketSession
 
         Notes
         ~~~~~
 
         * If you provide a `tokenbucket`, then the `rate`, `tokens`, and `capacity` arguments are ignored.
+        * Responses with status 429, 502, or 503 are retried up to `retries` times.  Each one cuts the
+          bucket's rate, and a 429 also pauses the bucket for its Retry-After, or `backoff` seconds.
+        * If you provide `metrics`, the time spent waiting for tokens and on each request, and the
+          status of each response, are recorded there.
+        * If you provide a `keypool`, each request is sent with the API key whose token comes soonest,
+          and the pool stands in for the token bucket.  A request turned away because of its key is
+          retried with another.
         """
         super(RateLimitedSession, self).__init__(*args, **kwargs)
-        if tokenbucket is None:
+        if keypool is not None:
+            tokenbucket = keypool
+        elif tokenbucket is None:
             tokenbucket  = TokenBucket(rate=rate, tokens=tokens, capacity=capacity)
         self.tokenbucket = tokenbucket
+        self.keypool = keypool
         self.session = session
         self.backoff = backoff
+        self.retries = retries
+        self.metrics = metrics
 
     def request(self, *args, **kwargs):
         """Maintains the existing api for Session.request.
@@ -97,9 +219,47 @@ class RateLimitedSession(Session):
             func = self.session.request
         else:
             func = super(RateLimitedSession, self).request
-        self.tokenbucket.consume(1)
-        r = func(*args, **kwargs)
-        if r.status_code == 429:
-            time.sleep(self.backoff)
+        metrics = self.metrics
+        keypool = self.keypool
+        key = None
+        for attempt in range(self.retries + 1):
+            stime = time.perf_counter()
+            if keypool is not None:
+                key, bucket = keypool.consume()
+                kwargs['params'] = {**(kwargs.get('params') or {}), 'api_key': key}
+            else:
+                bucket = self.tokenbucket
+                bucket.consume(1)
+            sent = time.perf_counter()
             r = func(*args, **kwargs)
+            if metrics is not None:
+                metrics.observe('token_wait_seconds', sent - stime)
+                metrics.observe('http_request_seconds', time.perf_counter() - sent)
+                metrics.inc('http_responses_total', status=r.status_code)
+                if r.status_code in RETRY_STATUSES and attempt < self.retries:
+                    metrics.inc('http_retries_total', status=r.status_code)
+            if key is not None and key_rejected(r.status_code, r.content):
+                removed = keypool.reject(key)
+                if metrics is not None:
+                    metrics.inc('api_key_rejected_total', key=keypool.label(key))
+                    if removed:
+                        metrics.inc('api_keys_removed_total')
+                if removed and attempt < self.retries:
+                    continue
+                break
+            if r.status_code not in RETRY_STATUSES:
+                bucket.reward()
+                if key is not None:
+                    keypool.succeeded(key)
+                break
+            bucket.penalize()
+            if r.status_code == 429:
+                delay = retry_after(r.headers)
+                bucket.pause(self.backoff if delay is None else delay)
+            if key is not None:
+                removed = keypool.pushed_back(key, r.status_code)
+                if metrics is not None:
+                    metrics.inc('api_key_pushback_total', key=keypool.label(key), status=r.status_code)
+                    if removed:
+                        metrics.inc('api_keys_removed_total')
         return r
@@ -0,0 +1,197 @@
+import json
+import re
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+from lxml import etree
+
+
+SEARCH_RESULT = """\
+<?xml version="1.0" encoding="UTF-8" ?>
+<eSearchResult><Count>{count}</Count><RetMax>{retmax}</RetMax><RetStart>0</RetStart>{history}<IdList>
+{ids}
+</IdList></eSearchResult>
+"""
+
+FETCH_RESULT = """\
+<?xml version="1.0" encoding="UTF-8" ?>
+<IdList>
+{ids}
+</IdList>
+"""
+
+ARTICLE = """\
+<PubmedArticle><MedlineCitation><PMID>{pmid}</PMID><Article><ArticleTitle>{title}</ArticleTitle>
+<Abstract><AbstractText>{abstract}</AbstractText></Abstract></Article>
+<MeshHeadingList><MeshHeading><DescriptorName>{mesh}</DescriptorName></MeshHeading></MeshHeadingList>
+</MedlineCitation></PubmedArticle>
+"""
+
+# every PMID the stand-in knows about, and the ones that any hedge matches
+FIRST_STAGE_PMIDS = list(range(1000, 1010))
+HEDGE_PMIDS = [pmid for pmid in range(900, 1100) if pmid % 3 == 0]
+
+# a search limited to publication dates, as hedgeindex splits large searches
+DATE_RANGE = re.compile(r'"(\d{4})/(\d\d)/(\d\d)"\[PDAT\] : "(\d{4})/(\d\d)/(\d\d)"\[PDAT\]')
+
+
+def published(pmid):
+    """
+    The publication date of a PMID: one a day, from 2000
+    """
+    return date(2000, 1, 1) + timedelta(days=pmid)
+
+
+def date_filter(term, pmids):
+    match = DATE_RANGE.search(term)
+    if match is None:
+        return pmids
+    parts = [int(part) for part in match.groups()]
+    first, last = date(*parts[:3]), date(*parts[3:])
+    return [pmid for pmid in pmids if first <= published(pmid) <= last]
+
+
+def article(pmid):
+    """
+    The record of a PMID: those that hedges match are about older adults
+    """
+    if pmid in HEDGE_PMIDS:
+        return ARTICLE.format(pmid=pmid, title='Falls in older adults', abstract='Elderly patients.', mesh='Aged')
+    return ARTICLE.format(pmid=pmid, title='Falls in children', abstract='Young patients.', mesh='Child')
+
+
+def search_result(pmids, count=None, history=''):
+    ids = '\n'.join(f'<Id>{pmid}</Id>' for pmid in pmids)
+    count = len(pmids) if count is None else count
+    return SEARCH_RESULT.format(count=count, retmax=len(pmids), history=history, ids=ids).encode('utf-8')
+
+
+def json_search_result(body):
+    """
+    The JSON form of an XML esearch result
+    """
+    xml = etree.fromstring(body)
+    if xml.find('ERROR') is not None:
+        result = {'ERROR': xml.findtext('ERROR')}
+    else:
+        result = {'count': xml.findtext('Count'), 'idlist': [element.text for element in xml.iterfind('IdList/Id')]}
+    return json.dumps({'header': {'type': 'esearch'}, 'esearchresult': result}).encode('utf-8')
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers esearch with ten PMIDs for a first stage search, and with the PMIDs divisible by 3
+    for a hedge search.  A search with history saves the hedge set, which efetch pages through.
+    """
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.handle_eutils(url, parse_qs(url.query))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        self.handle_eutils(url, parse_qs(self.rfile.read(length).decode('utf-8')))
+
+    def handle_eutils(self, url, params):
+        self.server.requests.append((url.path, params))
+        time.sleep(self.server.latency)
+        if self.server.failures:
+            status, headers = self.server.failures.pop(0)
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        term = params.get('term', [''])[0]
+        if self.server.search_errors and url.path.endswith('esearch.fcgi'):
+            message = self.server.search_errors.pop(0)
+            body = f'<?xml version="1.0" ?>\n<eSearchResult><ERROR>{message}</ERROR></eSearchResult>\n'.encode('utf-8')
+        elif url.path.endswith('epost.fcgi'):
+            self.server.posted.append([int(pmid) for pmid in params['id'][0].split(',')])
+            body = (f'<?xml version="1.0" ?>\n<ePostResult><QueryKey>{len(self.server.posted)}</QueryKey>'
+                    '<WebEnv>STUB</WebEnv></ePostResult>\n').encode('utf-8')
+        elif url.path.endswith('efetch.fcgi') and params.get('rettype') != ['uilist']:
+            if 'id' in params:
+                pmids = [int(pmid) for pmid in params['id'][0].split(',')]
+            else:
+                retstart = int(params['retstart'][0])
+                retmax = int(params['retmax'][0])
+                pmids = self.server.posted[int(params['query_key'][0]) - 1][retstart:retstart+retmax]
+            articles = ''.join(article(pmid) for pmid in pmids)
+            body = f'<?xml version="1.0" ?>\n<PubmedArticleSet>\n{articles}</PubmedArticleSet>\n'.encode('utf-8')
+        elif url.path.endswith('efetch.fcgi'):
+            retstart = int(params['retstart'][0])
+            retmax = int(params['retmax'][0])
+            saved = self.server.searches[int(params['query_key'][0]) - 1]
+            if self.server.retrieval_cap is not None and retstart >= self.server.retrieval_cap:
+                body = (b'<?xml version="1.0" ?>\n<eFetchResult><ERROR>Search Backend failed: '
+                        b'retstart cannot be larger than 9998</ERROR></eFetchResult>\n')
+            else:
+                page = saved[retstart:retstart+retmax][:self.server.page_limit]
+                body = FETCH_RESULT.format(ids='\n'.join(f'<Id>{pmid}</Id>' for pmid in page)).encode('utf-8')
+        elif params.get('usehistory') == ['y']:
+            pmids = date_filter(term, HEDGE_PMIDS)
+            self.server.searches.append(pmids)
+            history = f'<QueryKey>{len(self.server.searches)}</QueryKey><WebEnv>STUB</WebEnv>'
+            body = search_result([], count=len(pmids), history=history)
+        elif '[UID] AND (' in term:
+            pmids = [int(pmid) for pmid in term.split('[UID]')[0].split(',') if pmid]
+            body = search_result([pmid for pmid in pmids if pmid in HEDGE_PMIDS])
+        elif term.startswith('(') and ') AND (' in term:
+            # PMIDs ORed together, as best_match_comp_counter.py searched them
+            pmids = [int(pmid) for pmid in term[1:term.index(')')].split(' OR ')]
+            body = search_result([pmid for pmid in pmids if pmid in HEDGE_PMIDS])
+        else:
+            body = search_result(FIRST_STAGE_PMIDS, count=12345)
+        content_type = 'text/xml; charset=UTF-8'
+        if params.get('retmode') == ['json'] and url.path.endswith('esearch.fcgi'):
+            body = json_search_result(body)
+            content_type = 'application/json; charset=UTF-8'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    # room for every connection a run with max_workers: auto opens at once
+    request_queue_size = 128
+
+
+@pytest.fixture
+def eutils_server():
+    """
+    A local stand-in for the E-Utilities; pass `eutils_server.prefix` to EUtils
+    """
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    server.requests = []
+    # (status, headers) to answer the next requests with, instead of a result
+    server.failures = []
+    # ID lists posted with epost
+    server.posted = []
+    # ERROR messages to answer the next searches with
+    server.search_errors = []
+    # the PMIDs of each search saved on the history server
+    server.searches = []
+    # efetch answers pages from this retstart on with an ERROR, as PubMed does past 9,999
+    server.retrieval_cap = None
+    # the most UIDs efetch returns in a page, to make pages come back short
+    server.page_limit = None
+    # seconds added to every response
+    server.latency = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address
+    server.prefix = f'http://{host}:{port}/entrez'
+    yield server
+    server.shutdown()
+    server.server_close()
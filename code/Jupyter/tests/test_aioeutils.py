@@ -0,0 +1,33 @@
+import asyncio
+import time
+
+from bmcodeathon.team4 import AsyncEUtils
+from bmcodeathon.team4.tokenbucket import AsyncTokenBucket
+
+
+def test_async_bucket_paces_consumers():
+    bucket = AsyncTokenBucket(rate=50, tokens=1, capacity=1)
+
+    async def consume_all():
+        await asyncio.gather(*(bucket.consume(1) for _ in range(11)))
+
+    stime = time.perf_counter()
+    asyncio.run(consume_all())
+    elapsed = time.perf_counter() - stime
+    assert 0.18 < elapsed < 0.5
+
+
+def test_esearch(eutils_server):
+    async def search():
+        async with AsyncEUtils(rate=100, prefix=eutils_server.prefix) as eutils:
+            results = await asyncio.gather(*(
+                eutils.esearch('pubmed', term=f'query {i}', retmax=10) for i in range(5)
+            ))
+            return eutils.call_count, results
+
+    call_count, results = asyncio.run(search())
+    assert call_count == 5
+    for r in results:
+        assert r.status_code == 200
+        assert [e.text for e in r.xml.xpath('//IdList/Id')][:2] == ['1000', '1001']
+        assert r.webenv is None
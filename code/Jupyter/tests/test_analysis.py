@@ -0,0 +1,115 @@
+import numpy as np
+import pandas as pd
+
+from bmcodeathon.team4 import cli
+from bmcodeathon.team4.analysis import analyze, rank_curves
+
+
+def write_results(path, rows):
+    path.mkdir()
+    columns = ['search_index', 'sort', 'result_count', 'return_count', 'error_count',
+               'bias_dimension', 'bias_result_count']
+    pd.DataFrame(rows, columns=columns).to_csv(path / 'results.csv', index=False)
+
+
+def test_analyze(tmp_path):
+    write_results(tmp_path / 'first', [
+        (1, 'relevance', 50, 50, 0, 'race', 5),
+        (1, 'date_desc', 50, 50, 0, 'race', 2),
+        (2, 'relevance', 50, 50, 0, 'race', 0),
+        (2, 'date_desc', 50, 50, 0, 'race', 0),
+        (3, 'relevance', 50, 50, 1, 'race', 9),
+        (3, 'date_desc', 50, 50, 0, 'race', 1),
+    ])
+    write_results(tmp_path / 'second', [
+        (1, 'relevance', 50, 50, 0, 'kids', 1),
+        (1, 'date_desc', 50, 50, 0, 'kids', 4),
+    ])
+
+    bias = analyze([tmp_path / 'first', tmp_path / 'second' / 'results.csv'])
+
+    assert bias.counts.shape == (4, 2, 2)
+    assert list(bias.excluded) == [False, False, True, False]
+    histograms = bias.histograms()
+    assert histograms.astype({'experiment': str, 'bias_dimension': str}).values.tolist() == [
+        ['first', 'race', 3, 1],
+        ['second', 'kids', -3, 1],
+    ]
+    summary = bias.summary().set_index(['experiment', 'bias_dimension'])
+    assert summary.loc[('first', 'race'), 'compared'] == 1
+    assert summary.loc[('first', 'race'), 'excluded'] == 1
+    assert summary.loc[('second', 'race'), 'compared'] == 0
+
+
+def test_cli(tmp_path, capsys):
+    write_results(tmp_path / 'first', [
+        (1, 'relevance', 50, 50, 0, 'race', 5),
+        (1, 'date_desc', 50, 50, 0, 'race', 2),
+    ])
+    output_path = tmp_path / 'histograms.csv'
+    cli.main(['team4', 'analyze', str(tmp_path / 'first'), '-o', str(output_path)])
+    assert 'mean_differential' in capsys.readouterr().out
+    assert pd.read_csv(output_path)['count'].tolist() == [1]
+
+
+def write_idlists(path, idlists):
+    from bmcodeathon.team4.idstore import IdListStore
+
+    store = IdListStore(path).open_for_append()
+    for (search_index, sort_order, hedge), pmids in idlists.items():
+        store.append(search_index, sort_order, hedge, np.array(pmids, dtype=np.uint32))
+    store.close()
+
+
+def test_rank_curves(tmp_path):
+    write_results(tmp_path / 'first', [
+        (1, 'relevance', 50, 4, 0, 'race', 2),
+        (1, 'date_desc', 50, 4, 0, 'race', 1),
+        (2, 'relevance', 50, 3, 0, 'race', 1),
+        (2, 'date_desc', 50, 3, 0, 'race', 1),
+    ])
+    write_idlists(tmp_path / 'first', {
+        (1, 'relevance', None): [10, 11, 12, 13],
+        (1, 'relevance', 'race'): [10, 13],
+        (1, 'date_desc', None): [20, 21, 22, 23],
+        (1, 'date_desc', 'race'): [22],
+        (2, 'relevance', None): [30, 31, 32],
+        (2, 'relevance', 'race'): [32],
+        # query 2 is missing its date_desc hedge IdList
+        (2, 'date_desc', None): [32, 31, 30],
+    })
+
+    curves = rank_curves([tmp_path / 'first'])
+
+    assert curves.hits.shape == (2, 2, 1, 4)
+    assert curves.hits[0, 0, 0].tolist() == [1, 1, 1, 2]
+    assert curves.hits[0, 1, 0].tolist() == [0, 0, 1, 1]
+    # shorter IdLists keep their last count
+    assert curves.hits[1, 0, 0].tolist() == [0, 0, 1, 1]
+    assert list(curves.bias.excluded) == [False, True]
+    assert (curves.bias_at(4).counts == analyze([tmp_path / 'first']).counts)[0].all()
+
+    summary = curves.summary([1, 2, 3]).set_index('cutoff')
+    assert summary.compared.tolist() == [1, 1, 1]
+    assert summary.mean_differential.tolist() == [1.0, 1.0, 0.0]
+
+    table = curves.curves()
+    assert table['rank'].tolist() == [1, 2, 3, 4]
+    assert table.relevance.tolist() == [1, 1, 1, 2]
+
+
+def test_cli_cutoffs(tmp_path, capsys):
+    write_results(tmp_path / 'first', [
+        (1, 'relevance', 50, 2, 0, 'race', 1),
+        (1, 'date_desc', 50, 2, 0, 'race', 1),
+    ])
+    write_idlists(tmp_path / 'first', {
+        (1, 'relevance', None): [10, 11],
+        (1, 'relevance', 'race'): [10],
+        (1, 'date_desc', None): [20, 21],
+        (1, 'date_desc', 'race'): [21],
+    })
+    curves_path = tmp_path / 'curves.csv'
+    cli.main(['team4', 'analyze', str(tmp_path / 'first'), '--cutoffs', '1,2', '--curves', str(curves_path)])
+    assert 'cutoff' in capsys.readouterr().out
+    assert pd.read_csv(curves_path).date_desc.tolist() == [0, 1]
@@ -0,0 +1,203 @@
+"""
+End-to-end throughput of Pipeline.run against the replay server.
+
+The defaults keep this quick enough for every test run.  For numbers worth comparing, scale it up, e.g.
+
+    TEAM4_BENCH_QUERIES=200 TEAM4_BENCH_LATENCY=0.2 TEAM4_BENCH_OUTPUT=bench.jsonl pytest -s tests/test_benchmark.py
+
+Each run reports calls/sec, p50/p99 call latency, and peak RSS, and appends them to
+TEAM4_BENCH_OUTPUT as a JSON line when that is set.  The parsing benchmark compares reading the recorded
+esearch responses into a SearchResult with parsing them into a tree, and the startup benchmark times the
+quick commands, status and validate-config, checking that they import none of pandas, numpy, or the HTTP clients.
+"""
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+from lxml import etree
+
+from bmcodeathon.team4 import AsyncEUtils, Config, EUtils, Pipeline
+from bmcodeathon.team4.eutils import parse_search_result
+from bmcodeathon.team4.replay import ReplayServer
+
+
+DATA_PATH = Path(__file__).resolve().parents[3] / 'data'
+RECORDINGS_PATH = DATA_PATH / 'results' / 'sample-1'
+
+NUM_QUERIES = int(os.environ.get('TEAM4_BENCH_QUERIES', 10))
+LATENCY = float(os.environ.get('TEAM4_BENCH_LATENCY', 0.02))
+RATE_LIMIT = int(os.environ.get('TEAM4_BENCH_RATE', 200))
+MAX_WORKERS = int(os.environ.get('TEAM4_BENCH_WORKERS', 16))
+PARSE_REPEATS = int(os.environ.get('TEAM4_BENCH_PARSE_REPEATS', 5))
+
+
+@pytest.fixture
+def call_latencies(monkeypatch):
+    """
+    Time every EUtils and AsyncEUtils request
+    """
+    latencies = []
+    call, async_call = EUtils.fetch, AsyncEUtils.fetch
+
+    def timed_call(self, *args, **kwargs):
+        stime = time.perf_counter()
+        try:
+            return call(self, *args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - stime)
+
+    async def timed_async_call(self, *args, **kwargs):
+        stime = time.perf_counter()
+        try:
+            return await async_call(self, *args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - stime)
+
+    monkeypatch.setattr(EUtils, 'fetch', timed_call)
+    monkeypatch.setattr(AsyncEUtils, 'fetch', timed_async_call)
+    return latencies
+
+
+@pytest.mark.parametrize('run_mode', ['threads', 'async'])
+def test_pipeline_throughput(tmp_path, call_latencies, run_mode):
+    with ReplayServer(RECORDINGS_PATH, latency=LATENCY, jitter=1.0) as server:
+        config = Config.load()
+        config.result_path = str(tmp_path)
+        config.hedge_path = str(DATA_PATH / 'hedges.csv')
+        config.eutils_prefix = server.prefix
+        config.rate_limit = RATE_LIMIT
+        config.max_workers = MAX_WORKERS
+        config.num_queries = NUM_QUERIES
+        config.run_mode = run_mode
+        pipeline = Pipeline(config, 'bench')
+        pipeline.hedge = pipeline.load_hedges()
+        pipeline.queries = pd.DataFrame({
+            'search_id': [f'bench{i}' for i in range(NUM_QUERIES)],
+            'query_term': [f'benchmark query {i}' for i in range(NUM_QUERIES)],
+            'result_count': 0,
+        })
+        pipeline.result_path.mkdir()
+        pipeline.error_log = (pipeline.result_path / 'error_log.txt').open('w')
+
+        stime = time.perf_counter()
+        assert pipeline.run() == 0
+        elapsed = time.perf_counter() - stime
+
+    num_calls = NUM_QUERIES * 2 * (1 + len(pipeline.hedge))
+    assert server.request_count + pipeline.eutils.coalesced_count == num_calls
+    results = pd.read_csv(pipeline.result_path / 'results.csv')
+    assert len(results) == NUM_QUERIES * 2 * len(pipeline.hedge)
+
+    report = {
+        'run_mode': run_mode,
+        'queries': NUM_QUERIES,
+        'latency': LATENCY,
+        'rate_limit': RATE_LIMIT,
+        'max_workers': MAX_WORKERS,
+        'calls': num_calls,
+        'calls_per_second': num_calls / elapsed,
+        # calls shared with one in flight are not sent, so only the requests count against the rate limit
+        'requests_per_second': server.request_count / elapsed,
+        'p50_latency': float(np.percentile(call_latencies, 50)),
+        'p99_latency': float(np.percentile(call_latencies, 99)),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    print(json.dumps(report))
+    if os.environ.get('TEAM4_BENCH_OUTPUT'):
+        with open(os.environ['TEAM4_BENCH_OUTPUT'], 'a') as f:
+            print(json.dumps(report), file=f)
+    assert report['requests_per_second'] <= 1.1 * RATE_LIMIT
+
+
+def dom_search_result(content):
+    """
+    Read an esearch response the way the pipeline did before SearchResult: a tree, then an xpath per part
+    """
+    xml = etree.parse(BytesIO(content))
+    counts = xml.xpath('//Count')
+    webenv = xml.xpath('/eSearchResult/WebEnv')
+    query_key = xml.xpath('/eSearchResult/QueryKey')
+    return (
+        int(counts[0].text) if counts else 0,
+        [element.text for element in xml.xpath('//IdList/Id')],
+        [error.text for error in xml.xpath('/eSearchResult/ERROR')],
+        webenv[0].text if webenv else None,
+        query_key[0].text if query_key else None,
+    )
+
+
+def test_search_result_parsing():
+    responses = [path.read_bytes() for path in sorted(RECORDINGS_PATH.glob('*/*.xml'))]
+    assert responses
+    for content in responses:
+        result = parse_search_result(content)
+        expected = dom_search_result(content)
+        assert (result.count, result.ids.astype(str).tolist(), result.errors, result.webenv,
+                result.query_key) == expected
+
+    timings = {}
+    for name, parse in (('dom', dom_search_result), ('lean', parse_search_result)):
+        stime = time.perf_counter()
+        for _ in range(PARSE_REPEATS):
+            for content in responses:
+                parse(content)
+        timings[name] = (time.perf_counter() - stime) / (PARSE_REPEATS * len(responses))
+    report = {
+        'benchmark': 'search_result_parsing',
+        'responses': len(responses),
+        'dom_us': timings['dom'] * 1e6,
+        'lean_us': timings['lean'] * 1e6,
+        'speedup': timings['dom'] / timings['lean'],
+    }
+    print(json.dumps(report))
+    if os.environ.get('TEAM4_BENCH_OUTPUT'):
+        with open(os.environ['TEAM4_BENCH_OUTPUT'], 'a') as f:
+            print(json.dumps(report), file=f)
+
+
+STARTUP_SCRIPT = '''
+import json, sys, time
+stime = time.perf_counter()
+from bmcodeathon.team4 import cli
+imported = time.perf_counter()
+cli.main(['team4', 'status', sys.argv[1]])
+cli.main(['team4', 'validate-config', sys.argv[2]])
+done = time.perf_counter()
+heavy = sorted(name for name in ('pandas', 'numpy', 'lxml', 'requests', 'aiohttp') if name in sys.modules)
+print(json.dumps({'import_seconds': imported - stime, 'command_seconds': done - imported, 'heavy': heavy}))
+'''
+
+
+def test_cli_startup(tmp_path):
+    """
+    Time importing the CLI and running status and validate-config, in a fresh interpreter
+    """
+    experiment = tmp_path / 'experiment'
+    experiment.mkdir()
+    (experiment / 'queries.csv').write_text('search_index,search_id,query_term,result_count\n1,s1,cancer,1\n')
+    (experiment / 'results.csv').write_text(
+        'search_index,sort,result_count,return_count,error_count,bias_dimension,bias_result_count\n'
+        '1,relevance,100,20,0,one,3\n'
+    )
+    config_path = tmp_path / 'config.yml'
+    config_path.write_text(f'data_path: {config_path}\nhedge_path: {config_path}\n')
+    cwd = Path(__file__).resolve().parents[1]
+    output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, str(experiment), str(config_path)],
+                            cwd=cwd, capture_output=True, text=True, check=True).stdout
+    report = dict(json.loads(output.splitlines()[-1]), benchmark='cli_startup')
+    print(json.dumps(report))
+    if os.environ.get('TEAM4_BENCH_OUTPUT'):
+        with open(os.environ['TEAM4_BENCH_OUTPUT'], 'a') as f:
+            print(json.dumps(report), file=f)
+    assert report['heavy'] == []
+    # tens of milliseconds on a quiet machine, with room for a busy one
+    assert report['import_seconds'] + report['command_seconds'] < 0.5
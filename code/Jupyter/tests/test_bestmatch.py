@@ -0,0 +1,66 @@
+import ast
+import re
+
+import pandas as pd
+import pytest
+
+from bmcodeathon.team4 import cli
+from bmcodeathon.team4.bestmatch import BestMatchPipeline
+
+
+@pytest.mark.parametrize('run_mode', ['threads', 'async'])
+def test_bestmatch(tmp_path, eutils_server, run_mode, capsys):
+    config_path = tmp_path / 'config.yml'
+    config_path.write_text(f'eutils_prefix: {eutils_server.prefix}\nrate_limit: 100\nmax_workers: 4\n'
+                           f'run_mode: {run_mode}\n')
+    terms_path = tmp_path / 'terms.csv'
+    pd.DataFrame({'processed_query': ['cancer', 'asthma']}).to_csv(terms_path, index=False)
+    hedges_path = tmp_path / 'hedges.csv'
+    pd.DataFrame(
+        {'Hedge_Name': ['One', 'Two'], 'Shortcode': ['one', 'two'], 'Hedge_text': ['hedge one', 'hedge two']}
+    ).to_csv(hedges_path, index=False)
+    output_path = tmp_path / 'output.csv'
+
+    cli.main(['team4', 'bestmatch', '--searchtermsfile', str(terms_path), '--hedgesfile', str(hedges_path),
+              '--itemcounts', '10', '-c', str(config_path), '-o', str(output_path)])
+
+    # both searches find the same PMIDs, so their hedge searches may share requests
+    saved = re.search(r'^(\d+) calls saved', capsys.readouterr().out, re.MULTILINE)
+    assert len(eutils_server.requests) + (int(saved.group(1)) if saved else 0) == 2 * 2 * 3
+    path, params = eutils_server.requests[0]
+    assert params['retmode'] == ['json']
+    output = pd.read_csv(output_path).sort_values('search_count')
+    assert list(output.columns[:5]) == ['search_count', 'search_pointer', 'total_count', 'best_match_all',
+                                        'date_sort_all']
+    assert output.search_pointer.tolist() == ['cance', 'asthm']
+    assert (output.total_count == 12345).all()
+    assert (output.one_BM_count == 3).all() and (output.two_DS_count == 3).all()
+    assert ast.literal_eval(output.one_BM_ids.iloc[0]) == ['1002', '1005', '1008']
+
+
+def test_bestmatch_writes_a_row_when_a_sort_fails(tmp_path, eutils_server, monkeypatch):
+    config_path = tmp_path / 'config.yml'
+    config_path.write_text(f'eutils_prefix: {eutils_server.prefix}\nrate_limit: 100\nmax_workers: 2\n')
+    terms_path = tmp_path / 'terms.csv'
+    pd.DataFrame({'processed_query': ['cancer', 'asthma']}).to_csv(terms_path, index=False)
+    hedges_path = tmp_path / 'hedges.csv'
+    pd.DataFrame({'Hedge_Name': ['One'], 'Shortcode': ['one'], 'Hedge_text': ['hedge one']}).to_csv(hedges_path,
+                                                                                                   index=False)
+    output_path = tmp_path / 'output.csv'
+    run_case = BestMatchPipeline.run_case
+
+    def failing_run_case(self, search_index, sort_order):
+        if (search_index, sort_order) == (2, 'date_desc'):
+            raise RuntimeError('failed')
+        return run_case(self, search_index, sort_order)
+
+    monkeypatch.setattr(BestMatchPipeline, 'run_case', failing_run_case)
+    cli.main(['team4', 'bestmatch', '--searchtermsfile', str(terms_path), '--hedgesfile', str(hedges_path),
+              '--itemcounts', '10', '-c', str(config_path), '-o', str(output_path)])
+
+    output = pd.read_csv(output_path).sort_values('search_count').set_index('search_count')
+    assert output.index.tolist() == [1, 2]
+    assert output.total_count.tolist() == [12345, 12345]
+    assert output.one_BM_count.tolist() == [3, 3]
+    assert output.one_DS_count.isna().tolist() == [False, True]
+    assert output.date_sort_all.isna().tolist() == [False, True]
@@ -0,0 +1,67 @@
+import time
+import zlib
+
+from bmcodeathon.team4 import EUtils
+from bmcodeathon.team4.cache import ResponseCache, cache_key
+
+
+def test_key_ignores_api_key_and_order():
+    url = 'https://host/entrez/eutils/esearch.fcgi?db=pubmed&term=cancer&api_key=abc'
+    assert cache_key(url) == cache_key('https://other/entrez/eutils/esearch.fcgi?term=cancer&db=pubmed')
+    assert cache_key(url) != cache_key('https://host/entrez/eutils/esearch.fcgi?db=pubmed&term=asthma')
+
+
+def test_ttl(tmp_path):
+    cache = ResponseCache(tmp_path / 'cache.db', ttl=0.05)
+    cache.put('esearch.fcgi?term=a', 'text/xml', b'<a/>')
+    assert cache.get('esearch.fcgi?term=a') == ('text/xml', b'<a/>')
+    time.sleep(0.1)
+    assert cache.get('esearch.fcgi?term=a') is None
+
+
+def test_evicts_least_recently_used(tmp_path):
+    content = bytes(range(256)) * 4
+    cache = ResponseCache(tmp_path / 'cache.db')
+    cache.put('esearch.fcgi?term=a', 'text/xml', content)
+    cache.max_bytes = 2 * cache.size
+    cache.put('esearch.fcgi?term=b', 'text/xml', content)
+    cache.get('esearch.fcgi?term=a')
+    cache.put('esearch.fcgi?term=c', 'text/xml', content)
+
+    assert cache.get('esearch.fcgi?term=b') is None
+    assert cache.get('esearch.fcgi?term=a') is not None
+    assert cache.get('esearch.fcgi?term=c') is not None
+
+
+def test_size_is_kept_up_to_date(tmp_path):
+    def stored(cache):
+        return cache.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    cache = ResponseCache(tmp_path / 'cache.db', ttl=0.05)
+    cache.put('esearch.fcgi?term=a', 'text/xml', b'<a/>')
+    cache.put('esearch.fcgi?term=a', 'text/xml', bytes(range(256)))
+    cache.put('esearch.fcgi?term=b', 'text/xml', b'<b/>')
+    assert cache.size == stored(cache) > 0
+    time.sleep(0.1)
+    assert cache.get('esearch.fcgi?term=a') is None
+    assert cache.size == stored(cache) > 0
+    cache.max_bytes = 0
+    cache.put('esearch.fcgi?term=c', 'text/xml', b'<c/>')
+    assert cache.size == stored(cache) == 0
+    cache.max_bytes = 2**30
+    cache.put('esearch.fcgi?term=d', 'text/xml', b'<d/>')
+    cache.close()
+    assert ResponseCache(tmp_path / 'cache.db').size == len(zlib.compress(b'<d/>'))
+
+
+def test_eutils_counts_hits(tmp_path, eutils_server):
+    cache = ResponseCache(tmp_path / 'cache.db')
+    for apikey in ['first', 'second']:
+        eutils = EUtils(apikey, rate=100, prefix=eutils_server.prefix, cache=cache)
+        r = eutils.esearch('pubmed', term='cancer', retmax=10)
+        assert len(r.xml.xpath('//IdList/Id')) == 10
+    assert len(eutils_server.requests) == 1
+    assert (eutils.call_count, eutils.cache_hits, eutils.cache_misses) == (0, 1, 0)
+    # history server requests are never cached
+    eutils.esearch('pubmed', history=True, term='cancer')
+    assert eutils.call_count == 1
@@ -0,0 +1,80 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from bmcodeathon.team4.coalesce import AsyncSingleFlight, SingleFlight, normalize_term
+
+
+def test_normalize_term():
+    assert normalize_term('Breast  Neoplasms[mesh]  AND ( Humans [MH] )') == \
+        'breast neoplasms[MESH] AND (humans[MH])'
+    assert normalize_term('"Heart Attack" [tiab] OR  cancer') == '"heart attack"[TIAB] OR cancer'
+    # lower case operators are words, and a tag after an operator stays a separate token
+    assert normalize_term('cats and dogs') == 'cats and dogs'
+    assert normalize_term('cancer AND [pt]') == 'cancer AND [PT]'
+    assert normalize_term('1002,1005[uid] AND (Hedge One)') == '1002,1005[UID] AND (hedge one)'
+    # unbalanced quotes are left as they are, but for spacing
+    assert normalize_term('"Heart  Attack') == '"Heart Attack'
+
+
+def test_single_flight_shares_calls():
+    flights = SingleFlight()
+    barrier = threading.Barrier(4)
+    release = threading.Event()
+    calls = []
+
+    def call():
+        calls.append(1)
+        release.wait(5)
+        return 'result'
+
+    results = []
+
+    def worker():
+        barrier.wait()
+        results.append(flights.do('key', call))
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    # the first thread holds the call until the others have had time to join it
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert calls == [1]
+    assert sorted(results) == [('result', False)] + [('result', True)] * 3
+    # nothing is kept once the call has finished
+    assert flights.flights == {}
+    assert flights.do('key', call) == ('result', False)
+
+
+def test_single_flight_shares_exceptions():
+    flights = SingleFlight()
+
+    def call():
+        raise ValueError('failed')
+
+    with pytest.raises(ValueError):
+        flights.do('key', call)
+    assert flights.flights == {}
+
+
+def test_async_single_flight():
+    flights = AsyncSingleFlight()
+    calls = []
+
+    async def call():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 'result'
+
+    async def main():
+        return await asyncio.gather(*(flights.do('key', call) for _ in range(3)))
+
+    results = asyncio.run(main())
+    assert calls == [1]
+    assert results == [('result', False), ('result', True), ('result', True)]
+    assert flights.flights == {}
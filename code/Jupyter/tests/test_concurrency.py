@@ -0,0 +1,101 @@
+import pandas as pd
+import pytest
+
+from bmcodeathon.team4 import Config, Pipeline, cli
+from bmcodeathon.team4.concurrency import ConcurrencyController, estimate_calls, plan_run
+
+
+def test_estimate_calls():
+    assert estimate_calls(1000, 9) == (2000, 18000)
+    assert estimate_calls(1000, 9, hedge_batch=10) == (2000, 900)
+    assert estimate_calls(1000, 9, hedge_index=True) == (2000, 0)
+    # batches of 50 queries have unions of up to 20,000 PMIDs, searched in two chunks
+    assert estimate_calls(1000, 9, hedge_batch=50, num_results=200) == (2000, 20 * 2 * 9)
+    # a rerun searches the changed hedges for the cases it reuses, and runs the rest in full
+    assert estimate_calls(1000, 9, reused_cases=1990, changed_hedges=2) == (10, 10 * 9 + 1990 * 2)
+
+
+def test_plan_run():
+    config = Config.load()
+    config.num_queries = 1000
+    config.rate_limit = 10
+    estimate = plan_run(config, 9, latency=0.5)
+    assert estimate['calls'] == 20000
+    assert estimate['bound'] == 'latency'
+    assert estimate['calls_per_second'] == 2
+    assert estimate['recommended_max_workers'] == 7
+
+    config.max_workers = 'auto'
+    estimate = plan_run(config, 9, latency=0.5)
+    assert estimate['bound'] == 'rate'
+    assert estimate['seconds'] == 2000
+
+
+def test_controller_follows_latency():
+    controller = ConcurrencyController(rate=10)
+    assert controller.limit == 10
+    # units of ten calls taking 4 seconds: 10 calls/s takes 4 units in flight, 5 with headroom
+    for units in range(1, 20):
+        controller.observe(4.0, 10 * units)
+    assert controller.limit == 5
+    for units in range(20, 60):
+        controller.observe(20.0, 10 * units)
+    assert controller.limit == 25
+    assert ConcurrencyController(rate=10, maximum=8).observe(100.0, 1) == 8
+
+
+def test_controller_leaves_out_token_waits():
+    controller = ConcurrencyController(rate=10)
+    # units of ten calls taking 4 seconds, three of them spent waiting for tokens
+    for units in range(1, 20):
+        controller.observe(4.0, 10 * units, waiting=3.0 * units, requesting=1.0 * units)
+    assert controller.unit_seconds == 1.0
+    assert controller.limit == 2
+
+
+def test_plan_command(tmp_path, capsys):
+    pd.DataFrame(
+        {'Hedge_Name': ['One', 'Two'], 'Shortcode': ['one', 'two'], 'Hedge_text': ['hedge one', 'hedge two']}
+    ).to_csv(tmp_path / 'hedges.csv', index=False)
+    (tmp_path / 'config.yml').write_text(f'hedge_path: {tmp_path / "hedges.csv"}\nnum_queries: 100\n')
+    cli.main(['team4', 'plan', '-c', str(tmp_path / 'config.yml'), '--latency', '1.0'])
+    out = capsys.readouterr().out
+    assert '600 calls for 100 queries and 2 hedges' in out
+    assert 'Set max_workers to 4' in out
+
+
+def test_plan_rerun_command(tmp_path, eutils_server, capsys):
+    pd.DataFrame({
+        'search_id': [f's{i}' for i in range(5)],
+        'query_term': [f'term {i}' for i in range(5)],
+        'result_count': range(5),
+    }).to_csv(tmp_path / 'log.tsv', sep='\t', index=False)
+    hedges = pd.DataFrame(
+        {'Hedge_Name': ['One', 'Two'], 'Shortcode': ['one', 'two'], 'Hedge_text': ['hedge one', 'hedge two']}
+    )
+    hedges.to_csv(tmp_path / 'hedges.csv', index=False)
+    (tmp_path / 'config.yml').write_text('\n'.join([
+        f'data_path: {tmp_path / "log.tsv"}',
+        f'result_path: {tmp_path / "results"}',
+        f'hedge_path: {tmp_path / "hedges.csv"}',
+        f'eutils_prefix: {eutils_server.prefix}',
+        'rate_limit: 100',
+        'num_queries: 5',
+    ]))
+    prior = Pipeline(Config.load(tmp_path / 'config.yml'), 'prior')
+    prior.setup()
+    assert prior.run() == 0
+    hedges.loc[1, 'Hedge_text'] = 'hedge two revised'
+    hedges.to_csv(tmp_path / 'new-hedges.csv', index=False)
+    capsys.readouterr()
+
+    cli.main(['team4', 'plan', '-c', str(tmp_path / 'config.yml'), '--latency', '1.0', '--rerun', 'prior',
+              '--hedges', str(tmp_path / 'new-hedges.csv')])
+    out = capsys.readouterr().out
+    assert '10 calls for 5 queries and 2 hedges: 0 first stage and 10 hedge searches' in out
+
+
+def test_max_workers_validation(tmp_path):
+    (tmp_path / 'config.yml').write_text('max_workers: lots\n')
+    with pytest.raises(ValueError):
+        Config.load(tmp_path / 'config.yml')
@@ -3,7 +3,7 @@ import numpy as np
 
 import pytest
 
-from bmcodeathon.team4 import Config
+from bmcodeathon.team4 import Config, cli
 
 
 def test_defaults():
@@ -39,6 +39,39 @@ def test_unknown_setting_error(tmp_path):
     with pytest.raises(ValueError):
         Config.load(path)
 
+def test_api_keys(tmp_path):
+    data = dedent("""\
+        rate_limit: 10
+        api_keys:
+          - first
+          - key: second
+            rate: 5
+          - key: third
+    """)
+    path = tmp_path / 'team4.yaml'
+    path.write_text(data)
+
+    config = Config.load(path)
+
+    assert config.key_rates == [('first', 10), ('second', 5), ('third', 10)]
+    assert config.total_rate == 25
+    path.write_text('api_keys:\n  - key: first\n    rate: 0\n')
+    with pytest.raises(ValueError):
+        Config.load(path)
+
+def test_validate_config(tmp_path, capsys):
+    hedge_path = tmp_path / 'hedges.csv'
+    hedge_path.write_text('Shortcode,Hedge_Name,Hedge_text\n')
+    path = tmp_path / 'team4.yaml'
+    path.write_text(f'data_path: {hedge_path}\nhedge_path: {hedge_path}\n')
+    cli.main(['team4', 'validate-config', str(path)])
+    assert capsys.readouterr().out == f'{path}: OK\n'
+
+    path.write_text(f'data_path: {tmp_path / "missing.tsv"}\nhedge_path: {hedge_path}\nrun_mode: fast\n')
+    with pytest.raises(SystemExit):
+        cli.main(['team4', 'validate-config', str(path)])
+    assert 'run_mode should be one of' in capsys.readouterr().out
+
 # Python's typing doesn't enforce type hints - moving on
 #
 # def test_invalid_type_error(tmp_path):
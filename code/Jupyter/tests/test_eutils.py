@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+from bmcodeathon.team4.eutils import parse_search_result
+
+
+def test_parse_search_result():
+    content = (
+        b'<?xml version="1.0" encoding="UTF-8" ?>\n<eSearchResult><Count>12</Count><RetMax>2</RetMax>'
+        b'<RetStart>0</RetStart><QueryKey>1</QueryKey><WebEnv>MCID_1</WebEnv><IdList>\n<Id>5</Id>\n<Id>3</Id>\n'
+        b'</IdList><TranslationSet/><TranslationStack><TermSet><Term>cancer</Term><Count>99</Count></TermSet>'
+        b'</TranslationStack></eSearchResult>\n'
+    )
+    result = parse_search_result(content)
+    assert result.count == 12
+    assert result.ids.dtype == np.uint32 and result.ids.tolist() == [5, 3]
+    assert (result.webenv, result.query_key, result.errors, result.content) == ('MCID_1', '1', [], None)
+    assert parse_search_result(content, keep_content=True).content == content
+
+
+def test_parse_search_result_errors():
+    content = b'<?xml version="1.0" ?>\n<eSearchResult><ERROR>Search Backend failed: &lt;code&gt;</ERROR></eSearchResult>'
+    result = parse_search_result(content)
+    assert result.count == 0
+    assert len(result.ids) == 0
+    assert result.errors == ['Search Backend failed: <code>']
+    with pytest.raises(ValueError):
+        parse_search_result(b'<html>Bad Gateway</html>')
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from bmcodeathon.team4 import EUtils
+from bmcodeathon.team4 import hedgeindex
+from bmcodeathon.team4.hedgeindex import HedgeIndex, fetch_pmids
+
+from .conftest import HEDGE_PMIDS
+
+
+def test_fetch_pmids_pages(eutils_server):
+    eutils = EUtils(rate=100, prefix=eutils_server.prefix)
+    pmids = fetch_pmids(eutils, 'hedge', page_size=25)
+    assert pmids.dtype == np.uint32
+    assert list(pmids) == HEDGE_PMIDS
+    assert eutils.call_count == 1 + 3
+
+
+def test_fetch_pmids_refuses_short_pages(eutils_server):
+    eutils = EUtils(rate=100, prefix=eutils_server.prefix)
+    eutils_server.page_limit = 20
+    with pytest.raises(ValueError, match='fetched 57 of its 67 PMIDs'):
+        fetch_pmids(eutils, 'hedge', page_size=25)
+    eutils_server.page_limit = None
+    eutils_server.retrieval_cap = 50
+    with pytest.raises(ValueError, match='page at 50'):
+        fetch_pmids(eutils, 'hedge', page_size=25)
+
+
+def test_fetch_pmids_splits_by_publication_date(eutils_server, monkeypatch):
+    monkeypatch.setattr(hedgeindex, 'MAX_RETRIEVABLE', 20)
+    eutils = EUtils(rate=1000, prefix=eutils_server.prefix)
+    pmids = fetch_pmids(eutils, 'hedge', page_size=25)
+    assert list(pmids) == HEDGE_PMIDS
+    # only searches within the cap were paged through
+    fetched = [int(params['query_key'][0]) for path, params in eutils_server.requests if path.endswith('efetch.fcgi')]
+    assert len(fetched) > 1
+    assert all(len(eutils_server.searches[query_key - 1]) <= 20 for query_key in fetched)
+
+
+def test_fetch_pmids_refuses_dates_over_the_cap(eutils_server, monkeypatch):
+    monkeypatch.setattr(hedgeindex, 'MAX_RETRIEVABLE', 0)
+    eutils = EUtils(rate=1000, prefix=eutils_server.prefix)
+    with pytest.raises(ValueError, match='too many to fetch'):
+        fetch_pmids(eutils, 'hedge')
+
+
+def test_build_once_and_match(tmp_path, eutils_server):
+    eutils = EUtils(rate=100, prefix=eutils_server.prefix)
+    hedges = pd.DataFrame({'Hedge_text': ['hedge one']}, index=pd.Index(['one'], name='Shortcode'))
+
+    HedgeIndex(tmp_path).build(eutils, hedges)
+    calls = eutils.call_count
+    index = HedgeIndex(tmp_path).build(eutils, hedges)
+    assert eutils.call_count == calls
+
+    assert list(index.matches('one', [1001, 1002, 5, 1098, 1005])) == [1002, 1098, 1005]
+    assert index.bias_counts([1001, 1100000]) == [('one', 0)]
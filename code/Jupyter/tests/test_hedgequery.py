@@ -0,0 +1,104 @@
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from bmcodeathon.team4 import cli
+from bmcodeathon.team4.hedgequery import And, HedgeSyntaxError, Not, Or, RecordIndex, Term, parse_hedge
+from bmcodeathon.team4.records import Record, RecordStore
+
+
+DATA_PATH = Path(__file__).resolve().parents[3] / 'data'
+
+RECORDS = [
+    Record(1, 'Smoking among gay men', 'A survey of homosexual men.', ['Sexual and Gender Minorities', 'Smoking']),
+    Record(2, 'Smoking in adolescents', 'Homosexuality was not assessed.', ['Adolescent', 'Smoking']),
+    Record(3, 'Falls in the elderly', 'Older adults in nursing homes.', ['Aged', 'Accidental Falls']),
+    Record(4, 'Men and smoking', 'Gay bars and smoking bans.', ['Male']),
+]
+
+
+def test_parse_hedge():
+    assert parse_hedge('Racial Groups[MeSH] OR "mixed race"[TIAB]') == Or([
+        Term('Racial Groups', 'mesh'), Term('mixed race', 'tiab'),
+    ])
+    # operators are applied from left to right, and lower case and is a word
+    assert parse_hedge('a OR b AND c NOT Ethnic and Racial Minorities') == Not(
+        And([Or([Term('a', 'all'), Term('b', 'all')]), Term('c', 'all')]),
+        Term('Ethnic and Racial Minorities', 'all'),
+    )
+    # a tag after a space still applies, and a tag without a term matches nothing
+    assert parse_hedge('"Frail Elderly" [MeSH] OR [tiab] OR elder*[tiab]') == Or([
+        Term('Frail Elderly', 'mesh'), Term('', 'tiab'), Term('elder*', 'tiab'),
+    ])
+    for text in ('(a OR b', 'a OR', 'a[foo]'):
+        with pytest.raises(HedgeSyntaxError):
+            parse_hedge(text)
+
+
+def test_repo_hedges_parse():
+    hedges = pd.read_csv(DATA_PATH / 'hedges.csv')
+    for text in hedges.Hedge_text:
+        parse_hedge(text)
+
+
+def test_record_index():
+    index = RecordIndex(RECORDS)
+    assert index.evaluate('Smoking[Mesh]') == {1, 2}
+    assert index.evaluate('homosexual*[tiab]') == {1, 2}
+    assert index.evaluate('"gay men"[tiab]') == {1}
+    assert index.evaluate('gay[tiab] NOT Male[Mesh]') == {1}
+    assert index.evaluate('(homosexual*[tiab] OR gay[tiab]) AND smoking[ti]') == {1, 2, 4}
+    assert index.evaluate('"sexual and gender minorities"[Mesh:noexp]') == {1}
+    assert index.evaluate('older adults') == {3}
+    assert index.evaluate('"older adults"[ti]') == set()
+
+
+def test_record_store(tmp_path):
+    store = RecordStore(tmp_path / 'records.sqlite')
+    store.put(RECORDS[:2])
+    assert len(store) == 2
+    assert store.missing([4, 1, 3, 1]) == [3, 4]
+    assert store.get(1) == RECORDS[0]
+    assert list(store) == RECORDS[:2]
+    store.close()
+
+
+def test_evaluate_command(tmp_path, eutils_server, capsys):
+    pd.DataFrame(
+        {'Hedge_Name': ['Aged'], 'Shortcode': ['aged'], 'Hedge_text': ['Aged[Mesh] OR elder*[tiab]']}
+    ).to_csv(tmp_path / 'hedges.csv', index=False)
+    pd.DataFrame({'search_id': ['a', 'b'], 'query_term': ['falls', 'smoking'], 'result_count': 1}).to_csv(
+        tmp_path / 'log.tsv', sep='\t', index=False)
+    (tmp_path / 'config.yml').write_text('\n'.join([
+        f'data_path: {tmp_path / "log.tsv"}',
+        f'result_path: {tmp_path / "results"}',
+        f'hedge_path: {tmp_path / "hedges.csv"}',
+        f'eutils_prefix: {eutils_server.prefix}',
+        'rate_limit: 100',
+        'num_queries: 2',
+        'seed: 1',
+    ]))
+    config_path = str(tmp_path / 'config.yml')
+    cli.main(['team4', 'run', '-c', config_path, '-e', 'exp'])
+    num_requests = len(eutils_server.requests)
+    cli.main(['team4', 'evaluate', '-c', config_path, '-e', 'exp'])
+    # one epost, and one efetch page
+    assert len(eutils_server.requests) == num_requests + 2
+
+    counts = pd.read_csv(tmp_path / 'results' / 'exp' / 'local-results.csv')
+    assert len(counts) == 2 * 2
+    assert (counts.bias_result_count == 3).all()
+    assert (counts.bias_result_count == counts.server_result_count).all()
+
+    # a changed hedge is evaluated from the fetched records, without any calls
+    pd.DataFrame(
+        {'Hedge_Name': ['Child'], 'Shortcode': ['child'], 'Hedge_text': ['Child[Mesh]']}
+    ).to_csv(tmp_path / 'child.csv', index=False)
+    cli.main(['team4', 'evaluate', '-c', config_path, '-e', 'exp', '--hedges', str(tmp_path / 'child.csv'),
+              '--offline', '-o', str(tmp_path / 'child-results.csv')])
+    assert len(eutils_server.requests) == num_requests + 2
+    counts = pd.read_csv(tmp_path / 'child-results.csv')
+    assert (counts.bias_result_count == 7).all()
+    assert counts.server_result_count.isna().all()
+    assert 'agreement' in capsys.readouterr().out
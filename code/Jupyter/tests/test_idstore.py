@@ -0,0 +1,62 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from bmcodeathon.team4.idstore import IdListStore
+
+
+def test_append_and_load(tmp_path):
+    store = IdListStore(tmp_path).open_for_append()
+
+    def append(i):
+        store.append(i, 'relevance', None, [i, i + 1, i + 2])
+        store.append(i, 'relevance', 'race', [i + 1])
+        store.append(i, 'date_desc', 'race', [])
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(append, range(100)))
+    store.append(7, 'relevance', None, [70, 71])
+    store.close()
+
+    store = IdListStore(tmp_path).load()
+    assert len(store.keys()) == 300
+    assert isinstance(store.data, np.memmap)
+    assert list(store.get(3, 'relevance')) == [3, 4, 5]
+    assert list(store.get(3, 'relevance', 'race')) == [4]
+    assert list(store.get(3, 'date_desc', 'race')) == []
+    # the last append of a key wins
+    assert list(store.get(7, 'relevance')) == [70, 71]
+
+
+def test_pmids_streams_idlists(tmp_path):
+    store = IdListStore(tmp_path).open_for_append()
+    store.append(1, 'relevance', None, [5, 6])
+    store.append(1, 'relevance', 'race', [6])
+    store.append(2, 'date_desc', None, [6, 7])
+    store.close()
+
+    store = IdListStore(tmp_path).load()
+    pmids = store.pmids()
+    assert not isinstance(pmids, list)
+    assert list(pmids) == [5, 6, 6, 7]
+    assert list(store.pmids('race')) == [6]
+
+
+def test_append_after_a_crash(tmp_path):
+    store = IdListStore(tmp_path).open_for_append()
+    store.append(1, 'relevance', None, [5, 6])
+    store.close()
+    # a crash mid-append leaves data, and part of a byte, past the index, and a partial index row
+    with open(store.data_path, 'ab') as f:
+        f.write(np.array([8, 9], dtype=np.uint32).tobytes() + b'\x01')
+    with open(store.index_path, 'a') as f:
+        f.write('2,relevance,,2')
+
+    store = IdListStore(tmp_path).open_for_append()
+    store.append(2, 'relevance', None, [7, 8])
+    store.close()
+
+    store = IdListStore(tmp_path).load()
+    assert sorted(store.keys()) == [('1', 'relevance', ''), ('2', 'relevance', '')]
+    assert list(store.get(1, 'relevance')) == [5, 6]
+    assert list(store.get(2, 'relevance')) == [7, 8]
@@ -0,0 +1,73 @@
+import asyncio
+
+from bmcodeathon.team4 import EUtils
+from bmcodeathon.team4.aioeutils import AsyncEUtils
+from bmcodeathon.team4.keypool import KeyPool, with_api_key
+
+
+def test_reserve_takes_the_soonest_token():
+    pool = KeyPool([('a', 2), ('b', 4)])
+    assert pool.rate == 6
+    keys = [pool.reserve()[0] for _ in range(6)]
+    assert sorted(keys) == ['a', 'a', 'b', 'b', 'b', 'b']
+    # every token is spent, and b's next one comes first
+    key, _, wait = pool.reserve()
+    assert key == 'b' and 0 < wait <= 0.25
+
+
+def test_failing_keys_are_removed():
+    pool = KeyPool([('a', 10), ('b', 10), ('c', 10)], max_failures=2)
+    assert not pool.pushed_back('a', 429)
+    pool.succeeded('a')
+    assert not pool.pushed_back('a', 429)
+    assert pool.pushed_back('a', 503)
+    assert pool.throttled['a'] == 2
+    assert pool.reject('b')
+    # the last key stays, however it fails
+    assert not pool.reject('c')
+    assert not pool.pushed_back('c', 429) and not pool.pushed_back('c', 429)
+    assert pool.keys == ['c'] and pool.removed == ['a', 'b']
+    assert pool.rate == 10
+    assert [pool.reserve()[0] for _ in range(3)] == ['c', 'c', 'c']
+
+
+def test_with_api_key():
+    assert with_api_key('https://host/esearch.fcgi', 'k') == 'https://host/esearch.fcgi?api_key=k'
+    assert with_api_key('https://host/esearch.fcgi?db=pubmed', 'k') == 'https://host/esearch.fcgi?db=pubmed&api_key=k'
+
+
+def test_eutils_spreads_requests_over_keys(eutils_server):
+    eutils = EUtils(prefix=eutils_server.prefix, keys=[('one', 2), ('two', 2)])
+    assert eutils.rate == 4
+    for i in range(4):
+        eutils.search('pubmed', term=f'query {i}')
+    keys = [params['api_key'] for _, params in eutils_server.requests]
+    assert sorted(keys) == [['one'], ['one'], ['two'], ['two']]
+
+
+def test_eutils_tracks_pushback_by_key(eutils_server):
+    eutils = EUtils(prefix=eutils_server.prefix, keys=[('one', 100), ('two', 100)])
+    eutils.session.backoff = 0
+    eutils_server.failures = [(429, {})]
+    eutils.search('pubmed', term='query')
+    pushed_back, retried = [params['api_key'][0] for _, params in eutils_server.requests]
+    assert eutils.keypool.throttled == {pushed_back: 1, retried: 0}
+    assert eutils.metrics.counter('api_key_pushback_total', key=eutils.keypool.label(pushed_back), status=429) == 1
+
+
+def test_async_eutils_spreads_requests_over_keys(eutils_server):
+    async def main():
+        async with AsyncEUtils(prefix=eutils_server.prefix, keys=[('one', 2), ('two', 2)]) as eutils:
+            await asyncio.gather(*(eutils.search('pubmed', term=f'query {i}') for i in range(4)))
+            return eutils.tokenbucket.rate
+
+    assert asyncio.run(main()) == 4
+    keys = [params['api_key'] for _, params in eutils_server.requests]
+    assert sorted(keys) == [['one'], ['one'], ['two'], ['two']]
+
+
+def test_session_keeps_request_params(eutils_server):
+    eutils = EUtils(prefix=eutils_server.prefix, keys=[('one', 100)])
+    eutils.session.get(eutils_server.prefix + 'esearch.fcgi', params={'db': 'pubmed', 'term': 'query'})
+    _, params = eutils_server.requests[-1]
+    assert params['db'] == ['pubmed'] and params['term'] == ['query'] and params['api_key'] == ['one']
@@ -0,0 +1,49 @@
+from urllib.request import urlopen
+
+import pytest
+
+from bmcodeathon.team4 import EUtils
+from bmcodeathon.team4.metrics import Metrics, serve_prometheus
+
+
+def test_histogram_and_prometheus():
+    metrics = Metrics()
+    for value in (0.002, 0.003, 0.2, 4.0):
+        metrics.observe('latency', value, endpoint='esearch')
+    metrics.inc('calls', endpoint='esearch')
+    metrics.inc('calls', 2, endpoint='efetch')
+    assert metrics.counter('calls', endpoint='efetch') == 2
+    assert metrics.total('calls') == 3
+    assert metrics.seconds('latency') == pytest.approx(4.205)
+
+    snapshot = metrics.snapshot()
+    assert snapshot['histograms']['latency{endpoint="esearch"}']['p50'] == 0.005
+    assert snapshot['histograms']['latency{endpoint="esearch"}']['p99'] == 5.0
+
+    server = serve_prometheus(metrics, 0)
+    try:
+        text = urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics').read().decode('utf-8')
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert 'calls{endpoint="efetch"} 2\n' in text
+    assert 'latency_bucket{endpoint="esearch",le="0.005"} 2\n' in text
+    assert 'latency_bucket{endpoint="esearch",le="+Inf"} 4\n' in text
+    assert 'latency_count{endpoint="esearch"} 4\n' in text
+
+
+def test_eutils_metrics(eutils_server):
+    eutils_server.failures = [(429, {'Retry-After': '0'})]
+    eutils = EUtils(rate=100, prefix=eutils_server.prefix)
+    eutils.esearch('pubmed', term='cancer')
+    assert eutils.call_count == 1
+    metrics = eutils.metrics
+    assert metrics.counter('eutils_calls_total', endpoint='esearch') == 1
+    assert metrics.counter('eutils_bytes_total', endpoint='esearch') > 0
+    assert metrics.counter('http_responses_total', status=429) == 1
+    assert metrics.counter('http_retries_total', status=429) == 1
+    assert metrics.counter('http_responses_total', status=200) == 1
+    histograms = metrics.snapshot()['histograms']
+    assert histograms['xml_parse_seconds{endpoint="esearch"}']['count'] == 1
+    assert histograms['token_wait_seconds']['count'] == 2
+
@@ -1,6 +1,288 @@
+import json
+
+import pandas as pd
+import pytest
+
 from bmcodeathon.team4 import Config, Pipeline
+from bmcodeathon.team4.idstore import IdListStore
 
 
 def test_just_instantiate():
     config = Config.load()
     pipeline = Pipeline(config)
+
+
+def make_config(tmp_path, prefix, **overrides):
+    config = Config.load()
+    config.result_path = str(tmp_path)
+    config.hedge_path = str(tmp_path / 'hedges.csv')
+    config.eutils_prefix = prefix
+    config.rate_limit = 100
+    config.num_queries = 3
+    for key, value in overrides.items():
+        setattr(config, key, value)
+    return config
+
+
+def make_pipeline(tmp_path, prefix, **overrides):
+    """
+    Make a pipeline as setup would, with two hedges and three sampled queries
+    """
+    config = make_config(tmp_path, prefix, **overrides)
+    pd.DataFrame(
+        {'Hedge_Name': ['One', 'Two'], 'Shortcode': ['one', 'two'], 'Hedge_text': ['hedge one', 'hedge two']}
+    ).to_csv(config.hedge_path, index=False)
+    pipeline = Pipeline(config, 'test')
+    pipeline.hedge = pipeline.load_hedges()
+    pipeline.queries = pd.DataFrame(
+        {'search_id': ['a', 'b', 'c'], 'query_term': ['cancer', 'asthma', 'iridium'], 'result_count': [1, 2, 3]},
+        index=[10, 20, 30],
+    )
+    pipeline.result_path.mkdir()
+    pipeline.error_log = (pipeline.result_path / 'error_log.txt').open('w')
+    pipeline.queries.to_csv(pipeline.result_path / 'queries.csv')
+    (pipeline.result_path / 'seed.txt').write_text('12345')
+    return pipeline
+
+
+def test_run_async(tmp_path, eutils_server):
+    pipeline = make_pipeline(tmp_path, eutils_server.prefix, run_mode='async', max_workers=4)
+    assert pipeline.run() == 0
+
+    results = pd.read_csv(pipeline.result_path / 'results.csv')
+    assert len(results) == 3 * 2 * 2
+    assert set(results.search_index) == {10, 20, 30}
+    assert (results.result_count == 12345).all()
+    assert (results.bias_result_count == 3).all()
+    # hedge searches of the same IdList made at the same time share one request
+    assert len(eutils_server.requests) + pipeline.eutils.coalesced_count == 3 * 2 * 3
+
+
+def test_run_threads(tmp_path, eutils_server):
+    pipeline = make_pipeline(tmp_path, eutils_server.prefix, max_workers=2)
+    assert pipeline.run() == 0
+
+    results = pd.read_csv(pipeline.result_path / 'results.csv')
+    assert len(results) == 3 * 2 * 2
+    assert (results.bias_result_count == 3).all()
+
+    store = IdListStore(pipeline.result_path).load()
+    assert len(store.keys()) == 3 * 2 * 3
+    assert list(store.get(20, 'date_desc')) == list(range(1000, 1010))
+    assert list(store.get(20, 'date_desc', 'two')) == [1002, 1005, 1008]
+    assert not (pipeline.result_path / '20').exists()
+
+
+def test_run_with_hedge_index(tmp_path, eutils_server):
+    pipeline = make_pipeline(tmp_path, eutils_server.prefix, hedge_index_path=str(tmp_path / 'index'))
+    pipeline.build_hedge_index()
+    index_calls = len(eutils_server.requests)
+    assert pipeline.run() == 0
+
+    results = pd.read_csv(pipeline.result_path / 'results.csv')
+    assert len(results) == 3 * 2 * 2
+    assert (results.bias_result_count == 3).all()
+    # only the first stage searches went to the server
+    assert len(eutils_server.requests) - index_calls == 3 * 2
+
+
+def test_resume(tmp_path, eutils_server):
+    pipeline = make_pipeline(tmp_path, eutils_server.prefix)
+    assert pipeline.run() == 0
+    output_path = pipeline.result_path / 'results.csv'
+    results = pd.read_csv(output_path)
+    # one case errored, and another was interrupted after its first hedge
+    results.loc[(results.search_index == 10) & (results.sort == 'relevance'), 'error_count'] = 1
+    results = results.drop(results[(results.search_index == 30) & (results.sort == 'date_desc')].index[1:])
+    results.to_csv(output_path, index=False)
+    eutils_server.requests.clear()
+
+    config = make_config(tmp_path, eutils_server.prefix, num_queries=1000, seed=1)
+    pipeline = Pipeline(config, 'test')
+    pipeline.setup(resume=True)
+    assert config.seed == 12345
+    assert pipeline.run() == 0
+
+    assert len(eutils_server.requests) == 2 * 3
+    results = pd.read_csv(output_path)
+    assert len(results) == 3 * 2 * 2
+    assert len(results.drop_duplicates(['search_index', 'sort', 'bias_dimension'])) == len(results)
+    assert (results.error_count == 0).all()
+
+
+@pytest.mark.parametrize('run_mode', ['threads', 'async'])
+def test_rerun(tmp_path, eutils_server, run_mode):
+    pipeline = make_pipeline(tmp_path, eutils_server.prefix)
+    pipeline.hedge.to_csv(pipeline.result_path / 'hedges.csv')
+    assert pipeline.run() == 0
+    output_path = pipeline.result_path / 'results.csv'
+    results = pd.read_csv(output_path)
+    results.loc[(results.search_index == 10) & (results.sort == 'relevance'), 'error_count'] = 1
+    results.to_csv(output_path, index=False)
+    eutils_server.requests.clear()
+
+    # hedge one is unchanged, two has changed, and three is new
+    hedge_path = tmp_path / 'new-hedges.csv'
+    pd.DataFrame({
+        'Hedge_Name': ['One', 'Two', 'Three'],
+        'Shortcode': ['one', 'two', 'three'],
+        'Hedge_text': ['hedge  one', 'hedge two revised', 'hedge three'],
+    }).to_csv(hedge_path, index=False)
+    config = make_config(tmp_path, eutils_server.prefix, run_mode=run_mode, seed=1)
+    rerun = Pipeline(config, 'rerun')
+    rerun.setup_rerun('test', hedge_path)
+    assert (rerun.prior.unchanged, rerun.prior.changed) == (['one'], ['two', 'three'])
+    assert rerun.run() == 0
+
+    # five cases search the two changed hedges, and the errored case runs in full
+    assert len(eutils_server.requests) == 5 * 2 + 4
+    results = pd.read_csv(rerun.result_path / 'results.csv')
+    assert len(results) == 3 * 2 * 3
+    assert (results.error_count == 0).all()
+    assert (results.result_count == 12345).all()
+    assert (results.bias_result_count == 3).all()
+    store = IdListStore(rerun.result_path).load()
+    assert len(store.keys()) == 3 * 2 * 4
+    assert (rerun.result_path / 'hedges.csv').exists()
+    assert config.seed == 12345
+
+
+@pytest.mark.parametrize('run_mode', ['threads', 'async'])
+def test_run_batched(tmp_path, eutils_server, run_mode):
+    # one worker, so that no requests are made at the same time and shared
+    pipeline = make_pipeline(tmp_path, eutils_server.prefix, run_mode=run_mode, max_workers=1, hedge_batch=2)
+    assert pipeline.run() == 0
+
+    results = pd.read_csv(pipeline.result_path / 'results.csv')
+    assert len(results) == 3 * 2 * 2
+    assert (results.result_count == 12345).all()
+    assert (results.bias_result_count == 3).all()
+    # six first stage searches, and then two batches of queries each search both hedges once
+    assert len(eutils_server.requests) == 3 * 2 + 2 * 2
+    hedge_terms = [params['term'][0] for _, params in eutils_server.requests if '[UID]' in params['term'][0]]
+    assert len(hedge_terms) == 4
+    assert all(term.startswith(','.join(map(str, range(1000, 1010))) + '[UID]') for term in hedge_terms)
+
+    store = IdListStore(pipeline.result_path).load()
+    assert list(store.get(30, 'relevance', 'one')) == [1002, 1005, 1008]
+
+
+@pytest.mark.parametrize('run_mode', ['threads', 'async'])
+def test_run_retries_transient_errors(tmp_path, eutils_server, run_mode):
+    pipeline = make_pipeline(tmp_path, eutils_server.prefix, run_mode=run_mode, retry_backoff=0.01)
+    eutils_server.search_errors = [
+        'Search Backend failed: Pubmed 2.0 search API: HTTP request returned 502 status.',
+        'Search Backend failed: GWSearch response processing error: null',
+    ]
+    assert pipeline.run() == 0
+
+    results = pd.read_csv(pipeline.result_path / 'results.csv')
+    assert len(results) == 3 * 2 * 2
+    assert (results.error_count == 0).all()
+    assert (results.bias_result_count == 3).all()
+    assert pipeline.error_count == 0
+    assert pipeline.metrics.counter('retries_total') == 2
+
+
+def test_run_gives_up_on_permanent_errors(tmp_path, eutils_server):
+    pipeline = make_pipeline(tmp_path, eutils_server.prefix, retry_backoff=0.01)
+    eutils_server.search_errors = ['Invalid query']
+    assert pipeline.run() == 0
+
+    results = pd.read_csv(pipeline.result_path / 'results.csv')
+    assert results.error_count.sum() == 2
+    assert pipeline.error_count == 1
+    assert pipeline.metrics.counter('retries_total') == 0
+
+
+@pytest.mark.parametrize('run_mode', ['threads', 'async'])
+def test_run_auto_workers(tmp_path, eutils_server, run_mode):
+    pipeline = make_pipeline(tmp_path, eutils_server.prefix, run_mode=run_mode, max_workers='auto')
+    assert pipeline.run() == 0
+
+    results = pd.read_csv(pipeline.result_path / 'results.csv')
+    assert len(results) == 3 * 2 * 2
+    assert pipeline.controller.units == 3 * 2
+
+
+@pytest.mark.parametrize('run_mode', ['threads', 'async'])
+def test_run_auto_workers_settle(tmp_path, eutils_server, run_mode):
+    eutils_server.latency = 0.05
+    pipeline = make_pipeline(tmp_path, eutils_server.prefix, run_mode=run_mode, max_workers='auto', rate_limit=30)
+    pipeline.queries = pd.DataFrame({'search_id': 's', 'query_term': [f'query {i}' for i in range(24)],
+                                     'result_count': 1}, index=range(1, 25))
+    assert pipeline.run() == 0
+
+    # a case makes its three calls one after another, or in async mode, its hedge searches together, and
+    # sends fewer than three requests, since cases searching the same hedge terms at once share them, so by
+    # Little's law keeping 30 requests/s flowing takes 30 * seconds_per_case / requests_per_case cases in flight
+    seconds_per_case = (3 if run_mode == 'threads' else 2) * eutils_server.latency
+    requests_per_case = len(eutils_server.requests) / (2 * len(pipeline.queries))
+    expected = 30 * seconds_per_case / requests_per_case
+    # the time cases spend waiting for tokens, which grows with the cases in flight, is left out
+    assert pipeline.controller.unit_seconds < 1.5 * seconds_per_case
+    assert pipeline.controller.limit <= 2 * expected + 1
+
+
+@pytest.mark.parametrize('run_mode', ['threads', 'async'])
+def test_run_sequential(tmp_path, eutils_server, run_mode):
+    pipeline = make_pipeline(tmp_path, eutils_server.prefix, run_mode=run_mode, sequential_batch=1,
+                             min_comparisons=2)
+    assert pipeline.run() == 0
+
+    # every hedge count is the same, so the intervals have no width once two queries are compared
+    results = pd.read_csv(pipeline.result_path / 'results.csv')
+    assert list(results.search_index.unique()) == [10, 20]
+    estimates = (pipeline.result_path / 'estimates.jsonl').read_text().splitlines()
+    assert [json.loads(line)['compared_queries'] for line in estimates] == [1, 2]
+
+
+def test_run_sequential_budget(tmp_path, eutils_server):
+    pipeline = make_pipeline(tmp_path, eutils_server.prefix, sequential_batch=1, min_comparisons=100,
+                             call_budget=15)
+    assert pipeline.run() == 0
+
+    # each query takes 6 calls, so a third would go past the budget
+    assert len(eutils_server.requests) == 12
+    assert len(pd.read_csv(pipeline.result_path / 'results.csv')) == 2 * 2 * 2
+
+
+def test_run_threads_is_bounded(tmp_path, eutils_server):
+    pipeline = make_pipeline(tmp_path, eutils_server.prefix, max_workers=2, rate_limit=1000)
+    pipeline.queries = pd.DataFrame(
+        {'search_id': range(40), 'query_term': [f'query {i}' for i in range(40)], 'result_count': 1},
+    )
+    pipeline.config.num_queries = 40
+    started, finished, ahead = [], [], []
+    run_case, finish_case = pipeline.run_case, pipeline.finish_case
+
+    def tracked_run_case(*args):
+        started.append(args)
+        ahead.append(len(started) - len(finished))
+        return run_case(*args)
+
+    def tracked_finish_case(*args):
+        finished.append(args)
+        return finish_case(*args)
+
+    pipeline.run_case, pipeline.finish_case = tracked_run_case, tracked_finish_case
+    assert pipeline.run() == 0
+
+    assert len(finished) == 80
+    assert max(ahead) <= 4
+    results = pd.read_csv(pipeline.result_path / 'results.csv')
+    assert len(results) == 40 * 2 * 2
+
+
+def test_pipeline_stats(tmp_path, eutils_server):
+    pipeline = make_pipeline(tmp_path, eutils_server.prefix, max_workers=2)
+    assert pipeline.run() == 0
+
+    lines = (pipeline.result_path / 'stats.jsonl').read_text().splitlines()
+    stats = json.loads(lines[-1])
+    counters = stats['counters']
+    assert (counters['eutils_calls_total{endpoint="esearch"}']
+            + counters.get('coalesced_calls_total{endpoint="esearch"}', 0)) == 3 * 2 * 3
+    assert stats['counters']['cases_total{status="ok"}'] == 3 * 2
+    assert stats['histograms']['stage_seconds{stage="first_stage"}']['count'] == 3 * 2
+    assert stats['histograms']['stage_seconds{stage="hedge"}']['count'] == 3 * 2 * 2
@@ -0,0 +1,47 @@
+from io import BytesIO
+
+from bmcodeathon.team4 import EUtils
+from bmcodeathon.team4.records import RecordStore, fetch_records, iter_articles
+
+
+ARTICLES = """<?xml version="1.0" ?>
+<PubmedArticleSet>
+<PubmedArticle><MedlineCitation><PMID>999</PMID><Article><ArticleTitle>Falls in <i>older</i> adults</ArticleTitle>
+<Abstract><AbstractText>Elderly</AbstractText><AbstractText>patients.</AbstractText></Abstract></Article>
+<MeshHeadingList><MeshHeading><DescriptorName>Aged</DescriptorName></MeshHeading></MeshHeadingList>
+</MedlineCitation></PubmedArticle>
+<PubmedArticle><MedlineCitation><PMID>1000</PMID><Article><ArticleTitle>Falls in children</ArticleTitle></Article>
+<MeshHeadingList><MeshHeading><DescriptorName>Child</DescriptorName></MeshHeading>
+<MeshHeading><DescriptorName>Accidental Falls</DescriptorName></MeshHeading></MeshHeadingList>
+</MedlineCitation></PubmedArticle>
+</PubmedArticleSet>
+"""
+
+
+def test_iter_articles():
+    records = list(iter_articles(BytesIO(ARTICLES.encode('utf-8'))))
+    assert [record.pmid for record in records] == [999, 1000]
+    assert records[0].title == 'Falls in older adults'
+    assert records[0].abstract == 'Elderly patients.'
+    assert records[1].abstract == ''
+    assert records[1].mesh == ['Child', 'Accidental Falls']
+
+
+def test_fetch_records(tmp_path, eutils_server):
+    eutils = EUtils(rate=100, prefix=eutils_server.prefix)
+    store = RecordStore(tmp_path / 'records.sqlite')
+    assert fetch_records(eutils, store, range(1000, 1020), page_size=3, post_size=8, parallel=2) == 20
+    assert len(store) == 20
+    assert store.get(1002).mesh == ['Aged']
+    assert store.get(1003).mesh == ['Child']
+    # three posts of up to eight PMIDs, each fetched in pages of three
+    endpoints = [path.rsplit('/', 1)[-1] for path, _ in eutils_server.requests]
+    assert endpoints.count('epost.fcgi') == 3
+    assert endpoints.count('efetch.fcgi') == 3 + 3 + 2
+    assert eutils_server.posted[0] == list(range(1000, 1008))
+
+    # only missing records are fetched
+    eutils_server.requests.clear()
+    assert fetch_records(eutils, store, range(1015, 1030, 3), page_size=3) == 3
+    assert [int(pmid) for pmid in eutils_server.requests[0][1]['id'][0].split(',')] == [1021, 1024, 1027]
+    store.close()
@@ -0,0 +1,30 @@
+from pathlib import Path
+
+from bmcodeathon.team4 import EUtils
+from bmcodeathon.team4.replay import ReplayServer
+
+
+RECORDINGS_PATH = Path(__file__).resolve().parents[3] / 'data' / 'results' / 'sample-1'
+
+
+def test_replays_recordings():
+    with ReplayServer(RECORDINGS_PATH) as server:
+        eutils = EUtils(rate=100, prefix=server.prefix)
+        first = eutils.esearch('pubmed', term='cancer', sort='relevance', retmax=200)
+        again = eutils.esearch('pubmed', term='cancer', sort='relevance', retmax=200)
+        pmids = [element.text for element in first.xml.xpath('//IdList/Id')]
+        assert first.content == again.content
+        assert pmids
+
+        term = ','.join(pmids) + '[UID] AND (hedge)'
+        hedged = [element.text for element in eutils.esearch('pubmed', term=term).xml.xpath('//IdList/Id')]
+        assert 0 < len(hedged) < len(pmids)
+        assert set(hedged) <= set(pmids)
+
+
+def test_injected_failures_are_retried():
+    with ReplayServer(RECORDINGS_PATH, error_502=0.3, seed=1) as server:
+        eutils = EUtils(rate=1000, prefix=server.prefix)
+        for i in range(10):
+            assert eutils.esearch('pubmed', term=f'query {i}').status_code == 200
+        assert server.request_count > 10
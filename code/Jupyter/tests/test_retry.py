@@ -0,0 +1,81 @@
+import time
+
+import requests
+
+from bmcodeathon.team4.retry import CircuitBreaker, Dispatcher, RetryQueue, TransientError, is_transient
+
+
+def test_is_transient():
+    assert is_transient(TransientError('Search Backend failed'))
+    assert is_transient(requests.ConnectionError())
+    response = requests.Response()
+    response.status_code = 502
+    assert is_transient(requests.HTTPError(response=response))
+    response.status_code = 400
+    assert not is_transient(requests.HTTPError(response=response))
+    assert not is_transient(KeyError('query_term'))
+
+
+def test_retry_queue_backoff_and_deadline():
+    retries = RetryQueue(attempts=3, backoff=0.02, deadline=10, seed=1)
+    started = time.monotonic()
+    delay = retries.push('a', 1, started)
+    assert 0.01 <= delay <= 0.02
+    assert retries.pop_ready() is None
+    time.sleep(delay)
+    assert retries.pop_ready() == ('a', 1, started)
+    assert 0.04 <= retries.delay(3) <= 0.08
+    # out of attempts, or past the deadline
+    assert retries.push('a', 4, started) is None
+    assert retries.push('a', 2, started - 10) is None
+    assert len(retries) == 0
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(window=4, threshold=0.5, cooldown=0.05)
+    for ok in (True, False, True):
+        breaker.record(breaker.allow(), ok)
+    assert not breaker.is_open
+    breaker.record(breaker.allow(), False)
+    assert breaker.is_open
+    assert breaker.allow() is None
+    time.sleep(0.05)
+    # one probe is let through, and its failure opens the breaker again
+    probe = breaker.allow()
+    assert probe is not None
+    assert breaker.allow() is None
+    breaker.record(probe, False)
+    assert breaker.is_open and breaker.open_count == 2
+    time.sleep(0.05)
+    breaker.record(breaker.allow(), True)
+    assert not breaker.is_open
+
+
+def test_circuit_breaker_ignores_units_in_flight_when_it_opened():
+    breaker = CircuitBreaker(window=2, threshold=0.5, cooldown=0.05)
+    stale_failure, stale_success = breaker.allow(), breaker.allow()
+    breaker.record(breaker.allow(), False)
+    breaker.record(breaker.allow(), False)
+    assert breaker.is_open
+    time.sleep(0.05)
+    probe = breaker.allow()
+    # units dispatched before the breaker opened decide nothing, and no second probe goes out meanwhile
+    breaker.record(stale_failure, False)
+    assert breaker.is_open and breaker.open_count == 1
+    assert breaker.allow() is None
+    breaker.record(stale_success, True)
+    assert breaker.is_open
+    breaker.record(probe, True)
+    assert not breaker.is_open
+
+
+def test_dispatcher_prefers_ready_retries():
+    retries = RetryQueue(backoff=0.0)
+    dispatcher = Dispatcher(['a', 'b'], retries, CircuitBreaker())
+    unit, attempt, started, ticket = dispatcher.next()
+    assert (unit, attempt) == ('a', 0)
+    retries.push(unit, 1, started)
+    assert dispatcher.next()[:2] == ('a', 1)
+    assert dispatcher.next()[:2] == ('b', 0)
+    assert dispatcher.next() is None
+    assert dispatcher.done
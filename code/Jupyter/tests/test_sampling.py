@@ -0,0 +1,68 @@
+import pandas as pd
+from numpy.random import RandomState
+
+from bmcodeathon.team4 import Config, Pipeline
+from bmcodeathon.team4.sampling import reservoir_sample
+
+
+def write_log(path, num_rows=2000):
+    pd.DataFrame({
+        'search_id': [f's{i}' for i in range(num_rows)],
+        'query_term': [f'term {i % 700}' if i % 11 else None for i in range(num_rows)],
+        'result_count': range(num_rows),
+        'session_id': 'unused',
+    }).to_csv(path, sep='\t', index=False)
+
+
+def test_reservoir_sample(tmp_path):
+    data_path = tmp_path / 'log.tsv'
+    write_log(data_path)
+
+    queries = reservoir_sample(data_path, '\t', 50, RandomState(7), chunksize=128)
+
+    assert list(queries.columns) == ['search_id', 'query_term', 'result_count']
+    assert len(queries) == 50
+    assert queries.query_term.is_unique
+    # the index is the row number in the log
+    assert (queries.search_id == 's' + queries.index.astype(str)).all()
+    # the seed determines the sample, however the log is chunked
+    assert queries.equals(reservoir_sample(data_path, '\t', 50, RandomState(7), chunksize=1000))
+    assert not queries.equals(reservoir_sample(data_path, '\t', 50, RandomState(8), chunksize=128))
+
+
+def test_sample_is_reused(tmp_path):
+    data_path = tmp_path / 'log.tsv'
+    write_log(data_path)
+    config = Config.load()
+    config.data_path = str(data_path)
+    config.result_path = str(tmp_path / 'results')
+    config.num_queries = 20
+    config.seed = 42
+    config.sampler = 'stream'
+
+    first = Pipeline(config, 'first')
+    first.sample_queries()
+    assert first.sample_path().exists()
+    first.sample_path().write_text(first.sample_path().read_text().replace(',term ', ',cached term '))
+
+    second = Pipeline(config, 'second')
+    second.sample_queries()
+    assert list(second.queries.index) == list(first.queries.index)
+    assert second.queries.query_term.str.startswith('cached term').all()
+    assert (second.result_path / 'queries.csv').exists()
+
+
+def test_sample_is_kept_only_for_a_configured_seed(tmp_path):
+    data_path = tmp_path / 'log.tsv'
+    write_log(data_path)
+    config = Config.load()
+    config.data_path = str(data_path)
+    config.result_path = str(tmp_path / 'results')
+    config.num_queries = 20
+    config.sampler = 'stream'
+
+    pipeline = Pipeline(config, 'first')
+    pipeline.sample_queries()
+    assert config.seed > 0
+    assert (pipeline.result_path / 'seed.txt').read_text() == str(config.seed)
+    assert not (tmp_path / 'results' / '.samples').exists()
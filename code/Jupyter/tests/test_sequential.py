@@ -0,0 +1,56 @@
+import math
+
+import pandas as pd
+
+from bmcodeathon.team4.sequential import BiasEstimator, RunningMean
+
+
+def test_running_mean():
+    stat = RunningMean()
+    for value in [1, 2, 3, 4]:
+        stat.add(value)
+    assert stat.mean == 2.5
+    assert math.isclose(stat.variance, 5 / 3)
+    assert math.isclose(stat.half_width(2.0), 2.0 * math.sqrt(5 / 12))
+
+
+def test_estimator_pairs_sorts():
+    estimator = BiasEstimator(['race', 'kids'], width=1.0, min_comparisons=2)
+    estimator.add(1, 'relevance', 50, 0, [('race', 5), ('kids', 0)])
+    assert estimator.queries == 0
+    estimator.add(1, 'date_desc', 50, 0, [('race', 2), ('kids', 0)])
+    # an error in either sort drops the query
+    estimator.add(2, 'date_desc', 50, 1, [('race', 9), ('kids', 9)])
+    estimator.add(2, 'relevance', 50, 0, [('race', 1), ('kids', 1)])
+    # and so does a failed case
+    estimator.add(3, 'relevance', None, 0, [])
+    estimator.add(3, 'date_desc', 50, 0, [('race', 1), ('kids', 1)])
+    estimator.add(4, 'relevance', 50, 0, [('race', 4), ('kids', 1)])
+    estimator.add(4, 'date_desc', 50, 0, [('race', 1), ('kids', 1)])
+
+    assert estimator.queries == 2
+    estimates = estimator.estimates().set_index('bias_dimension')
+    assert estimates.loc['race', 'compared'] == 2
+    assert estimates.loc['race', 'mean_differential'] == 3.0
+    assert estimates.loc['kids', 'compared'] == 1
+    assert not estimator.converged
+
+
+def test_estimator_converges(tmp_path):
+    rows = []
+    for search_index in range(10):
+        rows.append((search_index, 'relevance', 50, 50, 0, 'race', 3 + search_index % 2))
+        rows.append((search_index, 'date_desc', 50, 50, 0, 'race', 2))
+    results_path = tmp_path / 'results.csv'
+    columns = ['search_index', 'sort', 'result_count', 'return_count', 'error_count',
+               'bias_dimension', 'bias_result_count']
+    pd.DataFrame(rows, columns=columns).to_csv(results_path, index=False)
+
+    estimator = BiasEstimator(['race'], width=1.0, min_comparisons=10)
+    estimator.load(results_path)
+    estimates = estimator.estimates()
+    assert estimates.compared.tolist() == [10]
+    assert estimates.mean_differential.tolist() == [1.5]
+    assert estimator.converged
+    estimator.width = 0.5
+    assert not estimator.converged
@@ -0,0 +1,100 @@
+import json
+
+import pandas as pd
+import pytest
+
+from bmcodeathon.team4 import Config, Pipeline
+from bmcodeathon.team4 import cli
+from bmcodeathon.team4.idstore import IdListStore
+from bmcodeathon.team4.shard import parse_shard, shard_queries
+
+
+def make_config(tmp_path, prefix):
+    pd.DataFrame({
+        'search_id': [f's{i}' for i in range(40)],
+        'query_term': [f'term {i}' for i in range(40)],
+        'result_count': range(40),
+    }).to_csv(tmp_path / 'log.tsv', sep='\t', index=False)
+    pd.DataFrame(
+        {'Hedge_Name': ['One', 'Two'], 'Shortcode': ['one', 'two'], 'Hedge_text': ['hedge one', 'hedge two']}
+    ).to_csv(tmp_path / 'hedges.csv', index=False)
+    (tmp_path / 'config.yml').write_text('\n'.join([
+        f'data_path: {tmp_path / "log.tsv"}',
+        f'result_path: {tmp_path / "results"}',
+        f'hedge_path: {tmp_path / "hedges.csv"}',
+        f'eutils_prefix: {prefix}',
+        'rate_limit: 100',
+        'num_queries: 7',
+        'seed: 42',
+        'max_workers: 2',
+    ]))
+    return str(tmp_path / 'config.yml')
+
+
+def test_parse_shard():
+    assert parse_shard('1/4') == (1, 4)
+    for value in ('4/4', '-1/4', '1', 'a/b'):
+        with pytest.raises(ValueError):
+            parse_shard(value)
+
+
+def test_shards_are_disjoint():
+    queries = pd.DataFrame({'query_term': [f'term {i}' for i in range(10)]}, index=range(100, 110))
+    shards = [shard_queries(queries, shard, 3) for shard in range(3)]
+    assert sorted(index for shard in shards for index in shard.index) == list(queries.index)
+    assert [len(shard) for shard in shards] == [4, 3, 3]
+
+
+def test_merge_matches_single_run(tmp_path, eutils_server):
+    config_path = make_config(tmp_path, eutils_server.prefix)
+    cli.main(['team4', 'run', '-c', config_path, '-e', 'single'])
+    for shard in range(3):
+        cli.main(['team4', 'run', '-c', config_path, '-e', 'sharded', '--shard', f'{shard}/3'])
+    cli.main(['team4', 'merge', '-c', config_path, '-e', 'sharded'])
+
+    single, sharded = tmp_path / 'results' / 'single', tmp_path / 'results' / 'sharded'
+    assert (sharded / 'queries.csv').read_text() == (single / 'queries.csv').read_text()
+    assert (sharded / 'seed.txt').read_text() == '42'
+    merged = pd.read_csv(sharded / 'results.csv')
+    expected = pd.read_csv(single / 'results.csv')
+    key = ['search_index', 'sort', 'bias_dimension']
+    pd.testing.assert_frame_equal(
+        merged.sort_values(key, ignore_index=True), expected.sort_values(key, ignore_index=True)
+    )
+    # the merged results are in the order of the sample
+    queries = pd.read_csv(sharded / 'queries.csv', index_col=0)
+    assert list(merged.search_index.drop_duplicates()) == list(queries.index)
+
+    store = IdListStore(sharded).load()
+    assert len(store.keys()) == 7 * 2 * 3
+    assert list(store.get(queries.index[3], 'date_desc', 'two')) == [1002, 1005, 1008]
+    counters = json.loads((sharded / 'stats.jsonl').read_text())['counters']
+    assert (counters['eutils_calls_total{endpoint="esearch"}']
+            + counters.get('coalesced_calls_total{endpoint="esearch"}', 0)) == 42
+
+
+def test_merge_requires_every_shard(tmp_path, eutils_server):
+    config_path = make_config(tmp_path, eutils_server.prefix)
+    cli.main(['team4', 'run', '-c', config_path, '-e', 'sharded', '--shard', '0/2'])
+    with pytest.raises(SystemExit):
+        cli.main(['team4', 'merge', '-c', config_path, '-e', 'sharded'])
+
+
+def test_shard_requires_seed(tmp_path):
+    config = Config.load()
+    config.seed = 0
+    with pytest.raises(ValueError):
+        Pipeline(config, 'sharded', shard=(0, 2))
+
+
+def test_shards_need_a_configured_seed(tmp_path, eutils_server):
+    config_path = make_config(tmp_path, eutils_server.prefix)
+    config_file = tmp_path / 'config.yml'
+    config_file.write_text(config_file.read_text().replace('seed: 42\n', ''))
+    # shards started at different times would otherwise draw different samples
+    for shard in range(2):
+        with pytest.raises(SystemExit):
+            cli.main(['team4', 'run', '-c', config_path, '-e', 'sharded', '--shard', f'{shard}/2'])
+    assert not (tmp_path / 'results' / 'sharded').exists()
+    cli.main(['team4', 'run', '-c', config_path, '-e', 'single'])
+    assert int((tmp_path / 'results' / 'single' / 'seed.txt').read_text()) > 0
@@ -0,0 +1,69 @@
+import pytest
+
+from bmcodeathon.team4 import cli, status
+from bmcodeathon.team4.status import ExperimentStatus, count_lines, tail_lines
+
+
+def make_experiment(path, num_queries=5, cases=None, errors=()):
+    """
+    An experiment of `num_queries` queries and two hedges, with results for its first `cases` cases
+    """
+    path.mkdir(parents=True)
+    (path / 'queries.csv').write_text('search_index,search_id,query_term,result_count\n' + ''.join(
+        f'{index},s{index},"term, {index}",1\n' for index in range(num_queries)
+    ))
+    (path / 'hedges.csv').write_text('Shortcode,Hedge_Name,Hedge_text\none,One,hedge one\ntwo,Two,hedge two\n')
+    lines = ['search_index,sort,result_count,return_count,error_count,bias_dimension,bias_result_count']
+    cases = [(index, sort) for index in range(num_queries) for sort in ('relevance', 'date_desc')][:cases]
+    for index, sort in cases:
+        error_count = 1 if (index, sort) in errors else 0
+        lines += [f'{index},{sort},100,20,{error_count},{hedge},3' for hedge in ('one', 'two')]
+    (path / 'results.csv').write_text('\n'.join(lines) + '\n')
+    (path / 'error_log.txt').write_text('3, date_desc:\nSearch Backend failed\n')
+    return path
+
+
+def test_count_and_tail_lines(tmp_path):
+    path = tmp_path / 'lines.txt'
+    path.write_text('first\nsecond\nthird')
+    assert count_lines(path) == 3
+    assert tail_lines(path) == ['first', 'second', 'third']
+    assert tail_lines(path, 11) == ['third']
+    assert tail_lines(path, 12) == ['second', 'third']
+
+
+def test_experiment_status(tmp_path):
+    path = make_experiment(tmp_path / 'experiment', cases=7, errors={(3, 'date_desc')})
+    experiment = ExperimentStatus(path)
+    assert (experiment.total_cases, experiment.completed_cases, experiment.missing_cases) == (10, 7, 3)
+    assert experiment.latest_case == ('3', 'relevance')
+    assert experiment.recent_errors() == (0, 7)
+    summary = experiment.summary()
+    assert summary[1] == '7 of 10 cases completed (70.0%), 3 missing'
+    assert summary[-1] == '  Search Backend failed'
+
+
+def test_experiment_status_reads_only_the_tail(tmp_path, monkeypatch):
+    path = make_experiment(tmp_path / 'experiment', num_queries=100, cases=150, errors={(74, 'date_desc')})
+    monkeypatch.setattr(status, 'TAIL_BYTES', 20 * 30)
+    (path / 'hedges.csv').unlink()
+    experiment = ExperimentStatus(path)
+    # the hedges are counted from the tail, and the cases before it from the lines of results.csv
+    assert experiment.hedges == 2
+    assert (experiment.completed_cases, experiment.missing_cases) == (150, 50)
+    assert experiment.latest_case == ('74', 'date_desc')
+    errors, cases = experiment.recent_errors()
+    assert errors == 1 and 0 < cases < 20
+
+
+def test_status_command(tmp_path, capsys):
+    make_experiment(tmp_path / 'results' / 'sharded' / 'shard-0-of-2', cases=4)
+    make_experiment(tmp_path / 'results' / 'sharded' / 'shard-1-of-2', cases=10)
+    config_path = tmp_path / 'config.yml'
+    config_path.write_text(f'result_path: {tmp_path / "results"}\n')
+    cli.main(['team4', 'status', 'sharded', '-c', str(config_path)])
+    out = capsys.readouterr().out
+    assert '4 of 10 cases completed (40.0%), 6 missing' in out
+    assert '10 of 10 cases completed (100.0%), 0 missing' in out
+    with pytest.raises(SystemExit):
+        cli.main(['team4', 'status', 'missing', '-c', str(config_path)])
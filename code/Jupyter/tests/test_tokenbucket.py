@@ -0,0 +1,59 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bmcodeathon.team4 import EUtils
+from bmcodeathon.team4.tokenbucket import TokenBucket, retry_after
+
+
+def test_reservations_do_not_hold_the_lock():
+    bucket = TokenBucket(rate=10, tokens=0, capacity=1)
+    waits = [bucket.reserve(1) for _ in range(3)]
+    assert waits == sorted(waits)
+    assert 0.25 < waits[-1] <= 0.3
+    assert not bucket.lock.locked()
+
+
+def test_aimd():
+    bucket = TokenBucket(rate=10, tokens=0, capacity=1)
+    bucket.penalize()
+    bucket.penalize()
+    assert bucket.rate == 2.5
+    for _ in range(1000):
+        bucket.reward()
+    assert bucket.rate == 10
+
+
+def test_retry_after():
+    assert retry_after({'Retry-After': '2'}) == 2.0
+    assert retry_after({'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}) == 0.0
+    assert retry_after({}) is None
+
+
+def test_calls_per_second_matches_rate(eutils_server):
+    rate = 25
+    eutils = EUtils(rate=rate, prefix=eutils_server.prefix)
+    # let the bucket's initial burst drain so that the measurement is the steady rate
+    eutils.session.tokenbucket.reserve(rate)
+    num_calls = 50
+
+    stime = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(lambda i: eutils.esearch('pubmed', term=f'query {i}'), range(num_calls)))
+    elapsed = time.perf_counter() - stime
+
+    tput = num_calls / elapsed
+    assert 0.9 * rate < tput < 1.05 * rate
+
+
+def test_429_honors_retry_after(eutils_server):
+    eutils_server.failures.append((429, {'Retry-After': '1'}))
+    eutils = EUtils(rate=100, prefix=eutils_server.prefix)
+
+    stime = time.perf_counter()
+    r = eutils.esearch('pubmed', term='cancer')
+    elapsed = time.perf_counter() - stime
+
+    assert r.status_code == 200
+    assert len(eutils_server.requests) == 2
+    assert elapsed >= 1.0
+    assert eutils.session.tokenbucket.rate < 100